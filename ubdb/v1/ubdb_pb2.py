@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12ubdb/v1/ubdb.proto\x12\x07ubdb.v1\"_\n\x15\x41\x64\x64\x42ucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x14\n\x05owner\x18\x02 \x01(\tR\x05owner\x12\x18\n\x07\x63luster\x18\x03 \x01(\tR\x07\x63luster\"\x18\n\x16\x41\x64\x64\x42ucketEntryResponse\"\x8e\x01\n\x18UpdateBucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x18\n\x07\x63luster\x18\x02 \x01(\tR\x07\x63luster\x12*\n\x05state\x18\x03 \x01(\x0e\x32\x14.ubdb.v1.BucketStateR\x05state\x12\x14\n\x05owner\x18\x04 \x01(\tR\x05owner\"\x1b\n\x19UpdateBucketEntryResponse\"b\n\x18\x44\x65leteBucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x18\n\x07\x63luster\x18\x02 \x01(\tR\x07\x63luster\x12\x14\n\x05owner\x18\x03 \x01(\tR\x05owner\"\x1b\n\x19\x44\x65leteBucketEntryResponse\"\x12\n\x10ReconcileRequest\"\x13\n\x11ReconcileResponse*`\n\x0b\x42ucketState\x12\x1c\n\x18\x42UCKET_STATE_UNSPECIFIED\x10\x00\x12\x18\n\x14\x42UCKET_STATE_CREATED\x10\x01\x12\x19\n\x15\x42UCKET_STATE_DELETING\x10\x02\x32\xdc\x02\n\x0bUBDBService\x12Q\n\x0e\x41\x64\x64\x42ucketEntry\x12\x1e.ubdb.v1.AddBucketEntryRequest\x1a\x1f.ubdb.v1.AddBucketEntryResponse\x12Z\n\x11\x44\x65leteBucketEntry\x12!.ubdb.v1.DeleteBucketEntryRequest\x1a\".ubdb.v1.DeleteBucketEntryResponse\x12Z\n\x11UpdateBucketEntry\x12!.ubdb.v1.UpdateBucketEntryRequest\x1a\".ubdb.v1.UpdateBucketEntryResponse\x12\x42\n\tReconcile\x12\x19.ubdb.v1.ReconcileRequest\x1a\x1a.ubdb.v1.ReconcileResponseB\x89\x01\n\x0b\x63om.ubdb.v1B\tUbdbProtoP\x01Z2bits.linode.com/StorageTeam/ubns/gen/proto/ubdb/v1\xa2\x02\x03UXX\xaa\x02\x07Ubdb.V1\xca\x02\x07Ubdb\\V1\xe2\x02\x13Ubdb\\V1\\GPBMetadata\xea\x02\x08Ubdb::V1b\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x12ubdb/v1/ubdb.proto\x12\x07ubdb.v1\"_\n\x15\x41\x64\x64\x42ucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x14\n\x05owner\x18\x02 \x01(\tR\x05owner\x12\x18\n\x07\x63luster\x18\x03 \x01(\tR\x07\x63luster\"\x18\n\x16\x41\x64\x64\x42ucketEntryResponse\"\x8e\x01\n\x18UpdateBucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x18\n\x07\x63luster\x18\x02 \x01(\tR\x07\x63luster\x12*\n\x05state\x18\x03 \x01(\x0e\x32\x14.ubdb.v1.BucketStateR\x05state\x12\x14\n\x05owner\x18\x04 \x01(\tR\x05owner\"\x1b\n\x19UpdateBucketEntryResponse\"b\n\x18\x44\x65leteBucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x18\n\x07\x63luster\x18\x02 \x01(\tR\x07\x63luster\x12\x14\n\x05owner\x18\x03 \x01(\tR\x05owner\"\x1b\n\x19\x44\x65leteBucketEntryResponse\"b\n\x18\x43reateBucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x14\n\x05owner\x18\x02 \x01(\tR\x05owner\x12\x18\n\x07\x63luster\x18\x03 \x01(\tR\x07\x63luster\"\x1b\n\x19\x43reateBucketEntryResponse\"c\n\x19\x44\x65stroyBucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x18\n\x07\x63luster\x18\x02 \x01(\tR\x07\x63luster\x12\x14\n\x05owner\x18\x03 \x01(\tR\x05owner\"\x1c\n\x1a\x44\x65stroyBucketEntryResponse\"\x99\x01\n\x10ReconcileRequest\x12\x18\n\x07\x63luster\x18\x01 \x01(\tR\x07\x63luster\x12\x32\n\x07\x64igests\x18\x02 \x03(\x0b\x32\x18.ubdb.v1.ReconcileDigestR\x07\x64igests\x12\x37\n\x07\x65ntries\x18\x03 \x03(\x0b\x32\x1d.ubdb.v1.ReconcileNodeEntriesR\x07\x65ntries\"U\n\x0fReconcileDigest\x12\x14\n\x05level\x18\x01 \x01(\rR\x05level\x12\x14\n\x05index\x18\x02 \x01(\rR\x05index\x12\x16\n\x06\x64igest\x18\x03 \x01(\x06R\x06\x64igest\"e\n\x14ReconcileNodeEntries\x12\x14\n\x05level\x18\x01 \x01(\rR\x05level\x12\x14\n\x05index\x18\x02 \x01(\rR\x05index\x12!\n\x0c\x65ntry_hashes\x18\x03 \x03(\x06R\x0b\x65ntryHashes\">\n\x0eReconcileEntry\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x14\n\x05owner\x18\x02 \x01(\tR\x05owner\"\xc4\x01\n\x11ReconcileResponse\x12\x38\n\nmismatched\x18\x01 \x03(\x0b\x32\x18.ubdb.v1.ReconcileDigestR\nmismatched\x12I\n\x14missing_from_cluster\x18\x02 \x03(\x0b\x32\x17.ubdb.v1.ReconcileEntryR\x12missingFromCluster\x12*\n\x11missing_from_ubdb\x18\x03 \x03(\x06R\x0fmissingFromUbdb\"\x85\x03\n\x14\x42ucketEntryOperation\x12=\n\tadd_entry\x18\x01 \x01(\x0b\x32\x1e.ubdb.v1.AddBucketEntryRequestH\x00R\x08\x61\x64\x64\x45ntry\x12\x46\n\x0cupdate_entry\x18\x02 \x01(\x0b\x32!.ubdb.v1.UpdateBucketEntryRequestH\x00R\x0bupdateEntry\x12\x46\n\x0c\x64\x65lete_entry\x18\x03 \x01(\x0b\x32!.ubdb.v1.DeleteBucketEntryRequestH\x00R\x0b\x64\x65leteEntry\x12\x46\n\x0c\x63reate_entry\x18\x04 \x01(\x0b\x32!.ubdb.v1.CreateBucketEntryRequestH\x00R\x0b\x63reateEntry\x12I\n\rdestroy_entry\x18\x05 \x01(\x0b\x32\".ubdb.v1.DestroyBucketEntryRequestH\x00R\x0c\x64\x65stroyEntryB\x0b\n\toperation\"Z\n\x19\x42\x61tchBucketEntriesRequest\x12=\n\noperations\x18\x01 \x03(\x0b\x32\x1d.ubdb.v1.BucketEntryOperationR\noperations\"A\n\x11\x42ucketEntryResult\x12\x12\n\x04\x63ode\x18\x01 \x01(\x05R\x04\x63ode\x12\x18\n\x07message\x18\x02 \x01(\tR\x07message\"R\n\x1a\x42\x61tchBucketEntriesResponse\x12\x34\n\x07results\x18\x01 \x03(\x0b\x32\x1a.ubdb.v1.BucketEntryResultR\x07results\"\x84\x02\n\x18ListBucketEntriesRequest\x12\x18\n\x07\x63luster\x18\x01 \x01(\tR\x07\x63luster\x12\x14\n\x05owner\x18\x02 \x01(\tR\x05owner\x12*\n\x05state\x18\x03 \x01(\x0e\x32\x14.ubdb.v1.BucketStateR\x05state\x12\x1b\n\tpage_size\x18\x04 \x01(\rR\x08pageSize\x12\x1d\n\npage_token\x18\x05 \x01(\tR\tpageToken\x12\x16\n\x06prefix\x18\x06 \x01(\tR\x06prefix\x12\x19\n\x08start_at\x18\x07 \x01(\tR\x07startAt\x12\x1d\n\nend_before\x18\x08 \x01(\tR\tendBefore\"\xa2\x01\n\x0b\x42ucketEntry\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x18\n\x07\x63luster\x18\x02 \x01(\tR\x07\x63luster\x12\x14\n\x05owner\x18\x03 \x01(\tR\x05owner\x12*\n\x05state\x18\x04 \x01(\x0e\x32\x14.ubdb.v1.BucketStateR\x05state\x12\x1f\n\x0b\x64\x65leted_seq\x18\x05 \x01(\x04R\ndeletedSeq\"s\n\x19ListBucketEntriesResponse\x12.\n\x07\x65ntries\x18\x01 \x03(\x0b\x32\x14.ubdb.v1.BucketEntryR\x07\x65ntries\x12&\n\x0fnext_page_token\x18\x02 \x01(\tR\rnextPageToken\"_\n\x15GetBucketEntryRequest\x12\x16\n\x06\x62ucket\x18\x01 \x01(\tR\x06\x62ucket\x12\x18\n\x07\x63luster\x18\x02 \x01(\tR\x07\x63luster\x12\x14\n\x05owner\x18\x03 \x01(\tR\x05owner\"D\n\x16GetBucketEntryResponse\x12*\n\x05\x65ntry\x18\x01 \x01(\x0b\x32\x14.ubdb.v1.BucketEntryR\x05\x65ntry\"S\n\x17GetBucketEntriesRequest\x12\x38\n\x07\x65ntries\x18\x01 \x03(\x0b\x32\x1e.ubdb.v1.GetBucketEntryRequestR\x07\x65ntries\"p\n\x14GetBucketEntryResult\x12\x12\n\x04\x63ode\x18\x01 \x01(\x05R\x04\x63ode\x12\x18\n\x07message\x18\x02 \x01(\tR\x07message\x12*\n\x05\x65ntry\x18\x03 \x01(\x0b\x32\x14.ubdb.v1.BucketEntryR\x05\x65ntry\"S\n\x18GetBucketEntriesResponse\x12\x37\n\x07results\x18\x01 \x03(\x0b\x32\x1d.ubdb.v1.GetBucketEntryResultR\x07results\"h\n\x19WatchBucketEntriesRequest\x12\x18\n\x07\x63luster\x18\x01 \x01(\tR\x07\x63luster\x12\x14\n\x05owner\x18\x02 \x01(\tR\x05owner\x12\x1b\n\tafter_seq\x18\x03 \x01(\x04R\x08\x61\x66terSeq\"Q\n\x11\x42ucketEntryChange\x12\x10\n\x03seq\x18\x01 \x01(\x04R\x03seq\x12*\n\x05\x65ntry\x18\x02 \x01(\x0b\x32\x14.ubdb.v1.BucketEntryR\x05\x65ntry\"|\n\x1aWatchBucketEntriesResponse\x12\x34\n\x07\x63hanges\x18\x01 \x03(\x0b\x32\x1a.ubdb.v1.BucketEntryChangeR\x07\x63hanges\x12\x10\n\x03seq\x18\x02 \x01(\x04R\x03seq\x12\x16\n\x06resync\x18\x03 \x01(\x08R\x06resync*\x95\x01\n\x0b\x42ucketState\x12\x1c\n\x18\x42UCKET_STATE_UNSPECIFIED\x10\x00\x12\x18\n\x14\x42UCKET_STATE_CREATED\x10\x01\x12\x19\n\x15\x42UCKET_STATE_DELETING\x10\x02\x12\x19\n\x15\x42UCKET_STATE_CREATING\x10\x03\x12\x18\n\x14\x42UCKET_STATE_DELETED\x10\x04\x32\xe5\x07\n\x0bUBDBService\x12Q\n\x0e\x41\x64\x64\x42ucketEntry\x12\x1e.ubdb.v1.AddBucketEntryRequest\x1a\x1f.ubdb.v1.AddBucketEntryResponse\x12Z\n\x11\x44\x65leteBucketEntry\x12!.ubdb.v1.DeleteBucketEntryRequest\x1a\".ubdb.v1.DeleteBucketEntryResponse\x12Z\n\x11UpdateBucketEntry\x12!.ubdb.v1.UpdateBucketEntryRequest\x1a\".ubdb.v1.UpdateBucketEntryResponse\x12Z\n\x11\x43reateBucketEntry\x12!.ubdb.v1.CreateBucketEntryRequest\x1a\".ubdb.v1.CreateBucketEntryResponse\x12]\n\x12\x44\x65stroyBucketEntry\x12\".ubdb.v1.DestroyBucketEntryRequest\x1a#.ubdb.v1.DestroyBucketEntryResponse\x12\x42\n\tReconcile\x12\x19.ubdb.v1.ReconcileRequest\x1a\x1a.ubdb.v1.ReconcileResponse\x12\x61\n\x12\x42\x61tchBucketEntries\x12\".ubdb.v1.BatchBucketEntriesRequest\x1a#.ubdb.v1.BatchBucketEntriesResponse(\x01\x30\x01\x12\\\n\x11ListBucketEntries\x12!.ubdb.v1.ListBucketEntriesRequest\x1a\".ubdb.v1.ListBucketEntriesResponse0\x01\x12Q\n\x0eGetBucketEntry\x12\x1e.ubdb.v1.GetBucketEntryRequest\x1a\x1f.ubdb.v1.GetBucketEntryResponse\x12W\n\x10GetBucketEntries\x12 .ubdb.v1.GetBucketEntriesRequest\x1a!.ubdb.v1.GetBucketEntriesResponse\x12_\n\x12WatchBucketEntries\x12\".ubdb.v1.WatchBucketEntriesRequest\x1a#.ubdb.v1.WatchBucketEntriesResponse0\x01\x42\x89\x01\n\x0b\x63om.ubdb.v1B\tUbdbProtoP\x01Z2bits.linode.com/StorageTeam/ubns/gen/proto/ubdb/v1\xa2\x02\x03UXX\xaa\x02\x07Ubdb.V1\xca\x02\x07Ubdb\\V1\xe2\x02\x13Ubdb\\V1\\GPBMetadata\xea\x02\x08Ubdb::V1b\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -21,8 +21,8 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'ubdb.v1.ubdb_pb2', _globals
 if _descriptor._USE_C_DESCRIPTORS == False:
   DESCRIPTOR._options = None
   DESCRIPTOR._serialized_options = b'\n\013com.ubdb.v1B\tUbdbProtoP\001Z2bits.linode.com/StorageTeam/ubns/gen/proto/ubdb/v1\242\002\003UXX\252\002\007Ubdb.V1\312\002\007Ubdb\\V1\342\002\023Ubdb\\V1\\GPBMetadata\352\002\010Ubdb::V1'
-  _globals['_BUCKETSTATE']._serialized_start=498
-  _globals['_BUCKETSTATE']._serialized_end=594
+  _globals['_BUCKETSTATE']._serialized_start=3273
+  _globals['_BUCKETSTATE']._serialized_end=3422
   _globals['_ADDBUCKETENTRYREQUEST']._serialized_start=31
   _globals['_ADDBUCKETENTRYREQUEST']._serialized_end=126
   _globals['_ADDBUCKETENTRYRESPONSE']._serialized_start=128
@@ -35,10 +35,54 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _globals['_DELETEBUCKETENTRYREQUEST']._serialized_end=426
   _globals['_DELETEBUCKETENTRYRESPONSE']._serialized_start=428
   _globals['_DELETEBUCKETENTRYRESPONSE']._serialized_end=455
-  _globals['_RECONCILEREQUEST']._serialized_start=457
-  _globals['_RECONCILEREQUEST']._serialized_end=475
-  _globals['_RECONCILERESPONSE']._serialized_start=477
-  _globals['_RECONCILERESPONSE']._serialized_end=496
-  _globals['_UBDBSERVICE']._serialized_start=597
-  _globals['_UBDBSERVICE']._serialized_end=945
+  _globals['_CREATEBUCKETENTRYREQUEST']._serialized_start=457
+  _globals['_CREATEBUCKETENTRYREQUEST']._serialized_end=555
+  _globals['_CREATEBUCKETENTRYRESPONSE']._serialized_start=557
+  _globals['_CREATEBUCKETENTRYRESPONSE']._serialized_end=584
+  _globals['_DESTROYBUCKETENTRYREQUEST']._serialized_start=586
+  _globals['_DESTROYBUCKETENTRYREQUEST']._serialized_end=685
+  _globals['_DESTROYBUCKETENTRYRESPONSE']._serialized_start=687
+  _globals['_DESTROYBUCKETENTRYRESPONSE']._serialized_end=715
+  _globals['_RECONCILEREQUEST']._serialized_start=718
+  _globals['_RECONCILEREQUEST']._serialized_end=871
+  _globals['_RECONCILEDIGEST']._serialized_start=873
+  _globals['_RECONCILEDIGEST']._serialized_end=958
+  _globals['_RECONCILENODEENTRIES']._serialized_start=960
+  _globals['_RECONCILENODEENTRIES']._serialized_end=1061
+  _globals['_RECONCILEENTRY']._serialized_start=1063
+  _globals['_RECONCILEENTRY']._serialized_end=1125
+  _globals['_RECONCILERESPONSE']._serialized_start=1128
+  _globals['_RECONCILERESPONSE']._serialized_end=1324
+  _globals['_BUCKETENTRYOPERATION']._serialized_start=1327
+  _globals['_BUCKETENTRYOPERATION']._serialized_end=1716
+  _globals['_BATCHBUCKETENTRIESREQUEST']._serialized_start=1718
+  _globals['_BATCHBUCKETENTRIESREQUEST']._serialized_end=1808
+  _globals['_BUCKETENTRYRESULT']._serialized_start=1810
+  _globals['_BUCKETENTRYRESULT']._serialized_end=1875
+  _globals['_BATCHBUCKETENTRIESRESPONSE']._serialized_start=1877
+  _globals['_BATCHBUCKETENTRIESRESPONSE']._serialized_end=1959
+  _globals['_LISTBUCKETENTRIESREQUEST']._serialized_start=1962
+  _globals['_LISTBUCKETENTRIESREQUEST']._serialized_end=2222
+  _globals['_BUCKETENTRY']._serialized_start=2225
+  _globals['_BUCKETENTRY']._serialized_end=2387
+  _globals['_LISTBUCKETENTRIESRESPONSE']._serialized_start=2389
+  _globals['_LISTBUCKETENTRIESRESPONSE']._serialized_end=2504
+  _globals['_GETBUCKETENTRYREQUEST']._serialized_start=2506
+  _globals['_GETBUCKETENTRYREQUEST']._serialized_end=2601
+  _globals['_GETBUCKETENTRYRESPONSE']._serialized_start=2603
+  _globals['_GETBUCKETENTRYRESPONSE']._serialized_end=2671
+  _globals['_GETBUCKETENTRIESREQUEST']._serialized_start=2673
+  _globals['_GETBUCKETENTRIESREQUEST']._serialized_end=2756
+  _globals['_GETBUCKETENTRYRESULT']._serialized_start=2758
+  _globals['_GETBUCKETENTRYRESULT']._serialized_end=2870
+  _globals['_GETBUCKETENTRIESRESPONSE']._serialized_start=2872
+  _globals['_GETBUCKETENTRIESRESPONSE']._serialized_end=2955
+  _globals['_WATCHBUCKETENTRIESREQUEST']._serialized_start=2957
+  _globals['_WATCHBUCKETENTRIESREQUEST']._serialized_end=3061
+  _globals['_BUCKETENTRYCHANGE']._serialized_start=3063
+  _globals['_BUCKETENTRYCHANGE']._serialized_end=3144
+  _globals['_WATCHBUCKETENTRIESRESPONSE']._serialized_start=3146
+  _globals['_WATCHBUCKETENTRIESRESPONSE']._serialized_end=3270
+  _globals['_UBDBSERVICE']._serialized_start=3425
+  _globals['_UBDBSERVICE']._serialized_end=4422
 # @@protoc_insertion_point(module_scope)
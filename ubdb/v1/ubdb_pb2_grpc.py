@@ -31,11 +31,46 @@ class UBDBServiceStub(object):
                 request_serializer=ubdb_dot_v1_dot_ubdb__pb2.UpdateBucketEntryRequest.SerializeToString,
                 response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.UpdateBucketEntryResponse.FromString,
                 )
+        self.CreateBucketEntry = channel.unary_unary(
+                '/ubdb.v1.UBDBService/CreateBucketEntry',
+                request_serializer=ubdb_dot_v1_dot_ubdb__pb2.CreateBucketEntryRequest.SerializeToString,
+                response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.CreateBucketEntryResponse.FromString,
+                )
+        self.DestroyBucketEntry = channel.unary_unary(
+                '/ubdb.v1.UBDBService/DestroyBucketEntry',
+                request_serializer=ubdb_dot_v1_dot_ubdb__pb2.DestroyBucketEntryRequest.SerializeToString,
+                response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.DestroyBucketEntryResponse.FromString,
+                )
         self.Reconcile = channel.unary_unary(
                 '/ubdb.v1.UBDBService/Reconcile',
                 request_serializer=ubdb_dot_v1_dot_ubdb__pb2.ReconcileRequest.SerializeToString,
                 response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.ReconcileResponse.FromString,
                 )
+        self.BatchBucketEntries = channel.stream_stream(
+                '/ubdb.v1.UBDBService/BatchBucketEntries',
+                request_serializer=ubdb_dot_v1_dot_ubdb__pb2.BatchBucketEntriesRequest.SerializeToString,
+                response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.BatchBucketEntriesResponse.FromString,
+                )
+        self.ListBucketEntries = channel.unary_stream(
+                '/ubdb.v1.UBDBService/ListBucketEntries',
+                request_serializer=ubdb_dot_v1_dot_ubdb__pb2.ListBucketEntriesRequest.SerializeToString,
+                response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.ListBucketEntriesResponse.FromString,
+                )
+        self.GetBucketEntry = channel.unary_unary(
+                '/ubdb.v1.UBDBService/GetBucketEntry',
+                request_serializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntryRequest.SerializeToString,
+                response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntryResponse.FromString,
+                )
+        self.GetBucketEntries = channel.unary_unary(
+                '/ubdb.v1.UBDBService/GetBucketEntries',
+                request_serializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntriesRequest.SerializeToString,
+                response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntriesResponse.FromString,
+                )
+        self.WatchBucketEntries = channel.unary_stream(
+                '/ubdb.v1.UBDBService/WatchBucketEntries',
+                request_serializer=ubdb_dot_v1_dot_ubdb__pb2.WatchBucketEntriesRequest.SerializeToString,
+                response_deserializer=ubdb_dot_v1_dot_ubdb__pb2.WatchBucketEntriesResponse.FromString,
+                )
 
 
 class UBDBServiceServicer(object):
@@ -64,8 +99,85 @@ class UBDBServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def CreateBucketEntry(self, request, context):
+        """CreateBucketEntry adds a BucketEntry in the CREATED state, as
+        AddBucketEntry then UpdateBucketEntry to CREATED would, atomically and
+        in one round trip.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def DestroyBucketEntry(self, request, context):
+        """DestroyBucketEntry deletes a BucketEntry in the CREATED state, as
+        UpdateBucketEntry to DELETING then DeleteBucketEntry would, atomically
+        and in one round trip.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def Reconcile(self, request, context):
         """Force trigger a reconciliation of UBDB with the Ceph clusters.
+
+        Reconciliation compares a cluster's bucket set with UBDB's entries for
+        that cluster over several calls, without shipping the whole set. Both
+        sides place each (bucket, owner) entry in a tree with fanout 16 by the
+        CRC-32 of the bucket name, each level down taking 4 more bits of it,
+        and digest each node as the XOR of the hashes of every entry under it.
+        An entry's hash is the 8-byte BLAKE2b digest of the bucket name, a NUL
+        and the owner, read as a big-endian integer. The caller sends its
+        digests for some nodes (starting with the root) and gets back the ones
+        that differ; it then sends the children of those, and so on. For
+        differing nodes that are small enough, it sends its entry hashes
+        instead, and gets back the entries only UBDB has and the hashes only it
+        has.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchBucketEntries(self, request_iterator, context):
+        """BatchBucketEntries applies batches of add, update, delete, create and
+        destroy operations. Each request message is applied as a unit and answered by
+        one response message carrying a result per operation, in order.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ListBucketEntries(self, request, context):
+        """ListBucketEntries streams the BucketEntries matching a filter in bucket
+        name order, a page per response message, until there are no more or
+        the caller cancels. A listing can be limited to a name prefix or range,
+        and resumed later from the next_page_token of the last page received.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetBucketEntry(self, request, context):
+        """GetBucketEntry returns a BucketEntry from UBDB, without changing it.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetBucketEntries(self, request, context):
+        """GetBucketEntries looks up many BucketEntries at once, each as
+        GetBucketEntry would.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchBucketEntries(self, request, context):
+        """WatchBucketEntries streams every change made to BucketEntries matching
+        a filter, in the order the server made them, until the caller cancels.
+        Each change carries its sequence number, and a watch can be resumed
+        after the last one received, for as long as the server still holds the
+        changes that followed it. When it doesn't, or when the watcher falls
+        that far behind, the stream ends with a resync message instead.
         """
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
@@ -89,11 +201,46 @@ def add_UBDBServiceServicer_to_server(servicer, server):
                     request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.UpdateBucketEntryRequest.FromString,
                     response_serializer=ubdb_dot_v1_dot_ubdb__pb2.UpdateBucketEntryResponse.SerializeToString,
             ),
+            'CreateBucketEntry': grpc.unary_unary_rpc_method_handler(
+                    servicer.CreateBucketEntry,
+                    request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.CreateBucketEntryRequest.FromString,
+                    response_serializer=ubdb_dot_v1_dot_ubdb__pb2.CreateBucketEntryResponse.SerializeToString,
+            ),
+            'DestroyBucketEntry': grpc.unary_unary_rpc_method_handler(
+                    servicer.DestroyBucketEntry,
+                    request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.DestroyBucketEntryRequest.FromString,
+                    response_serializer=ubdb_dot_v1_dot_ubdb__pb2.DestroyBucketEntryResponse.SerializeToString,
+            ),
             'Reconcile': grpc.unary_unary_rpc_method_handler(
                     servicer.Reconcile,
                     request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.ReconcileRequest.FromString,
                     response_serializer=ubdb_dot_v1_dot_ubdb__pb2.ReconcileResponse.SerializeToString,
             ),
+            'BatchBucketEntries': grpc.stream_stream_rpc_method_handler(
+                    servicer.BatchBucketEntries,
+                    request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.BatchBucketEntriesRequest.FromString,
+                    response_serializer=ubdb_dot_v1_dot_ubdb__pb2.BatchBucketEntriesResponse.SerializeToString,
+            ),
+            'ListBucketEntries': grpc.unary_stream_rpc_method_handler(
+                    servicer.ListBucketEntries,
+                    request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.ListBucketEntriesRequest.FromString,
+                    response_serializer=ubdb_dot_v1_dot_ubdb__pb2.ListBucketEntriesResponse.SerializeToString,
+            ),
+            'GetBucketEntry': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetBucketEntry,
+                    request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntryRequest.FromString,
+                    response_serializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntryResponse.SerializeToString,
+            ),
+            'GetBucketEntries': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetBucketEntries,
+                    request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntriesRequest.FromString,
+                    response_serializer=ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntriesResponse.SerializeToString,
+            ),
+            'WatchBucketEntries': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchBucketEntries,
+                    request_deserializer=ubdb_dot_v1_dot_ubdb__pb2.WatchBucketEntriesRequest.FromString,
+                    response_serializer=ubdb_dot_v1_dot_ubdb__pb2.WatchBucketEntriesResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'ubdb.v1.UBDBService', rpc_method_handlers)
@@ -157,6 +304,40 @@ class UBDBService(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def CreateBucketEntry(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/ubdb.v1.UBDBService/CreateBucketEntry',
+            ubdb_dot_v1_dot_ubdb__pb2.CreateBucketEntryRequest.SerializeToString,
+            ubdb_dot_v1_dot_ubdb__pb2.CreateBucketEntryResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def DestroyBucketEntry(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/ubdb.v1.UBDBService/DestroyBucketEntry',
+            ubdb_dot_v1_dot_ubdb__pb2.DestroyBucketEntryRequest.SerializeToString,
+            ubdb_dot_v1_dot_ubdb__pb2.DestroyBucketEntryResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def Reconcile(request,
             target,
@@ -173,3 +354,88 @@ class UBDBService(object):
             ubdb_dot_v1_dot_ubdb__pb2.ReconcileResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def BatchBucketEntries(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/ubdb.v1.UBDBService/BatchBucketEntries',
+            ubdb_dot_v1_dot_ubdb__pb2.BatchBucketEntriesRequest.SerializeToString,
+            ubdb_dot_v1_dot_ubdb__pb2.BatchBucketEntriesResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ListBucketEntries(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/ubdb.v1.UBDBService/ListBucketEntries',
+            ubdb_dot_v1_dot_ubdb__pb2.ListBucketEntriesRequest.SerializeToString,
+            ubdb_dot_v1_dot_ubdb__pb2.ListBucketEntriesResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def GetBucketEntry(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/ubdb.v1.UBDBService/GetBucketEntry',
+            ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntryRequest.SerializeToString,
+            ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntryResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def GetBucketEntries(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/ubdb.v1.UBDBService/GetBucketEntries',
+            ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntriesRequest.SerializeToString,
+            ubdb_dot_v1_dot_ubdb__pb2.GetBucketEntriesResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def WatchBucketEntries(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/ubdb.v1.UBDBService/WatchBucketEntries',
+            ubdb_dot_v1_dot_ubdb__pb2.WatchBucketEntriesRequest.SerializeToString,
+            ubdb_dot_v1_dot_ubdb__pb2.WatchBucketEntriesResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -0,0 +1,574 @@
+"""
+Admission control for the UBNS server.
+
+Under overload it's better for some RPCs to fail fast than for every RPC to
+queue until it times out. Two things bound the work the server takes on:
+
+- gRPC's maximum_concurrent_rpcs, which refuses RPCs with RESOURCE_EXHAUSTED
+  while that many are already in progress, running or queued for a handler.
+  That bounds the queue.
+- Deadline-aware shedding, here. When an RPC reaches a handler, it fails
+  with RESOURCE_EXHAUSTED if its deadline is nearer than the time its method
+  usually takes, since its caller would have given up by the time it
+  finished. Shedding it frees the thread for one that can still make it.
+
+Neither of those cares whose RPCs they are, so one Ceph cluster calling in
+a tight loop can take the capacity every other cluster needs. Per-cluster
+admission, also here, shares it out:
+
+- Token buckets per cluster, and optionally per owner. Each RPC takes a
+  token from its cluster's bucket and its owner's, refilled at the limit's
+  rate up to its burst. One that finds either empty fails at once with
+  RESOURCE_EXHAUSTED and a google.rpc.RetryInfo saying when the next token
+  is due.
+- A weighted fair queue. Only so many RPCs run at once; the rest wait in
+  start-time fair order, so that each cluster with RPCs waiting gets turns
+  in proportion to its weight, however many it sends. A cluster with too
+  many waiting has the excess refused.
+
+Limits, weights and the number of RPCs run at once can be changed while the
+server runs, and are off until something sets them.
+"""
+
+import asyncio
+from datetime import timedelta
+from google.protobuf import any_pb2
+from google.rpc import code_pb2
+from google.rpc import error_details_pb2
+from google.rpc import status_pb2
+import grpc
+from grpc_status import rpc_status
+import heapq
+import itertools
+import threading
+import time
+
+from ubns_partition import is_forwarded
+
+
+class DeadlineShedder:
+    """Per-method service time estimates, and the RPCs shed because of them."""
+
+    # Weight of each new sample in a method's moving average.
+    ALPHA = 0.05
+
+    def __init__(self):
+        # method -> seconds. Updated without a lock: a lost sample only
+        # costs the estimate a little precision.
+        self.service_time: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.shed: dict[str, int] = {}
+
+    def check(self, method: str, remaining: float) -> str:
+        """Why an RPC with `remaining` seconds left should be shed, or None."""
+        expected = self.service_time.get(method)
+        if remaining is None or expected is None or remaining >= expected:
+            return None
+        with self._lock:
+            self.shed[method] = self.shed.get(method, 0) + 1
+        # Shed RPCs don't run, so don't add samples. Decay the estimate
+        # instead, so that one stall doesn't have every RPC with a tighter
+        # deadline shed from then on: eventually one gets to run and
+        # measure afresh.
+        self.service_time[method] = expected * (1 - self.ALPHA)
+        return (
+            f"shed: deadline in {remaining * 1000:.1f}ms, "
+            f"{method} takes {expected * 1000:.1f}ms"
+        )
+
+    def record(self, method: str, duration: float):
+        expected = self.service_time.get(method)
+        if expected is None:
+            self.service_time[method] = duration
+        else:
+            self.service_time[method] = expected + self.ALPHA * (duration - expected)
+
+
+def _wrap_handler(handler, method: str, policy, wrap_unary):
+    if handler is None or handler.unary_unary is None:
+        # Streams are left alone: they take as long as their results do.
+        return handler
+    return grpc.unary_unary_rpc_method_handler(
+        wrap_unary(handler.unary_unary, method, policy),
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer,
+    )
+
+
+def _shed_unary(behavior, method, shedder):
+    def wrapper(request, context):
+        reason = shedder.check(method, context.time_remaining())
+        if reason is not None:
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, reason)
+        start = time.perf_counter()
+        response = behavior(request, context)
+        shedder.record(method, time.perf_counter() - start)
+        return response
+
+    return wrapper
+
+
+def _shed_unary_async(behavior, method, shedder):
+    async def wrapper(request, context):
+        reason = shedder.check(method, context.time_remaining())
+        if reason is not None:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, reason)
+        start = time.perf_counter()
+        response = await behavior(request, context)
+        shedder.record(method, time.perf_counter() - start)
+        return response
+
+    return wrapper
+
+
+class SheddingInterceptor(grpc.ServerInterceptor):
+    """
+    Sheds unary RPCs that can't finish before their deadline on a
+    thread-pool server. The check is made when a handler thread picks the
+    RPC up, after any time it spent queued.
+    """
+
+    def __init__(self, shedder: DeadlineShedder):
+        self.shedder = shedder
+
+    def intercept_service(self, continuation, handler_call_details):
+        return _wrap_handler(
+            continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            self.shedder,
+            _shed_unary,
+        )
+
+
+class AsyncSheddingInterceptor(grpc.aio.ServerInterceptor):
+    """As SheddingInterceptor, for a grpc.aio server."""
+
+    def __init__(self, shedder: DeadlineShedder):
+        self.shedder = shedder
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return _wrap_handler(
+            await continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            self.shedder,
+            _shed_unary_async,
+        )
+
+
+class TokenBuckets:
+    """
+    A token bucket per key, each refilled at its limit's rate (tokens per
+    second) up to its burst. A key without a limit of its own has the
+    default; a rate of 0 means unlimited. Callers serialize access.
+    """
+
+    # Drop idle buckets, which are full and so the same as new ones, once
+    # this many more keys have been seen since the last time.
+    PRUNE_AFTER = 10000
+
+    def __init__(self, rate: float = 0, burst: float = None, limits=None):
+        self.default = (rate, burst or rate)
+        # key -> (rate, burst)
+        self.limits = dict(limits or {})
+        # key -> [tokens, monotonic time of the last refill]
+        self._buckets = {}
+        self._prune_at = self.PRUNE_AFTER
+
+    @property
+    def active(self) -> bool:
+        return bool(self.default[0] or any(r for r, _ in self.limits.values()))
+
+    def set_limit(self, key: str, rate: float, burst: float = None):
+        """Set a key's limit, or the default's if key is None."""
+        limit = (rate, burst or rate)
+        if key is None:
+            self.default = limit
+        elif rate:
+            self.limits[key] = limit
+        else:
+            self.limits.pop(key, None)
+        self._buckets.clear()
+
+    def wait(self, key: str, now: float) -> float:
+        """Seconds until key has a token; 0 if it has one now."""
+        rate, burst = self.limits.get(key, self.default)
+        if not rate:
+            return 0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._prune_at:
+                self._prune(now)
+            bucket = self._buckets[key] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return 0 if bucket[0] >= 1 else (1 - bucket[0]) / rate
+
+    def take(self, key: str):
+        """Take a token that wait() has just said is there."""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket[0] -= 1
+
+    def _prune(self, now: float):
+        for key, (tokens, stamp) in list(self._buckets.items()):
+            rate, burst = self.limits.get(key, self.default)
+            if not rate or tokens + (now - stamp) * rate >= burst:
+                del self._buckets[key]
+        self._prune_at = len(self._buckets) + self.PRUNE_AFTER
+
+
+class QueueFullError(Exception):
+    """A key already has as many RPCs waiting as its queue may hold."""
+
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(f"too many RPCs from cluster '{key}' waiting to run")
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("key", "wake", "granted", "abandoned")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.wake = None
+        self.granted = False
+        self.abandoned = False
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class FairQueue:
+    """
+    Lets up to `slots` RPCs run at once, and queues the rest by key in
+    start-time fair order: an RPC's start tag is the later of the virtual
+    time and its key's last finish tag, and its key's finish tag moves on
+    1/weight past that. Waiters run lowest start tag first, and the
+    virtual time follows the start tag of the last to run.
+    """
+
+    # Weight of each new sample in the moving average of time held.
+    ALPHA = 0.05
+
+    def __init__(self, slots: int = 0, depth: int = 16, weights=None):
+        # 0 means no limit: nothing ever waits.
+        self.slots = slots
+        # Most RPCs waiting per key.
+        self.depth = depth
+        self.weights = dict(weights or {})
+        self.hold_time = 0.0
+        self._lock = threading.Lock()
+        self._running = 0
+        self._heap = []
+        self._arrivals = itertools.count()
+        # key -> RPCs queued, including any that gave up waiting.
+        self.waiting: dict[str, int] = {}
+        self._finish: dict[str, float] = {}
+        self._vtime = 0.0
+
+    def set_slots(self, slots: int):
+        with self._lock:
+            self.slots = slots
+            wakes = []
+            while self._heap and (not slots or self._running < slots):
+                waiter = self._next_locked()
+                if waiter is None:
+                    break
+                self._running += 1
+                wakes.append(waiter.wake)
+        for wake in wakes:
+            wake()
+
+    def _tag_locked(self, key: str) -> float:
+        start = max(self._vtime, self._finish.get(key, 0.0))
+        self._finish[key] = start + 1 / self.weights.get(key, 1.0)
+        return start
+
+    def _enter_locked(self, key: str) -> _Waiter:
+        """None if the RPC can run now, else its waiter, queued."""
+        if not self.slots or (self._running < self.slots and not self._heap):
+            self._running += 1
+            self._vtime = self._tag_locked(key)
+            return None
+        if self.waiting.get(key, 0) >= self.depth:
+            raise QueueFullError(
+                key, max(0.001, self.hold_time * self.depth / self.slots)
+            )
+        waiter = _Waiter(key)
+        heapq.heappush(
+            self._heap, (self._tag_locked(key), next(self._arrivals), waiter)
+        )
+        self.waiting[key] = self.waiting.get(key, 0) + 1
+        return waiter
+
+    def _next_locked(self) -> _Waiter:
+        """Pop the next waiter to run, skipping any that gave up."""
+        while self._heap:
+            start, _, waiter = heapq.heappop(self._heap)
+            self.waiting[waiter.key] -= 1
+            if not self.waiting[waiter.key]:
+                del self.waiting[waiter.key]
+            if not waiter.abandoned:
+                waiter.granted = True
+                self._vtime = start
+                return waiter
+        return None
+
+    def acquire(self, key: str, timeout: float = None) -> bool:
+        """
+        Wait for a turn to run, up to timeout seconds. Returns whether it
+        came; if it did, release() it after. Raises QueueFullError.
+        """
+        with self._lock:
+            waiter = self._enter_locked(key)
+            if waiter is None:
+                return True
+            event = threading.Event()
+            waiter.wake = event.set
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            # It may have come as the wait ran out.
+            waiter.abandoned = not waiter.granted
+        return waiter.granted
+
+    async def acquire_async(self, key: str, timeout: float = None) -> bool:
+        """As acquire(), from a coroutine."""
+        with self._lock:
+            waiter = self._enter_locked(key)
+            if waiter is None:
+                return True
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            waiter.wake = lambda: loop.call_soon_threadsafe(_grant, future)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self._lock:
+                waiter.abandoned = not waiter.granted
+            return waiter.granted
+        except asyncio.CancelledError:
+            with self._lock:
+                waiter.abandoned = not waiter.granted
+            if waiter.granted:
+                self.release(0)
+            raise
+
+    def release(self, held: float):
+        """Hand a finished RPC's turn to the next waiter, if any."""
+        with self._lock:
+            self.hold_time += self.ALPHA * (held - self.hold_time)
+            # Fewer slots since this one was taken: don't hand it on.
+            over = self.slots and self._running > self.slots
+            waiter = None if over else self._next_locked()
+            if waiter is None:
+                self._running -= 1
+                return
+        waiter.wake()
+
+
+def _throttled_status(message: str, retry_after: float) -> grpc.Status:
+    """RESOURCE_EXHAUSTED, with a RetryInfo saying when to try again."""
+    info = error_details_pb2.RetryInfo()
+    info.retry_delay.FromTimedelta(timedelta(seconds=retry_after))
+    detail = any_pb2.Any()
+    detail.Pack(info)
+    return rpc_status.to_status(
+        status_pb2.Status(
+            code=code_pb2.RESOURCE_EXHAUSTED, message=message, details=[detail]
+        )
+    )
+
+
+class ClusterAdmission:
+    """
+    Token buckets by cluster and by owner and a fair queue by cluster, as
+    one policy for the interceptors, with counts of the RPCs refused by
+    cluster and reason. An RPC that doesn't name a cluster or owner isn't
+    limited by one.
+    """
+
+    def __init__(
+        self,
+        clusters: TokenBuckets = None,
+        owners: TokenBuckets = None,
+        queue: FairQueue = None,
+    ):
+        self.clusters = clusters if clusters is not None else TokenBuckets()
+        self.owners = owners if owners is not None else TokenBuckets()
+        self.queue = queue if queue is not None else FairQueue()
+        self._lock = threading.Lock()
+        # (cluster, reason) -> RPCs refused
+        self.throttled: dict[tuple[str, str], int] = {}
+        self._update()
+
+    def _update(self):
+        # Whether there is anything to check; read by the interceptors.
+        self.active = bool(
+            self.clusters.active or self.owners.active or self.queue.slots
+        )
+
+    def count(self, cluster: str, reason: str):
+        with self._lock:
+            key = (cluster, reason)
+            self.throttled[key] = self.throttled.get(key, 0) + 1
+
+    def check(self, cluster: str, owner: str) -> tuple[str, float]:
+        """
+        Take a token for the cluster and the owner. If either has none,
+        take neither and return (why, seconds until there will be).
+        """
+        now = time.monotonic()
+        with self._lock:
+            cluster_wait = self.clusters.wait(cluster, now) if cluster else 0
+            owner_wait = self.owners.wait(owner, now) if owner else 0
+            if not cluster_wait and not owner_wait:
+                if cluster:
+                    self.clusters.take(cluster)
+                if owner:
+                    self.owners.take(owner)
+                return None
+            if cluster_wait >= owner_wait:
+                reason = "cluster_rate"
+                message = f"cluster '{cluster}' is over its rate limit"
+            else:
+                reason = "owner_rate"
+                message = f"owner '{owner}' is over its rate limit"
+            key = (cluster, reason)
+            self.throttled[key] = self.throttled.get(key, 0) + 1
+        return message, max(cluster_wait, owner_wait)
+
+    def set_limit(self, kind: str, key: str, rate: float, burst: float = None):
+        """Set a cluster's or owner's rate limit, or with key None, the default."""
+        buckets = self.clusters if kind == "cluster" else self.owners
+        with self._lock:
+            buckets.set_limit(key, rate, burst)
+        self._update()
+
+    def set_weight(self, cluster: str, weight: float):
+        with self.queue._lock:
+            self.queue.weights[cluster] = weight
+
+    def set_slots(self, slots: int, depth: int = None):
+        if depth is not None:
+            self.queue.depth = depth
+        self.queue.set_slots(slots)
+        self._update()
+
+    def describe(self) -> str:
+        """The current settings, one line each."""
+        queue = self.queue
+        lines = [
+            f"queue slots={queue.slots} depth={queue.depth} running={queue._running} "
+            f"waiting={sum(queue.waiting.values())}"
+        ]
+        for kind, buckets in (("cluster", self.clusters), ("owner", self.owners)):
+            rate, burst = buckets.default
+            lines.append(f"{kind} * rate={rate:g} burst={burst:g}")
+            for key, (rate, burst) in sorted(buckets.limits.items()):
+                lines.append(f"{kind} {key} rate={rate:g} burst={burst:g}")
+        for cluster, weight in sorted(queue.weights.items()):
+            lines.append(f"cluster {cluster} weight={weight:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _admit_unary(behavior, method, admission):
+    def wrapper(request, context):
+        if is_forwarded(context):
+            # Admitted by the worker that forwarded it.
+            return behavior(request, context)
+        cluster = getattr(request, "cluster", "")
+        refusal = admission.check(cluster, getattr(request, "owner", ""))
+        if refusal is not None:
+            context.abort_with_status(_throttled_status(*refusal))
+        queue = admission.queue
+        if not queue.slots:
+            return behavior(request, context)
+        try:
+            admitted = queue.acquire(cluster, context.time_remaining())
+        except QueueFullError as e:
+            admission.count(cluster, "queue_full")
+            context.abort_with_status(_throttled_status(str(e), e.retry_after))
+        if not admitted:
+            context.abort(
+                grpc.StatusCode.DEADLINE_EXCEEDED, "deadline passed waiting to run"
+            )
+        start = time.perf_counter()
+        try:
+            return behavior(request, context)
+        finally:
+            queue.release(time.perf_counter() - start)
+
+    return wrapper
+
+
+def _admit_unary_async(behavior, method, admission):
+    async def wrapper(request, context):
+        if is_forwarded(context):
+            return await behavior(request, context)
+        cluster = getattr(request, "cluster", "")
+        refusal = admission.check(cluster, getattr(request, "owner", ""))
+        if refusal is not None:
+            status = _throttled_status(*refusal)
+            await context.abort(status.code, status.details, status.trailing_metadata)
+        queue = admission.queue
+        if not queue.slots:
+            return await behavior(request, context)
+        try:
+            admitted = await queue.acquire_async(cluster, context.time_remaining())
+        except QueueFullError as e:
+            admission.count(cluster, "queue_full")
+            status = _throttled_status(str(e), e.retry_after)
+            await context.abort(status.code, status.details, status.trailing_metadata)
+        if not admitted:
+            await context.abort(
+                grpc.StatusCode.DEADLINE_EXCEEDED, "deadline passed waiting to run"
+            )
+        start = time.perf_counter()
+        try:
+            return await behavior(request, context)
+        finally:
+            queue.release(time.perf_counter() - start)
+
+    return wrapper
+
+
+class ClusterAdmissionInterceptor(grpc.ServerInterceptor):
+    """
+    Applies ClusterAdmission to unary RPCs on a thread-pool server. While
+    nothing is limited it only checks that nothing is.
+    """
+
+    def __init__(self, admission: ClusterAdmission):
+        self.admission = admission
+
+    def intercept_service(self, continuation, handler_call_details):
+        if not self.admission.active:
+            return continuation(handler_call_details)
+        return _wrap_handler(
+            continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            self.admission,
+            _admit_unary,
+        )
+
+
+class AsyncClusterAdmissionInterceptor(grpc.aio.ServerInterceptor):
+    """As ClusterAdmissionInterceptor, for a grpc.aio server."""
+
+    def __init__(self, admission: ClusterAdmission):
+        self.admission = admission
+
+    async def intercept_service(self, continuation, handler_call_details):
+        if not self.admission.active:
+            return await continuation(handler_call_details)
+        return _wrap_handler(
+            await continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            self.admission,
+            _admit_unary_async,
+        )
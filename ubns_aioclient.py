@@ -0,0 +1,392 @@
+"""
+asyncio client library for the UBDB service.
+
+UBNSClient keeps a pool of long-lived grpc.aio channels to one server and
+spreads calls over them, so a program pays for connection setup and TLS
+handshakes once rather than per call, and can have as many calls in flight
+as it likes: each method is a coroutine, and any number can be awaited
+together.
+
+    async with UBNSClient("dns:127.0.0.1:9000", channels=4) as client:
+        await client.create("b1", "cluster", "owner")
+        await asyncio.gather(
+            *(client.add(f"b{i}", "cluster", "owner") for i in range(2, 100))
+        )
+
+A failed call raises the UBNSError subclass for its status code, which
+carries the code, the server's message, its S3ErrorDetails if it sent any,
+and how long it asked the caller to wait before retrying, if it did. Bulk
+calls report a failed entry the same way, as an exception in its result
+rather than raised.
+"""
+
+import asyncio
+from google.rpc import error_details_pb2
+import grpc
+from grpc_status import rpc_status
+import itertools
+
+from ubdb.v1 import ubdb_pb2_grpc
+from ubdb.v1 import ubdb_pb2
+from ubns_dedup import REQUEST_ID_METADATA
+import ubns_reconcile
+
+
+class UBNSError(Exception):
+    """A call, or one entry of a bulk call, that the server refused."""
+
+    # Whether the same call may succeed if made again, after some backoff.
+    retryable = False
+
+    def __init__(
+        self, code: grpc.StatusCode, details: str, s3_error=None, retry_after=None
+    ):
+        super().__init__(f"{code.name}: {details}")
+        self.code = code
+        self.details = details
+        # ubdb_pb2.S3ErrorDetails, if the server sent them.
+        self.s3_error = s3_error
+        # Seconds the server asked the caller to wait before trying again,
+        # from a google.rpc.RetryInfo, if it sent one.
+        self.retry_after = retry_after
+
+
+class BucketExistsError(UBNSError):
+    """ALREADY_EXISTS: the bucket exists, or was deleted too recently."""
+
+
+class BucketNotFoundError(UBNSError):
+    """NOT_FOUND"""
+
+
+class MismatchError(UBNSError):
+    """FAILED_PRECONDITION: the bucket belongs to another cluster or owner."""
+
+
+class InvalidRequestError(UBNSError):
+    """INVALID_ARGUMENT, including state changes the bucket can't make."""
+
+
+class OverloadedError(UBNSError):
+    """
+    RESOURCE_EXHAUSTED: refused or shed by admission control, not run. If
+    the caller's cluster or owner was over its limit, retry_after says
+    when it won't be.
+    """
+
+    retryable = True
+
+
+class DeadlineExceededError(UBNSError):
+    """DEADLINE_EXCEEDED. A mutation may or may not have been applied."""
+
+
+class UnavailableError(UBNSError):
+    """UNAVAILABLE: the server couldn't be reached."""
+
+    retryable = True
+
+
+_ERRORS = {
+    grpc.StatusCode.ALREADY_EXISTS: BucketExistsError,
+    grpc.StatusCode.NOT_FOUND: BucketNotFoundError,
+    grpc.StatusCode.FAILED_PRECONDITION: MismatchError,
+    grpc.StatusCode.INVALID_ARGUMENT: InvalidRequestError,
+    grpc.StatusCode.RESOURCE_EXHAUSTED: OverloadedError,
+    grpc.StatusCode.DEADLINE_EXCEEDED: DeadlineExceededError,
+    grpc.StatusCode.UNAVAILABLE: UnavailableError,
+}
+
+# Numeric codes, as found in bulk results, to status codes.
+_CODES = {code.value[0]: code for code in grpc.StatusCode}
+
+# Not every version of the proto defines S3ErrorDetails.
+_S3_ERROR_DETAILS = getattr(ubdb_pb2, "S3ErrorDetails", None)
+
+# UpdateBucketEntry states by name.
+UPDATE_STATES = {
+    "created": ubdb_pb2.BucketState.BUCKET_STATE_CREATED,
+    "deleting": ubdb_pb2.BucketState.BUCKET_STATE_DELETING,
+}
+
+
+def error_for(code, details: str, s3_error=None, retry_after=None) -> UBNSError:
+    """The exception for a status code, given as a grpc.StatusCode or number."""
+    if not isinstance(code, grpc.StatusCode):
+        code = _CODES.get(code, grpc.StatusCode.UNKNOWN)
+    return _ERRORS.get(code, UBNSError)(code, details, s3_error, retry_after)
+
+
+def error_from_rpc(e: grpc.RpcError) -> UBNSError:
+    """
+    The exception for a failed call, with any S3ErrorDetails and RetryInfo
+    unpacked.
+    """
+    s3_error = retry_after = None
+    status = rpc_status.from_call(e)
+    if status is not None:
+        for detail in status.details:
+            if _S3_ERROR_DETAILS and detail.Is(_S3_ERROR_DETAILS.DESCRIPTOR):
+                s3_error = _S3_ERROR_DETAILS()
+                detail.Unpack(s3_error)
+            elif detail.Is(error_details_pb2.RetryInfo.DESCRIPTOR):
+                info = error_details_pb2.RetryInfo()
+                detail.Unpack(info)
+                retry_after = info.retry_delay.ToTimedelta().total_seconds()
+    return error_for(e.code(), e.details(), s3_error, retry_after)
+
+
+def _result_error(result):
+    """None for a bulk result that succeeded, else its exception."""
+    if result.code == grpc.StatusCode.OK.value[0]:
+        return None
+    return error_for(result.code, result.message)
+
+
+class _BlockingStub:
+    """
+    The client as the blocking stub ubns_reconcile expects, for use from
+    another thread than the event loop's.
+    """
+
+    def __init__(self, client: "UBNSClient", loop):
+        self.client = client
+        self.loop = loop
+
+    def Reconcile(self, request, timeout=None):
+        return asyncio.run_coroutine_threadsafe(
+            self.client._call("Reconcile", request, timeout), self.loop
+        ).result()
+
+
+class UBNSClient:
+    """
+    Calls to one server over a pool of `channels` connections, each call on
+    the next in turn. A timeout given to a call is its deadline in seconds;
+    without one, the client's `timeout` applies, and without that, none
+    does. Create and use it on one event loop, and close() it when done.
+    """
+
+    def __init__(
+        self,
+        target: str,
+        channels: int = 1,
+        credentials: grpc.ChannelCredentials = None,
+        timeout: float = None,
+        options=None,
+    ):
+        if credentials is None:
+            self._channels = [
+                grpc.aio.insecure_channel(target, options) for _ in range(channels)
+            ]
+        else:
+            self._channels = [
+                grpc.aio.secure_channel(target, credentials, options)
+                for _ in range(channels)
+            ]
+        self._stubs = itertools.cycle(
+            [ubdb_pb2_grpc.UBDBServiceStub(c) for c in self._channels]
+        )
+        self.timeout = timeout
+
+    async def close(self):
+        await asyncio.gather(*(c.close() for c in self._channels))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _deadline(self, timeout: float):
+        return self.timeout if timeout is None else timeout
+
+    async def _call(self, method: str, request, timeout=None, request_id=None):
+        metadata = ((REQUEST_ID_METADATA, request_id),) if request_id else None
+        try:
+            return await getattr(next(self._stubs), method)(
+                request, timeout=self._deadline(timeout), metadata=metadata
+            )
+        except grpc.RpcError as e:
+            raise error_from_rpc(e) from None
+
+    async def call(self, method: str, request, timeout=None, request_id=None):
+        """
+        Any unary call, by its method name, with the request message as
+        given; for a caller that already has one, as replaying a trace does.
+        """
+        return await self._call(method, request, timeout, request_id)
+
+    # Mutations. A request ID makes a retry of the same call get the first
+    # attempt's outcome instead of being applied again.
+
+    async def add(self, bucket, cluster, owner, request_id=None, timeout=None):
+        request = ubdb_pb2.AddBucketEntryRequest(
+            bucket=bucket, cluster=cluster, owner=owner
+        )
+        return await self._call("AddBucketEntry", request, timeout, request_id)
+
+    async def update(
+        self, bucket, cluster, owner, state, request_id=None, timeout=None
+    ):
+        """Move a bucket to `state`: "created", "deleting", or the enum value."""
+        request = ubdb_pb2.UpdateBucketEntryRequest(
+            bucket=bucket,
+            cluster=cluster,
+            owner=owner,
+            state=UPDATE_STATES.get(state, state),
+        )
+        return await self._call("UpdateBucketEntry", request, timeout, request_id)
+
+    async def delete(self, bucket, cluster, owner, request_id=None, timeout=None):
+        request = ubdb_pb2.DeleteBucketEntryRequest(
+            bucket=bucket, cluster=cluster, owner=owner
+        )
+        return await self._call("DeleteBucketEntry", request, timeout, request_id)
+
+    async def create(self, bucket, cluster, owner, request_id=None, timeout=None):
+        request = ubdb_pb2.CreateBucketEntryRequest(
+            bucket=bucket, cluster=cluster, owner=owner
+        )
+        return await self._call("CreateBucketEntry", request, timeout, request_id)
+
+    async def destroy(self, bucket, cluster, owner, request_id=None, timeout=None):
+        request = ubdb_pb2.DestroyBucketEntryRequest(
+            bucket=bucket, cluster=cluster, owner=owner
+        )
+        return await self._call("DestroyBucketEntry", request, timeout, request_id)
+
+    # Reads.
+
+    async def get(self, bucket, cluster="", owner="", timeout=None):
+        """
+        A bucket's ubdb_pb2.BucketEntry. With a cluster or owner, the
+        bucket must also have that cluster or owner.
+        """
+        request = ubdb_pb2.GetBucketEntryRequest(
+            bucket=bucket, cluster=cluster, owner=owner
+        )
+        return (await self._call("GetBucketEntry", request, timeout)).entry
+
+    async def get_many(
+        self, buckets, cluster="", owner="", batch_size=1000, timeout=None
+    ):
+        """
+        Look up many buckets, `batch_size` per call with all the calls in
+        flight at once. Returns a list in the order of `buckets`, of
+        BucketEntry or, for a bucket that couldn't be got, UBNSError.
+        """
+        buckets = list(buckets)
+        requests = []
+        for i in range(0, len(buckets), batch_size):
+            request = ubdb_pb2.GetBucketEntriesRequest()
+            for name in buckets[i : i + batch_size]:
+                request.entries.add(bucket=name, cluster=cluster, owner=owner)
+            requests.append(request)
+        responses = await asyncio.gather(
+            *(self._call("GetBucketEntries", r, timeout) for r in requests)
+        )
+        return [
+            _result_error(result) or result.entry
+            for response in responses
+            for result in response.results
+        ]
+
+    async def batch(self, operations, batch_size=1000, timeout=None):
+        """
+        Apply ubdb_pb2.BucketEntryOperations from an iterable, streaming
+        them `batch_size` to a message. Yields, in order, None for each
+        operation that was applied and UBNSError for each that wasn't.
+        """
+
+        def requests():
+            request = ubdb_pb2.BatchBucketEntriesRequest()
+            for op in operations:
+                request.operations.append(op)
+                if len(request.operations) == batch_size:
+                    yield request
+                    request = ubdb_pb2.BatchBucketEntriesRequest()
+            if request.operations:
+                yield request
+
+        call = next(self._stubs).BatchBucketEntries(
+            requests(), timeout=self._deadline(timeout)
+        )
+        try:
+            async for response in call:
+                for result in response.results:
+                    yield _result_error(result)
+        except grpc.RpcError as e:
+            raise error_from_rpc(e) from None
+        finally:
+            call.cancel()
+
+    async def list_pages(
+        self,
+        cluster="",
+        owner="",
+        state=ubdb_pb2.BucketState.BUCKET_STATE_UNSPECIFIED,
+        page_size=0,
+        page_token="",
+        timeout=None,
+        prefix="",
+        start_at="",
+        end_before="",
+    ):
+        """
+        Yield the ListBucketEntriesResponse pages of a listing, of the names
+        starting with prefix, from start_at and before end_before, those that
+        are set. Stopping early cancels the rest; a page's next_page_token
+        resumes after it, given the same filters.
+        """
+        request = ubdb_pb2.ListBucketEntriesRequest(
+            cluster=cluster,
+            owner=owner,
+            state=state,
+            page_size=page_size,
+            page_token=page_token,
+            prefix=prefix,
+            start_at=start_at,
+            end_before=end_before,
+        )
+        call = next(self._stubs).ListBucketEntries(
+            request, timeout=self._deadline(timeout)
+        )
+        try:
+            async for page in call:
+                yield page
+        except grpc.RpcError as e:
+            raise error_from_rpc(e) from None
+        finally:
+            call.cancel()
+
+    async def watch(self, cluster="", owner="", after_seq=0, timeout=None):
+        """
+        Yield the WatchBucketEntriesResponse messages of a watch: first one
+        with no changes, giving the seq the watch starts after, then the
+        changes as they're made, until the caller stops or a resync message
+        ends it. A message's seq resumes the watch after it.
+        """
+        request = ubdb_pb2.WatchBucketEntriesRequest(
+            cluster=cluster, owner=owner, after_seq=after_seq
+        )
+        call = next(self._stubs).WatchBucketEntries(
+            request, timeout=self._deadline(timeout)
+        )
+        try:
+            async for response in call:
+                yield response
+        except grpc.RpcError as e:
+            raise error_from_rpc(e) from None
+        finally:
+            call.cancel()
+
+    async def reconcile(self, cluster: str, entries, timeout=None):
+        """
+        ubns_reconcile.reconcile() of a cluster's (bucket, owner) pairs,
+        run on a thread while its calls go through this client.
+        """
+        stub = _BlockingStub(self, asyncio.get_running_loop())
+        return await asyncio.to_thread(
+            ubns_reconcile.reconcile, stub, cluster, entries, timeout
+        )
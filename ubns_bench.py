@@ -0,0 +1,2436 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the UBNS server internals.
+
+Usage::
+    ./ubns_bench.py wal [--ops N] [--threads T] [--dir DIR]
+    ./ubns_bench.py stress [--threads T] [--names K] [--seconds S]
+    ./ubns_bench.py conformance [--backend B ...] [--ops N] [--threads T]
+    ./ubns_bench.py backends [--buckets N ...] [--memory-limit MIB] [--backend B ...]
+    ./ubns_bench.py bloom [--buckets N] [--fp-rate F ...] [--creates N]
+    ./ubns_bench.py workers [--workers W ...] [--shards N ...] [--seconds S]
+    ./ubns_bench.py inflight [--concurrency C ...] [--seconds S]
+    ./ubns_bench.py client [--concurrency C ...] [--channels N] [--seconds S]
+    ./ubns_bench.py processes [--workers N ...] [--clients K] [--seconds S]
+    ./ubns_bench.py logging [--mode M ...] [--threads T] [--seconds S]
+    ./ubns_bench.py metrics [--threads T ...] [--seconds S]
+    ./ubns_bench.py profile [--threads T ...] [--seconds S]
+    ./ubns_bench.py capture [--threads T ...] [--seconds S] [--dir DIR]
+    ./ubns_bench.py watch [--watchers N ...] [--slow N] [--buffer N] [--seconds S]
+    ./ubns_bench.py memory [--buckets N ...] [--clusters C] [--owners O]
+    ./ubns_bench.py reconcile [--buckets N] [--divergence F ...]
+    ./ubns_bench.py list [--buckets N] [--clusters C] [--owners O]
+    ./ubns_bench.py names [--names N ...] [--queries Q] [--page N]
+    ./ubns_bench.py reads [--read-fraction F ...] [--threads T ...] [--seconds S]
+    ./ubns_bench.py overload [--rate R ...] [--deadline D] [--max-concurrent-rpcs N]
+    ./ubns_bench.py fairness [--mode M ...] [--polite N] [--polite-rate R] [--aggressor C]
+    ./ubns_bench.py startup [--buckets N ...] [--format F ...]
+    ./ubns_bench.py tombstones [--retention SECS ...] [--threads T] [--seconds S]
+"""
+
+import argparse
+from array import array
+import asyncio
+from collections import Counter
+from concurrent import futures
+import errno
+import grpc
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ubdb.v1 import ubdb_pb2_grpc
+from ubdb.v1 import ubdb_pb2
+from ubns_aioclient import UBNSClient
+from ubns_capture import Capture, CaptureInterceptor, TraceReader
+from ubns_dedup import REQUEST_ID_METADATA, RequestCache
+from ubns_log import AccessLog, setup_logging
+from ubns_metrics import MetricsInterceptor, MetricsRegistry
+from ubns_profile import Profiler, ProfilingInterceptor
+from ubns_reconcile import LEAVES, entry_hash, leaf_of, reconcile
+from ubns_server import (
+    Bucket,
+    BucketAlreadyExistsError,
+    BucketNameDatabase,
+    BucketNotFoundError,
+    BucketRecentlyDeletedError,
+    BucketState,
+    InvalidStateTransitionError,
+    MismatchedClusterError,
+    MismatchedOwnerError,
+    SQLiteBucketDatabase,
+    UBDBServer,
+    _UPDATE_STATES,
+    _batch_path,
+    _check_transition,
+    _list_bounds,
+    build_server,
+)
+from ubns_bloom import CountingBloomFilter
+from ubns_index import SortedNames, prefix_end
+import ubns_snapshot
+from ubns_sqlite import BucketTable
+from ubns_wal import JSON_SNAPSHOT_NAME, SNAPSHOT_NAME, SyncMode, WriteAheadLog
+from ubns_watch import ChangeFeed
+
+
+def bench_wal(args):
+    """
+    Mutations/sec through BucketNameDatabase.add_bucket with the log in each
+    sync mode, driven from a thread pool the same size as the server's.
+    """
+    print(f"{'mode':<8} {'threads':>7} {'ops':>8} {'secs':>8} {'ops/sec':>10}")
+    for mode in (SyncMode.NONE, SyncMode.GROUP, SyncMode.PER_OP):
+        for threads in args.threads:
+            data_dir = tempfile.mkdtemp(prefix="ubns-bench-", dir=args.dir)
+            try:
+                wal = WriteAheadLog(data_dir, mode)
+                db = BucketNameDatabase(wal)
+                ops = args.ops if mode != SyncMode.PER_OP else args.ops // 10
+                per_thread = ops // threads
+
+                def worker(t):
+                    for i in range(per_thread):
+                        db.add_bucket(f"bucket-{t}-{i}", "cluster", "owner")
+
+                start = time.perf_counter()
+                with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+                    list(pool.map(worker, range(threads)))
+                elapsed = time.perf_counter() - start
+                wal.close()
+                done = per_thread * threads
+                print(
+                    f"{mode.value:<8} {threads:>7} {done:>8} {elapsed:>8.2f} {done / elapsed:>10.0f}"
+                )
+            finally:
+                shutil.rmtree(data_dir)
+
+
+def _stress_workers(db, names, threads, seconds):
+    """
+    Run random lifecycle steps on `names` from `threads` threads for
+    `seconds`, with snapshots being taken and tombstones purged meanwhile.
+    Returns how many more times each name was added than removed, the
+    number of steps run and the sequence number tombstones were purged up to.
+    """
+    deadline = time.monotonic() + seconds
+    steps = [
+        lambda n: db.add_bucket(n, "cluster", "owner"),
+        lambda n: db.update_bucket(n, "cluster", "owner", BucketState.CREATED),
+        lambda n: db.update_bucket(n, "cluster", "owner", BucketState.DELETING),
+        lambda n: db.delete_bucket(n, "cluster", "owner"),
+        lambda n: db.create_bucket(n, "cluster", "owner"),
+        lambda n: db.destroy_bucket(n, "cluster", "owner"),
+    ]
+    # Indexes into steps of those that add or remove a bucket.
+    adds, deletes = (0, 4), (3, 5)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        net, ops = Counter(), 0
+        while time.monotonic() < deadline:
+            name = rng.choice(names)
+            step = rng.randrange(len(steps))
+            try:
+                steps[step](name)
+            except Exception:
+                pass
+            else:
+                if step in adds:
+                    net[name] += 1
+                elif step in deletes:
+                    net[name] -= 1
+            ops += 1
+        return net, ops
+
+    def checkpointer():
+        upto = 0
+        while time.monotonic() < deadline - seconds / 10:
+            time.sleep(seconds / 5)
+            db.purge_tombstones(upto)
+            upto = db.seq
+            db.checkpoint()
+        return upto
+
+    with futures.ThreadPoolExecutor(max_workers=threads + 1) as pool:
+        snapshots = pool.submit(checkpointer)
+        results = list(pool.map(worker, range(threads)))
+        purged = snapshots.result()
+    net, ops = Counter(), 0
+    for n, o in results:
+        net.update(n)
+        ops += o
+    return net, ops, purged
+
+
+def _stress_check(db, replayed, names, existed, net, purged) -> int:
+    """
+    Check a table after _stress_workers() against the net adds it returned
+    and the names that `existed` before, and a replay of its log against
+    it. Returns the number of failures, having printed them.
+    """
+    failures = 0
+    for name in names:
+        exists = db.get_bucket(name) is not None
+        if net[name] != int(exists) - int(name in existed):
+            print(
+                f"FAIL {name}: {net[name]} net adds, existed={name in existed} exists={exists}"
+            )
+            failures += 1
+
+    live = {(name, state) for name, _, _, state in _list_all(db)}
+    if {name for name, _ in live} != {n for n in names if db.get_bucket(n)}:
+        print("FAIL listing doesn't match lookups")
+        failures += 1
+    recovered = {(name, state) for name, _, _, state in _list_all(replayed)}
+    if live != recovered:
+        print(f"FAIL log replay: {len(live ^ recovered)} entries differ")
+        failures += 1
+
+    expected = [0] * LEAVES
+    for name, _ in live:
+        expected[leaf_of(name)] ^= entry_hash(name, "owner")
+    for label, table in (("live", db), ("replayed", replayed)):
+        if table.cluster_digests("cluster") != expected:
+            print(f"FAIL reconcile digests of the {label} table are wrong")
+            failures += 1
+        leaves = table.cluster_leaf_entries("cluster", range(LEAVES))
+        if {name for entries in leaves.values() for name, _ in entries} != {
+            name for name, _ in live
+        }:
+            print(f"FAIL reconcile entries of the {label} table are wrong")
+            failures += 1
+
+    # Purges aren't logged, so a replay can bring back purged tombstones.
+    tombstones = set(db.list_tombstones(limit=len(names)))
+    replayed_tombstones = set(replayed.list_tombstones(limit=len(names)))
+    if {name for name, _, _ in tombstones} & {name for name, _ in live}:
+        print("FAIL live buckets have tombstones")
+        failures += 1
+    if not tombstones <= replayed_tombstones or any(
+        seq > purged for _, _, seq in replayed_tombstones - tombstones
+    ):
+        print(
+            f"FAIL tombstone replay: {len(tombstones ^ replayed_tombstones)} differ"
+        )
+        failures += 1
+
+    counted = Counter(state for _, state in live)
+    counted[BucketState.DELETED] = len(tombstones)
+    for state, n in db.state_counts().items():
+        if counted[state] != n:
+            print(f"FAIL state count {state.name}: {n}, table has {counted[state]}")
+            failures += 1
+        if state == BucketState.DELETED:
+            continue
+        listed = {name for name, _, _, _ in _list_all(db, state=state)}
+        if listed != {name for name, s in live if s == state}:
+            print(f"FAIL {state.name} listing doesn't match the table")
+            failures += 1
+    return failures
+
+
+def bench_stress(args):
+    """
+    Hammer a small set of names from many threads with every lifecycle step
+    and check that the outcome is consistent with some serial order: each
+    name's successful adds minus successful deletes must equal whether it
+    still exists, replaying the snapshot and log must reproduce the final
+    table and its tombstones, and the listings, per-state bucket counts and
+    reconciliation digests must match the table. It runs twice: from an empty table, and
+    then from that table reopened, so mostly in its snapshot.
+    """
+    names = [f"bucket-{i}" for i in range(args.names)]
+    data_dir = tempfile.mkdtemp(prefix="ubns-stress-", dir=args.dir)
+    failures = ops = 0
+    try:
+        wal = WriteAheadLog(data_dir, SyncMode.NONE)
+        db = BucketNameDatabase(wal, args.shards)
+        existed = set()
+        for _ in range(2):
+            net, n, purged = _stress_workers(
+                db, names, args.threads, args.seconds / 2
+            )
+            ops += n
+            wal.close()
+            wal = WriteAheadLog(data_dir, SyncMode.NONE)
+            replayed = BucketNameDatabase(wal, args.shards)
+            failures += _stress_check(db, replayed, names, existed, net, purged)
+            existed = {name for name in names if db.get_bucket(name)}
+            db = replayed
+        wal.close()
+    finally:
+        shutil.rmtree(data_dir)
+
+    print(
+        f"{ops} ops from {args.threads} threads over {args.names} names: "
+        + ("PASS" if failures == 0 else f"{failures} FAILURES")
+    )
+    if failures:
+        sys.exit(1)
+
+
+# Each step of the scripted conformance check: an operation as for
+# apply_batch(), and the error it should fail with, or None.
+_CONFORMANCE_SCRIPT = [
+    (("add", "a", "c1", "o1"), None),
+    (("add", "a", "c1", "o1"), BucketAlreadyExistsError),
+    (("update", "a", "c2", "o1", BucketState.CREATED), MismatchedClusterError),
+    (("update", "a", "c1", "o2", BucketState.CREATED), MismatchedOwnerError),
+    (("update", "a", "c1", "o1", BucketState.DELETING), InvalidStateTransitionError),
+    (("delete", "a", "c1", "o1"), InvalidStateTransitionError),
+    (("update", "a", "c1", "o1", BucketState.CREATED), None),
+    (("update", "a", "c1", "o1", BucketState.CREATED), InvalidStateTransitionError),
+    (("create", "b", "c1", "o2"), None),
+    (("create", "c", "c2", "o1"), None),
+    (("destroy", "nope", "c1", "o1"), BucketNotFoundError),
+    (("destroy", "b", "c1", "o2"), None),
+    (("destroy", "b", "c1", "o2"), BucketNotFoundError),
+    (("create", "b", "c2", "o2"), BucketRecentlyDeletedError),
+    (("add", "b", "c2", "o2"), BucketRecentlyDeletedError),
+    (("create", "b", "c1", "o3"), None),
+    (("update", "c", "c2", "o1", BucketState.DELETING), None),
+    (("delete", "c", "c2", "o1"), None),
+    (("add", "c", "c2", "o1"), None),
+    (("destroy", "c", "c2", "o1"), InvalidStateTransitionError),
+    (("add", "d", "c3", "o3"), None),
+    (("update", "d", "c3", "o3", BucketState.CREATED), None),
+    (("update", "d", "c3", "o3", BucketState.DELETING), None),
+    (("delete", "d", "c3", "o3"), None),
+]
+
+
+class _ConformanceModel:
+    """The table every backend should end up with, kept the obvious way."""
+
+    def __init__(self):
+        self.buckets: dict[str, tuple[str, str, BucketState]] = {}
+        self.tombstones: dict[str, tuple[int, str]] = {}
+        self.seq = 0
+
+    def apply(self, op) -> Exception:
+        name, cluster, owner = op[1:4]
+        found = self.buckets.get(name)
+        bucket = None
+        if found is not None:
+            bucket = Bucket(name, found[0], found[1])
+            bucket.state = found[2]
+        try:
+            state = _check_transition(
+                bucket, name, cluster, owner, _batch_path(op), self.tombstones.get
+            )
+        except Exception as e:
+            return e
+        self.seq += 1
+        if state == BucketState.NONE:
+            del self.buckets[name]
+            self.tombstones[name] = (self.seq, cluster)
+        else:
+            self.tombstones.pop(name, None)
+            self.buckets[name] = (cluster, owner, state)
+        return None
+
+
+def _conformance_apply(db, op) -> Exception:
+    """Apply one operation through the method for it."""
+    try:
+        if op[0] == "update":
+            db.update_bucket(*op[1:])
+        else:
+            getattr(db, f"{op[0]}_bucket")(*op[1:])
+    except Exception as e:
+        return e
+    return None
+
+
+def _conformance_pages(list_page) -> list[tuple]:
+    """Everything list_page(after, limit) lists, a few entries at a time."""
+    entries, after = [], ""
+    while True:
+        page = list_page(after, 7)
+        if not page:
+            return entries
+        entries.extend(page)
+        after = page[-1][0]
+
+
+def _conformance_compare(db, model, names, clusters, owners) -> list[str]:
+    """How the table differs from the model, as failure messages."""
+    failures = []
+    expected = sorted((n, c, o, s) for n, (c, o, s) in model.buckets.items())
+    for name in names:
+        b = db.get_bucket(name)
+        got = None if b is None else (b.cluster, b.owner, b.state)
+        if got != model.buckets.get(name):
+            failures.append(f"get {name}: {got}, expected {model.buckets.get(name)}")
+    for cluster, owner, state in itertools.product(
+        [None] + clusters, [None] + owners, [None] + list(_UPDATE_STATES)
+    ):
+        listed = _conformance_pages(
+            lambda after, limit: db.list_buckets(cluster, owner, state, after, limit)
+        )
+        wanted = [
+            e
+            for e in expected
+            if (not cluster or e[1] == cluster)
+            and (not owner or e[2] == owner)
+            and (state is None or e[3] == state)
+        ]
+        if listed != wanted:
+            failures.append(f"list cluster={cluster} owner={owner} state={state}")
+    for cluster in [None] + clusters:
+        tombstones = _conformance_pages(
+            lambda after, limit: db.list_tombstones(cluster, after, limit)
+        )
+        wanted = sorted(
+            (n, c, seq)
+            for n, (seq, c) in model.tombstones.items()
+            if not cluster or c == cluster
+        )
+        if tombstones != wanted:
+            failures.append(
+                f"tombstones cluster={cluster}: {len(tombstones)} listed, "
+                f"{len(wanted)} expected, {len(set(tombstones) ^ set(wanted))} differ"
+            )
+    counts = Counter(s for _, _, s in model.buckets.values())
+    counts[BucketState.DELETED] = len(model.tombstones)
+    got = db.state_counts()
+    if any(got[state] != counts[state] for state in BucketState):
+        failures.append(f"state counts {got}")
+    if len(db) != len(model.buckets):
+        failures.append(f"len {len(db)}, expected {len(model.buckets)}")
+    for cluster in clusters:
+        digests = [0] * LEAVES
+        leaves = {}
+        for n, (c, o, _) in model.buckets.items():
+            if c == cluster:
+                digests[leaf_of(n)] ^= entry_hash(n, o)
+                leaves.setdefault(leaf_of(n), set()).add((n, o))
+        if db.cluster_digests(cluster) != digests:
+            failures.append(f"digests of {cluster}")
+        got = db.cluster_leaf_entries(cluster, range(LEAVES))
+        if {i: set(e) for i, e in got.items() if e} != leaves:
+            failures.append(f"leaf entries of {cluster}")
+    return failures
+
+
+def _conformance_backends(data_dir):
+    """(name, open) for each backend, where open() (re)opens its table."""
+    memory_dir = os.path.join(data_dir, "memory")
+    sqlite_dir = os.path.join(data_dir, "sqlite")
+    return [
+        (
+            "memory",
+            lambda: BucketNameDatabase(WriteAheadLog(memory_dir, SyncMode.NONE)),
+        ),
+        (
+            "sqlite",
+            lambda: SQLiteBucketDatabase(BucketTable(sqlite_dir, SyncMode.NONE)),
+        ),
+    ]
+
+
+def _conformance_check(name, open_db, seed, ops, threads) -> int:
+    """Run the conformance checks on one backend. Returns the failure count."""
+    failures = []
+    db = open_db()
+    model = _ConformanceModel()
+
+    # The script, each step through its own method.
+    for i, (op, error) in enumerate(_CONFORMANCE_SCRIPT):
+        got = _conformance_apply(db, op)
+        model.apply(op)
+        if type(got) is not (error or type(None)):
+            failures.append(f"script step {i} {op}: {got!r}, expected {error}")
+    clusters, owners = ["c1", "c2", "c3"], ["o1", "o2", "o3"]
+    names = [f"n{i:03d}" for i in range(100)] + list("abcd")
+    failures += _conformance_compare(db, model, names, clusters, owners)
+
+    # Random operations, singly and in batches, against the model.
+    rng = random.Random(seed)
+    kinds = ["add", "create", "update", "update", "delete", "destroy"]
+    done = 0
+    while done < ops:
+        batch = []
+        for _ in range(rng.choice((1, 1, 1, 5))):
+            kind, bucket = rng.choice(kinds), rng.choice(names)
+            cluster, owner = rng.choice(clusters), rng.choice(owners)
+            # Mostly the bucket's own cluster and owner, so that most
+            # operations get as far as the state checks.
+            if rng.random() < 0.8:
+                if bucket in model.buckets:
+                    cluster, owner, _ = model.buckets[bucket]
+                elif bucket in model.tombstones:
+                    cluster = model.tombstones[bucket][1]
+            op = (kind, bucket, cluster, owner)
+            if kind == "update":
+                op += (rng.choice(_UPDATE_STATES),)
+            batch.append(op)
+        if len(batch) == 1:
+            got = [_conformance_apply(db, batch[0])]
+        else:
+            got = db.apply_batch(batch)
+        for op, result in zip(batch, got):
+            wanted = model.apply(op)
+            if type(result) is not type(wanted):
+                failures.append(f"random {op}: {result!r}, expected {wanted!r}")
+        done += len(batch)
+    failures += _conformance_compare(db, model, names, clusters, owners)
+
+    # Reopened, it should be the same table.
+    db.close()
+    db = open_db()
+    failures += [f"reopened: {f}" for f in _conformance_compare(
+        db, model, names, clusters, owners
+    )]
+
+    # Purged tombstones are gone, and their names free for any cluster.
+    purged = db.purge_tombstones(db.seq)
+    if purged != len(model.tombstones) or db.list_tombstones():
+        failures.append(f"purged {purged} of {len(model.tombstones)} tombstones")
+    model.tombstones.clear()
+
+    # Concurrent lifecycles on disjoint names: every one should succeed.
+    def worker(t):
+        errors = []
+        for i in range(ops // threads // 4):
+            bucket = f"t{t}-{i}"
+            for step in (
+                ("add", bucket, "c1", "o1"),
+                ("update", bucket, "c1", "o1", BucketState.CREATED),
+                ("update", bucket, "c1", "o1", BucketState.DELETING),
+                ("delete", bucket, "c1", "o1"),
+            ):
+                errors.append(_conformance_apply(db, step))
+        return [e for e in errors if e is not None]
+
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for errors in pool.map(worker, range(threads)):
+            failures += [f"concurrent: {e!r}" for e in errors]
+
+    failures += _conformance_storage_failure(db)
+    db.close()
+
+    for f in failures:
+        print(f"FAIL {name}: {f}")
+    return len(failures)
+
+
+def _fail_storage(db, error):
+    """Make db's log or store fail every write with error, or stop (None)."""
+    if isinstance(db, SQLiteBucketDatabase):
+        db.table._error = error
+    else:
+        db.wal._error = error
+
+
+def _conformance_storage_failure(db) -> list[str]:
+    """
+    An add refused because the log or store has failed changes nothing and
+    isn't seen by watchers, and a retry with the same request ID once it
+    works again is run again, not given the failure.
+    """
+    failures = []
+    db.changes = ChangeFeed(16, db.seq)
+    servicer = UBDBServer(db, request_cache=RequestCache())
+    request = ubdb_pb2.AddBucketEntryRequest(
+        bucket="retried", cluster="c1", owner="o1"
+    )
+    seq = db.seq
+    _fail_storage(db, OSError(errno.EIO, "injected"))
+    try:
+        context = _RequestIdContext("retry-1")
+        servicer.AddBucketEntry(request, context)
+        if context.code() != grpc.StatusCode.UNAVAILABLE:
+            failures.append(
+                f"storage failure: got {context.code()}, expected UNAVAILABLE"
+            )
+        if db.get_bucket("retried") is not None or db.seq != seq:
+            failures.append("storage failure: the refused add was applied")
+        if db.changes.seq != seq:
+            failures.append("storage failure: the refused add was published")
+    finally:
+        _fail_storage(db, None)
+    context = _RequestIdContext("retry-1")
+    servicer.AddBucketEntry(request, context)
+    if context.code() is not None:
+        failures.append(f"retry after storage failure: got {context.code()}")
+    if db.get_bucket("retried") is None or db.changes.seq != db.seq:
+        failures.append("retry after storage failure: bucket not added")
+    db.changes = None
+    return failures
+
+
+def bench_conformance(args):
+    """
+    Check that each storage backend behaves the same: a script of lifecycle
+    steps with the errors they should raise, then random operations singly
+    and in batches against a simple model of the table, comparing lookups,
+    every combination of listing filters, tombstones, state counts and
+    reconciliation digests, again after reopening the table. Then a purge,
+    concurrent mutations from several threads, and a retry after a failure
+    to write, which must not reach watchers.
+    """
+    failures = 0
+    data_dir = tempfile.mkdtemp(prefix="ubns-conformance-", dir=args.dir)
+    try:
+        for name, open_db in _conformance_backends(data_dir):
+            if name not in args.backend:
+                continue
+            n = _conformance_check(name, open_db, args.seed, args.ops, args.threads)
+            print(f"{name}: " + ("PASS" if n == 0 else f"{n} FAILURES"))
+            failures += n
+    finally:
+        shutil.rmtree(data_dir)
+    if failures:
+        sys.exit(1)
+
+
+def _backends_child(backend, data_dir, buckets, seconds, threads, sync, memory_limit):
+    """
+    Fill a table on one backend in a fresh process, in batches of creates,
+    then time lookups and lifecycle churn on it. With memory_limit, the
+    process's address space is capped at that many bytes first, to stand
+    in for a table larger than RAM. Returns a dict of results.
+    """
+    logging.basicConfig(level=logging.CRITICAL)
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        # Thread stacks count against the cap at their full reserved size.
+        threading.stack_size(1 << 20)
+    if backend == "sqlite":
+        db = SQLiteBucketDatabase(BucketTable(data_dir, SyncMode(sync)))
+    else:
+        db = BucketNameDatabase(WriteAheadLog(data_dir, SyncMode(sync)))
+    result = {"filled": 0, "oom": False}
+    before = _rss_bytes()
+    start = time.perf_counter()
+    try:
+        for first in range(0, buckets, 1000):
+            db.apply_batch(
+                [
+                    ("create", f"bucket-{i:010d}", f"cluster-{i % 8}", f"owner-{i % 1000}")
+                    for i in range(first, min(first + 1000, buckets))
+                ]
+            )
+            result["filled"] = min(first + 1000, buckets)
+    except MemoryError:
+        result["oom"] = True
+        return result
+    result["fill_secs"] = time.perf_counter() - start
+    result["rss"] = _rss_bytes() - before
+    result["disk"] = sum(
+        os.path.getsize(os.path.join(data_dir, f)) for f in os.listdir(data_dir)
+    )
+
+    rng = random.Random(0)
+    deadline = time.monotonic() + seconds
+    lookups = 0
+    while time.monotonic() < deadline:
+        db.get_bucket(f"bucket-{rng.randrange(buckets):010d}")
+        lookups += 1
+    result["lookups"] = lookups / seconds
+
+    deadline = time.monotonic() + seconds
+
+    def worker(t):
+        ops = 0
+        while time.monotonic() < deadline:
+            name = f"churn-{t}-{ops}"
+            db.add_bucket(name, "cluster-0", "owner-0")
+            db.update_bucket(name, "cluster-0", "owner-0", BucketState.CREATED)
+            db.update_bucket(name, "cluster-0", "owner-0", BucketState.DELETING)
+            db.delete_bucket(name, "cluster-0", "owner-0")
+            ops += 4
+        return ops
+
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        result["churn"] = sum(pool.map(worker, range(threads))) / seconds
+    db.close()
+    return result
+
+
+def bench_backends(args):
+    """
+    Each storage backend filled with --buckets buckets, each in a fresh
+    process: fill rate, resident memory and disk used, then random lookups
+    from one thread and add/update/update/delete churn from --threads.
+    --memory-limit caps each process's address space, so that a table can
+    be larger than the "RAM" it has without needing one that big.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    limit = args.memory_limit * 2**20 if args.memory_limit else None
+    print(
+        f"{'backend':<8} {'buckets':>9} {'fill/s':>8} {'RSS MiB':>8} {'disk MiB':>8} {'lookups/s':>9} {'churn/s':>8}"
+    )
+    for buckets in args.buckets:
+        for backend in args.backend:
+            data_dir = tempfile.mkdtemp(prefix="ubns-backends-", dir=args.dir)
+            try:
+                with ctx.Pool(1) as pool:
+                    r = pool.apply(
+                        _backends_child,
+                        (
+                            backend,
+                            data_dir,
+                            buckets,
+                            args.seconds,
+                            args.threads,
+                            args.wal_sync,
+                            limit,
+                        ),
+                    )
+            finally:
+                shutil.rmtree(data_dir)
+            if r["oom"]:
+                print(f"{backend:<8} {buckets:>9} out of memory after {r['filled']}")
+                continue
+            print(
+                f"{backend:<8} {buckets:>9} {buckets / r['fill_secs']:>8.0f} {r['rss'] / 2**20:>8.0f} "
+                f"{r['disk'] / 2**20:>8.0f} {r['lookups']:>9.0f} {r['churn']:>8.0f}"
+            )
+
+
+def bench_bloom(args):
+    """
+    The Bloom filter on its own: its false-positive rate against names it
+    doesn't hold, and its size per million names. Then creates of new names
+    on a SQLite table of --buckets, one at a time without fsyncs, with and
+    without the filter in front of the lookups they make.
+    """
+    names = [f"bucket-{i:010d}" for i in range(args.buckets)]
+    print(f"{'fp rate':>8} {'hashes':>6} {'measured':>9} {'MiB/M names':>11} {'add us':>7} {'probe us':>8}")
+    for fp_rate in args.fp_rate:
+        bloom = CountingBloomFilter(args.buckets, fp_rate)
+        start = time.perf_counter()
+        for name in names:
+            bloom.add(name)
+        added = time.perf_counter() - start
+        start = time.perf_counter()
+        positives = sum(f"absent-{i:010d}" in bloom for i in range(args.probes))
+        probed = time.perf_counter() - start
+        print(
+            f"{fp_rate:>8} {bloom.hashes:>6} {positives / args.probes:>9.4f} "
+            f"{bloom.slots / args.buckets:>11.2f} {added / args.buckets * 1e6:>7.2f} "
+            f"{probed / args.probes * 1e6:>8.2f}"
+        )
+
+    data_dir = tempfile.mkdtemp(prefix="ubns-bloom-", dir=args.dir)
+    try:
+        db = SQLiteBucketDatabase(BucketTable(data_dir, SyncMode.NONE, bloom_fp_rate=0))
+        for first in range(0, args.buckets, 1000):
+            db.apply_batch(
+                [("create", name, "cluster", "owner") for name in names[first : first + 1000]]
+            )
+        db.close()
+        print(f"{'filter':<7} {'creates/s':>9} {'p50 us':>7} {'p99 us':>7} {'negatives':>9} {'false +':>7}")
+        # Alternate, as the table grows and the page cache warms as we go.
+        for run, (label, fp_rate) in enumerate(
+            [("off", 0), ("on", 0.01)] * args.rounds
+        ):
+            table = BucketTable(data_dir, SyncMode.NONE, args.cache_mb, fp_rate)
+            db = SQLiteBucketDatabase(table)
+            latencies = []
+            for i in range(args.creates):
+                name = f"new-{run}-{i:010d}"
+                start = time.perf_counter()
+                db.create_bucket(name, "cluster", "owner")
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            print(
+                f"{label:<7} {len(latencies) / sum(latencies):>9.0f} "
+                f"{_percentile(latencies, 0.5) * 1e6:>7.1f} {_percentile(latencies, 0.99) * 1e6:>7.1f} "
+                f"{table.bloom_negatives:>9} {table.bloom_false_positives:>7}"
+            )
+            db.close()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def bench_workers(args):
+    """
+    End-to-end AddBucketEntry throughput against an in-process server, as a
+    function of the handler thread count and the number of shards.
+    """
+    print(f"{'shards':>6} {'workers':>7} {'rpcs':>8} {'rpcs/sec':>10}")
+    for shards in args.shards:
+        for workers in args.workers:
+            db = BucketNameDatabase(None, shards)
+            server = build_server(db, workers)
+            port = server.add_insecure_port("127.0.0.1:0")
+            server.start()
+            # Enough clients to keep every handler thread busy.
+            clients = workers * 2
+            channels = [
+                grpc.insecure_channel(f"127.0.0.1:{port}") for _ in range(clients)
+            ]
+            deadline = time.monotonic() + args.seconds
+
+            def client(c):
+                stub = ubdb_pb2_grpc.UBDBServiceStub(channels[c])
+                n = 0
+                while time.monotonic() < deadline:
+                    req = ubdb_pb2.AddBucketEntryRequest(
+                        bucket=f"bucket-{c}-{n}", cluster="cluster", owner="owner"
+                    )
+                    stub.AddBucketEntry(req)
+                    n += 1
+                return n
+
+            with futures.ThreadPoolExecutor(max_workers=clients) as pool:
+                total = sum(pool.map(client, range(clients)))
+            for channel in channels:
+                channel.close()
+            server.stop(None)
+            print(f"{shards:>6} {workers:>7} {total:>8} {total / args.seconds:>10.0f}")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(extra_args=(), nice=0):
+    """
+    Start ubns_server.py in a subprocess, so that it doesn't share a GIL
+    with the load generator, `nice` lower in priority. Returns (process,
+    address) once it's serving.
+    """
+    port = _free_port()
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ubns_server.py")
+    proc = subprocess.Popen(
+        [sys.executable, server, "127.0.0.1", str(port), *extra_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        preexec_fn=(lambda: os.nice(nice)) if nice else None,
+    )
+    address = f"127.0.0.1:{port}"
+    with grpc.insecure_channel(address) as channel:
+        grpc.channel_ready_future(channel).result(timeout=30)
+    return proc, address
+
+
+def stop_server(proc):
+    proc.terminate()
+    proc.wait()
+
+
+async def _drive_inflight(address, concurrency, seconds, channels):
+    """
+    Keep `concurrency` AddBucketEntry calls in flight for `seconds`, spread
+    over `channels` connections. Returns (completed, sorted latencies).
+    """
+    chans = [grpc.aio.insecure_channel(address) for _ in range(channels)]
+    stubs = [ubdb_pb2_grpc.UBDBServiceStub(c) for c in chans]
+    latencies = []
+    deadline = time.monotonic() + seconds
+
+    async def caller(c):
+        stub = stubs[c % len(stubs)]
+        n = 0
+        while time.monotonic() < deadline:
+            req = ubdb_pb2.AddBucketEntryRequest(
+                bucket=f"bucket-{concurrency}-{c}-{n}",
+                cluster="cluster",
+                owner="owner",
+            )
+            start = time.perf_counter()
+            await stub.AddBucketEntry(req)
+            latencies.append(time.perf_counter() - start)
+            n += 1
+
+    await asyncio.gather(*(caller(c) for c in range(concurrency)))
+    for c in chans:
+        await c.close()
+    return sorted(latencies)
+
+
+def bench_inflight(args):
+    """
+    Throughput and latency with many RPCs in flight at once, against the
+    thread-pool server and the asyncio server.
+    """
+    print(
+        f"{'mode':<6} {'inflight':>8} {'rpcs/sec':>10} {'p50 ms':>8} {'p99 ms':>8}"
+    )
+    for mode in args.mode:
+        proc, address = spawn_server(["--async"] if mode == "async" else [])
+        try:
+            for concurrency in args.concurrency:
+                latencies = asyncio.run(
+                    _drive_inflight(address, concurrency, args.seconds, args.channels)
+                )
+                n = len(latencies)
+                p50 = latencies[n // 2] * 1000
+                p99 = latencies[min(n - 1, n * 99 // 100)] * 1000
+                print(
+                    f"{mode:<6} {concurrency:>8} {n / args.seconds:>10.0f} {p50:>8.2f} {p99:>8.2f}"
+                )
+        finally:
+            stop_server(proc)
+
+
+def _per_call_channels(address, seconds):
+    """AddBucketEntry one call at a time, each on a new channel, as the CLI was."""
+    n = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        with grpc.insecure_channel(address) as channel:
+            ubdb_pb2_grpc.UBDBServiceStub(channel).AddBucketEntry(
+                ubdb_pb2.AddBucketEntryRequest(
+                    bucket=f"per-call-{n}", cluster="cluster", owner="owner"
+                )
+            )
+        n += 1
+    return n
+
+
+async def _client_calls(address, concurrency, channels, seconds):
+    """AddBucketEntry through one UBNSClient, `concurrency` calls in flight."""
+    deadline = time.monotonic() + seconds
+
+    async def caller(c):
+        n = 0
+        while time.monotonic() < deadline:
+            await client.add(f"client-{concurrency}-{c}-{n}", "cluster", "owner")
+            n += 1
+        return n
+
+    async with UBNSClient(address, channels) as client:
+        return sum(await asyncio.gather(*(caller(c) for c in range(concurrency))))
+
+
+def bench_client(args):
+    """
+    AddBucketEntry throughput with a channel per call, as ubns_client.py
+    used to make, against the ubns_aioclient library with a few long-lived
+    channels and many calls in flight.
+    """
+    proc, address = spawn_server()
+    try:
+        print(f"{'client':<9} {'inflight':>8} {'rpcs/sec':>10}")
+        n = _per_call_channels(address, args.seconds)
+        print(f"{'per-call':<9} {1:>8} {n / args.seconds:>10.0f}")
+        for concurrency in args.concurrency:
+            n = asyncio.run(
+                _client_calls(address, concurrency, args.channels, args.seconds)
+            )
+            print(f"{'aioclient':<9} {concurrency:>8} {n / args.seconds:>10.0f}")
+    finally:
+        stop_server(proc)
+
+
+def _process_client(address, prefix, seconds, threads):
+    """Load generator process: `threads` blocking callers on one channel each."""
+    deadline = time.monotonic() + seconds
+
+    def caller(t):
+        with grpc.insecure_channel(address) as channel:
+            stub = ubdb_pb2_grpc.UBDBServiceStub(channel)
+            n = 0
+            while time.monotonic() < deadline:
+                req = ubdb_pb2.AddBucketEntryRequest(
+                    bucket=f"bucket-{prefix}-{t}-{n}", cluster="cluster", owner="owner"
+                )
+                stub.AddBucketEntry(req)
+                n += 1
+            return n
+
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(pool.map(caller, range(threads)))
+
+
+def bench_processes(args):
+    """
+    RPC throughput against `ubns_server.py --workers N`. Load comes from
+    several client processes so the client side isn't GIL-bound either; each
+    opens its own connections, which SO_REUSEPORT spreads across workers.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'workers':>7} {'rpcs':>8} {'rpcs/sec':>10} {'speedup':>8}")
+    base = None
+    for workers in args.workers:
+        proc, address = spawn_server(["--workers", str(workers)])
+        try:
+            with ctx.Pool(args.clients) as pool:
+                counts = pool.starmap(
+                    _process_client,
+                    [
+                        (address, c, args.seconds, args.threads)
+                        for c in range(args.clients)
+                    ],
+                )
+        finally:
+            stop_server(proc)
+        rate = sum(counts) / args.seconds
+        base = base or rate
+        print(f"{workers:>7} {sum(counts):>8} {rate:>10.0f} {rate / base:>8.2f}")
+
+
+class _NullContext:
+    """Just enough of a grpc.ServicerContext to call a handler directly."""
+
+    def set_code(self, code):
+        pass
+
+    def set_details(self, details):
+        pass
+
+    def code(self):
+        return None
+
+    def invocation_metadata(self):
+        return ()
+
+    def time_remaining(self):
+        return None
+
+
+class _RequestIdContext(_NullContext):
+    """A _NullContext for a call with a request ID, keeping its status code."""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self._code = None
+
+    def set_code(self, code):
+        self._code = code
+
+    def code(self):
+        return self._code
+
+    def invocation_metadata(self):
+        return ((REQUEST_ID_METADATA, self.request_id),)
+
+
+class _SlowSink:
+    """A log destination that takes `latency` seconds per write."""
+
+    def __init__(self, stream, latency):
+        self.stream = stream
+        self.latency = latency
+
+    def write(self, data):
+        time.sleep(self.latency)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+# name: (handler, level, access log sample rate)
+LOGGING_MODES = {
+    "off": (None, logging.CRITICAL, 1.0),
+    "sync": ("stream", logging.INFO, 1.0),
+    "queue": ("queue", logging.INFO, 1.0),
+    "sampled": ("queue", logging.INFO, 0.01),
+}
+
+
+def bench_logging(args):
+    """
+    Per-RPC cost of request logging, calling the servicer directly so gRPC
+    itself isn't in the measurement. Log output goes to /dev/null, which
+    flatters the synchronous handler; --sink-latency makes every write take
+    that long, like a slow terminal or disk would. One in ten requests is a
+    duplicate, to exercise the failure path.
+    """
+    print(f"{'mode':<8} {'threads':>7} {'rpcs/sec':>10} {'us/rpc':>8}")
+    for mode in args.mode:
+        handler, level, sample = LOGGING_MODES[mode]
+        with open(os.devnull, "w") as devnull:
+            sink = devnull
+            if args.sink_latency:
+                sink = _SlowSink(devnull, args.sink_latency)
+            listener = None
+            root = logging.getLogger()
+            for h in list(root.handlers):
+                root.removeHandler(h)
+            if handler == "stream":
+                root.addHandler(logging.StreamHandler(sink))
+                root.setLevel(level)
+            elif handler == "queue":
+                listener = setup_logging(level, sink)
+            else:
+                root.setLevel(level)
+
+            servicer = UBDBServer(BucketNameDatabase(), access_log=AccessLog(sample))
+            deadline = time.monotonic() + args.seconds
+
+            def caller(t):
+                context = _NullContext()
+                n = 0
+                while time.monotonic() < deadline:
+                    # Reuse every tenth name so some requests fail.
+                    i = n - 1 if n % 10 == 9 else n
+                    req = ubdb_pb2.AddBucketEntryRequest(
+                        bucket=f"bucket-{t}-{i}", cluster="cluster", owner="owner"
+                    )
+                    servicer.AddBucketEntry(req, context)
+                    n += 1
+                return n
+
+            start = time.perf_counter()
+            with futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+                total = sum(pool.map(caller, range(args.threads)))
+            elapsed = time.perf_counter() - start
+            if listener is not None:
+                # Not timed: the backlog drains after the RPCs have returned.
+                listener.stop()
+            print(
+                f"{mode:<8} {args.threads:>7} {total / elapsed:>10.0f} {elapsed / total * 1e6 * args.threads:>8.1f}"
+            )
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+
+class _CallDetails:
+    def __init__(self, method):
+        self.method = method
+
+
+def bench_metrics(args):
+    """
+    Per-RPC cost of the metrics interceptor, calling the servicer directly
+    with and without it, while another thread scrapes the metrics every
+    --scrape-interval seconds.
+    """
+    print(f"{'metrics':<8} {'threads':>7} {'rpcs/sec':>10} {'us/rpc':>8}")
+    for threads in args.threads:
+        for enabled in (False, True):
+            servicer = UBDBServer(BucketNameDatabase(), access_log=AccessLog(0))
+            handler = servicer.AddBucketEntry
+            registry = MetricsRegistry()
+            if enabled:
+                wrapped = MetricsInterceptor(registry.rpc).intercept_service(
+                    lambda details: grpc.unary_unary_rpc_method_handler(handler),
+                    _CallDetails("/ubdb.v1.UBDBService/AddBucketEntry"),
+                )
+                handler = wrapped.unary_unary
+            deadline = time.monotonic() + args.seconds
+
+            def caller(t):
+                context = _NullContext()
+                n = 0
+                while time.monotonic() < deadline:
+                    req = ubdb_pb2.AddBucketEntryRequest(
+                        bucket=f"bucket-{t}-{n}", cluster="cluster", owner="owner"
+                    )
+                    handler(req, context)
+                    n += 1
+                return n
+
+            def scraper():
+                while time.monotonic() < deadline:
+                    registry.render()
+                    time.sleep(args.scrape_interval)
+
+            start = time.perf_counter()
+            with futures.ThreadPoolExecutor(max_workers=threads + 1) as pool:
+                pool.submit(scraper)
+                total = sum(pool.map(caller, range(threads)))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{'on' if enabled else 'off':<8} {threads:>7} {total / elapsed:>10.0f} {elapsed / total * 1e6 * threads:>8.1f}"
+            )
+
+
+def bench_profile(args):
+    """
+    Per-RPC cost of the profiler: not installed, installed but idle, and
+    during each kind of capture. Each call goes through the interceptor and
+    the request and response (de)serializers, as it would in the server.
+    """
+    details = _CallDetails("/ubdb.v1.UBDBService/AddBucketEntry")
+    print(f"{'profiler':<8} {'threads':>7} {'rpcs/sec':>10} {'us/rpc':>8}")
+    for threads in args.threads:
+        for mode in ("off", "idle", "rpcs", "stacks"):
+            servicer = UBDBServer(BucketNameDatabase(), access_log=AccessLog(0))
+            profiler = Profiler(args.interval_ms / 1000)
+            profiler.attach(servicer)
+            plain = grpc.unary_unary_rpc_method_handler(
+                servicer.AddBucketEntry,
+                request_deserializer=ubdb_pb2.AddBucketEntryRequest.FromString,
+                response_serializer=ubdb_pb2.AddBucketEntryResponse.SerializeToString,
+            )
+            if mode == "off":
+                intercept = lambda details: plain
+            else:
+                interceptor = ProfilingInterceptor(profiler)
+                intercept = lambda details: interceptor.intercept_service(
+                    lambda d: plain, details
+                )
+            capture = None
+            if mode != "off" and mode != "idle":
+                run = profiler.time_rpcs if mode == "rpcs" else profiler.sample_stacks
+                capture = threading.Thread(target=run, args=(args.seconds + 1,))
+                capture.start()
+                time.sleep(0.1)
+            deadline = time.monotonic() + args.seconds
+
+            def caller(t):
+                context = _NullContext()
+                request = ubdb_pb2.AddBucketEntryRequest(cluster="cluster", owner="owner")
+                n = 0
+                while time.monotonic() < deadline:
+                    request.bucket = f"bucket-{t}-{n}"
+                    handler = intercept(details)
+                    req = handler.request_deserializer(request.SerializeToString())
+                    handler.response_serializer(handler.unary_unary(req, context))
+                    n += 1
+                return n
+
+            start = time.perf_counter()
+            with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+                total = sum(pool.map(caller, range(threads)))
+            elapsed = time.perf_counter() - start
+            if capture is not None:
+                capture.join()
+            print(
+                f"{mode:<8} {threads:>7} {total / elapsed:>10.0f} {elapsed / total * 1e6 * threads:>8.1f}"
+            )
+
+
+def bench_capture(args):
+    """
+    Per-RPC cost of traffic capture: no interceptor, the interceptor with
+    no capture running, and capturing to a file in --dir; and the size of
+    the trace per call. As for the profiler, each call goes through the
+    interceptor and the (de)serializers.
+    """
+    details = _CallDetails("/ubdb.v1.UBDBService/AddBucketEntry")
+    print(
+        f"{'capture':<8} {'threads':>7} {'rpcs/sec':>10} {'us/rpc':>8} {'bytes/call':>10} {'dropped':>8}"
+    )
+    for threads in args.threads:
+        for mode in ("off", "idle", "on"):
+            servicer = UBDBServer(BucketNameDatabase(), access_log=AccessLog(0))
+            capture = Capture()
+            plain = grpc.unary_unary_rpc_method_handler(
+                servicer.AddBucketEntry,
+                request_deserializer=ubdb_pb2.AddBucketEntryRequest.FromString,
+                response_serializer=ubdb_pb2.AddBucketEntryResponse.SerializeToString,
+            )
+            if mode == "off":
+                intercept = lambda details: plain
+            else:
+                interceptor = CaptureInterceptor(capture)
+                intercept = lambda details: interceptor.intercept_service(
+                    lambda d: plain, details
+                )
+            f = tempfile.TemporaryFile(dir=args.dir)
+            if mode == "on":
+                capture.start(f)
+            deadline = time.monotonic() + args.seconds
+
+            def caller(t):
+                context = _NullContext()
+                request = ubdb_pb2.AddBucketEntryRequest(cluster="cluster", owner="owner")
+                n = 0
+                while time.monotonic() < deadline:
+                    request.bucket = f"bucket-{t}-{n}"
+                    handler = intercept(details)
+                    req = handler.request_deserializer(request.SerializeToString())
+                    handler.response_serializer(handler.unary_unary(req, context))
+                    n += 1
+                return n
+
+            start = time.perf_counter()
+            with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+                total = sum(pool.map(caller, range(threads)))
+            elapsed = time.perf_counter() - start
+            calls, dropped = capture.stop()
+            size = f.tell()
+            if mode == "on":
+                f.seek(0)
+                if sum(1 for _ in TraceReader(f)) != calls:
+                    raise SystemExit("capture: the trace doesn't hold every call")
+            f.close()
+            per_call = f"{size / calls:.1f}" if calls else "-"
+            print(
+                f"{mode:<8} {threads:>7} {total / elapsed:>10.0f} {elapsed / total * 1e6 * threads:>8.1f} {per_call:>10} {dropped:>8}"
+            )
+
+
+def _watcher(feed, deadline, delay, started, latencies, resyncs):
+    """
+    Follow a change feed until the deadline, as a watch does, recording how
+    long after its mutation started each change was read. A slow watcher
+    takes `delay` seconds over each batch instead.
+    """
+    after = feed.seq
+    while time.monotonic() < deadline:
+        changes = feed.changes_after(after)
+        if changes is None:
+            resyncs.append(after)
+            after = feed.seq
+            continue
+        if not changes:
+            feed.wait(after, 0.1)
+            continue
+        if delay:
+            time.sleep(delay)
+        else:
+            now = time.perf_counter()
+            latencies.extend(now - started[change[1]] for change in changes)
+        after = changes[-1][0]
+
+
+def bench_watch(args):
+    """
+    Mutation throughput with no change feed, and with a feed followed by
+    fast and slow watchers; how soon fast watchers see each change, and how
+    often slow ones fall off the end of the feed.
+    """
+    runs = [("off", 0, 0)] + [("on", n, 0) for n in args.watchers]
+    if args.slow:
+        runs.append(("on", max(args.watchers), args.slow))
+    print(
+        f"{'feed':<4} {'fast':>4} {'slow':>4} {'muts/sec':>10} {'p50 us':>8} {'p99 us':>8} {'resyncs':>8}"
+    )
+    for feed_mode, fast, slow in runs:
+        db = BucketNameDatabase()
+        if feed_mode == "on":
+            db.changes = ChangeFeed(args.buffer, db.seq)
+        started = {}
+        latencies = []
+        resyncs = []
+        deadline = time.monotonic() + args.seconds
+        watchers = [
+            threading.Thread(
+                target=_watcher,
+                args=(
+                    db.changes,
+                    deadline,
+                    args.slow_ms / 1000 if i >= fast else 0,
+                    started,
+                    latencies,
+                    resyncs,
+                ),
+            )
+            for i in range(fast + slow)
+        ]
+        for t in watchers:
+            t.start()
+
+        def mutator(t):
+            n = 0
+            while time.monotonic() < deadline:
+                name = f"bucket-{t}-{n}"
+                started[name] = time.perf_counter()
+                db.add_bucket(name, "cluster", "owner")
+                n += 1
+            return n
+
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+            total = sum(pool.map(mutator, range(args.threads)))
+        elapsed = time.perf_counter() - start
+        for t in watchers:
+            t.join()
+        latencies.sort()
+        if latencies:
+            p50 = f"{_percentile(latencies, 0.5) * 1e6:>8.0f}"
+            p99 = f"{_percentile(latencies, 0.99) * 1e6:>8.0f}"
+        else:
+            p50 = p99 = f"{'-':>8}"
+        print(
+            f"{feed_mode:<4} {fast:>4} {slow:>4} {total / elapsed:>10.0f} {p50} {p99} {len(resyncs):>8}"
+        )
+
+
+def _rss_bytes(pid="self"):
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _memory_child(buckets, clusters, owners):
+    """Fill a database in a fresh process, returning (RSS growth, secs)."""
+    logging.basicConfig(level=logging.CRITICAL)
+    db = BucketNameDatabase()
+    before = _rss_bytes()
+    start = time.perf_counter()
+    for i in range(buckets):
+        # Build fresh strings each time, as decoding a request would.
+        db.add_bucket(f"bucket-{i:010d}", f"cluster-{i % clusters}", f"owner-{i % owners}")
+        if i % 4 == 0:
+            db.update_bucket(
+                f"bucket-{i:010d}",
+                f"cluster-{i % clusters}",
+                f"owner-{i % owners}",
+                BucketState.CREATED,
+            )
+    elapsed = time.perf_counter() - start
+    return _rss_bytes() - before, elapsed
+
+
+def bench_memory(args):
+    """
+    Resident memory per bucket as the table grows, each size measured in a
+    fresh process. The growth includes the bucket names themselves, which
+    are the same whatever the record layout.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'buckets':>10} {'MiB':>8} {'bytes/bucket':>12} {'secs':>8}")
+    for buckets in args.buckets:
+        with ctx.Pool(1) as pool:
+            grown, elapsed = pool.apply(
+                _memory_child, (buckets, args.clusters, args.owners)
+            )
+        print(
+            f"{buckets:>10} {grown / 2**20:>8.0f} {grown / buckets:>12.0f} {elapsed:>8.1f}"
+        )
+
+
+def bench_reconcile(args):
+    """
+    Bytes and time for Reconcile against an in-process server holding
+    --buckets entries for one cluster, when the cluster's own list differs
+    in the given fraction of entries: a third missing from UBDB, a third
+    missing from the cluster and a third with another owner. "full" is the
+    size of just sending the cluster's whole list.
+    """
+    db = BucketNameDatabase()
+    names = [f"bucket-{i:010d}" for i in range(args.buckets)]
+    for name in names:
+        db.add_bucket(name, "cluster", "owner")
+    server = build_server(db)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    rng = random.Random(0)
+    print(
+        f"{'diverge':>7} {'diffs':>7} {'calls':>5} {'nodes':>6} {'sent':>10} {'received':>10} {'full':>10} {'secs':>6}  result"
+    )
+    try:
+        with grpc.insecure_channel(f"127.0.0.1:{port}") as channel:
+            stub = ubdb_pb2_grpc.UBDBServiceStub(channel)
+            for divergence in args.divergence:
+                changed = rng.sample(range(len(names)), int(len(names) * divergence))
+                thirds = len(changed) // 3
+                dropped = {names[i] for i in changed[:thirds]}
+                reowned = {names[i] for i in changed[thirds : 2 * thirds]}
+                extra = [
+                    f"extra-{j:010d}" for j in range(len(changed) - 2 * thirds)
+                ]
+                entries = [
+                    (name, "other-owner" if name in reowned else "owner")
+                    for name in names
+                    if name not in dropped
+                ] + [(name, "owner") for name in extra]
+                full = sum(
+                    ubdb_pb2.ReconcileEntry(bucket=b, owner=o).ByteSize() + 2
+                    for b, o in entries
+                )
+
+                start = time.perf_counter()
+                result = reconcile(stub, "cluster", entries)
+                elapsed = time.perf_counter() - start
+                ok = (
+                    {b for b, _ in result.missing_from_cluster} == dropped
+                    and {b for b, _, _ in result.owner_mismatch} == reowned
+                    and {b for b, _ in result.missing_from_ubdb} == set(extra)
+                )
+                print(
+                    f"{divergence:>7.2%} {len(changed):>7} {result.calls:>5} {result.compared_nodes:>6} "
+                    f"{result.bytes_sent:>10} {result.bytes_received:>10} {full:>10} {elapsed:>6.2f}  "
+                    + ("PASS" if ok else "FAIL")
+                )
+    finally:
+        server.stop(None)
+
+
+def _scan(
+    db, cluster=None, owner=None, state=None, limit=None, prefix="", start_at="", end_before=""
+):
+    """list_buckets() the hard way: filter every bucket, then sort."""
+    entries = []
+    for shard in db.shards:
+        with shard.lock:
+            for b in shard.buckets.values():
+                if (
+                    (cluster is None or b.cluster == cluster)
+                    and (owner is None or b.owner == owner)
+                    and (state is None or b.state == state)
+                    and b.name.startswith(prefix)
+                    and b.name >= start_at
+                    and (not end_before or b.name < end_before)
+                ):
+                    entries.append((b.name, b.cluster, b.owner, b.state))
+    entries.sort()
+    return entries[:limit]
+
+
+def _list_all(
+    db, cluster=None, owner=None, state=None, limit=None, prefix="", start_at="", end_before=""
+):
+    """Page through list_buckets() until limit entries, or the end."""
+    after, inclusive, end = _list_bounds(
+        ubdb_pb2.ListBucketEntriesRequest(
+            prefix=prefix, start_at=start_at, end_before=end_before
+        )
+    )
+    entries = []
+    while limit is None or len(entries) < limit:
+        page = db.list_buckets(cluster, owner, state, after, 1000, end, inclusive)
+        entries.extend(page)
+        if len(page) < 1000:
+            break
+        after, inclusive = page[-1][0], False
+    return entries[:limit]
+
+
+def bench_list(args):
+    """
+    Latency of filtered listings through the secondary indexes, against a
+    full scan of the table, with --buckets spread over --clusters clusters
+    and --owners owners. A quarter of the buckets are CREATED and one in a
+    thousand DELETING; the rest are CREATING.
+    """
+    db = BucketNameDatabase()
+    start = time.perf_counter()
+    for i in range(args.buckets):
+        name, cluster, owner = (
+            f"bucket-{i:010d}",
+            f"cluster-{i % args.clusters}",
+            f"owner-{i % args.owners}",
+        )
+        db.add_bucket(name, cluster, owner)
+        if i % 4 == 0 or i % 1000 == 1:
+            db.update_bucket(name, cluster, owner, BucketState.CREATED)
+        if i % 1000 == 1:
+            db.update_bucket(name, cluster, owner, BucketState.DELETING)
+    print(f"filled {args.buckets} buckets in {time.perf_counter() - start:.1f}s")
+
+    queries = [
+        ("cluster, first page", dict(cluster="cluster-3"), 1000),
+        ("owner, all", dict(owner="owner-42"), None),
+        ("DELETING, all", dict(state=BucketState.DELETING), None),
+        (
+            "cluster+CREATING, page",
+            dict(cluster="cluster-3", state=BucketState.CREATING),
+            1000,
+        ),
+        ("CREATED, first page", dict(state=BucketState.CREATED), 1000),
+        ("prefix, all", dict(prefix="bucket-0000123"), None),
+        (
+            "cluster+prefix, all",
+            dict(cluster="cluster-3", prefix="bucket-000012"),
+            None,
+        ),
+        (
+            "range, all",
+            dict(start_at="bucket-0000500000", end_before="bucket-0000502500"),
+            None,
+        ),
+    ]
+    print(f"{'query':<22} {'entries':>8} {'index ms':>10} {'scan ms':>10}  result")
+    for label, filters, limit in queries:
+        start = time.perf_counter()
+        listed = _list_all(db, limit=limit, **filters)
+        indexed = time.perf_counter() - start
+        start = time.perf_counter()
+        scanned = _scan(db, limit=limit, **filters)
+        scan = time.perf_counter() - start
+        print(
+            f"{label:<22} {len(listed):>8} {indexed * 1000:>10.2f} {scan * 1000:>10.1f}  "
+            + ("PASS" if listed == scanned else "FAIL")
+        )
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def _insert_names(names, ordered):
+    """Insert names into a dict, and a SortedNames too if ordered; seconds per name."""
+    table, index = {}, SortedNames()
+    start = time.perf_counter()
+    if ordered:
+        add = index.add
+        for name in names:
+            table[name] = None
+            add(name)
+    else:
+        for name in names:
+            table[name] = None
+    return (time.perf_counter() - start) / len(names), table, index
+
+
+def bench_names(args):
+    """
+    What the ordered name index costs and buys at each of --names names.
+    First, inserts into a dict alone (as the bucket table) and into a dict
+    with a SortedNames alongside, in name order and shuffled. Then latency
+    of --queries random prefix and range queries for a first page of up to
+    --page names through the index, against filtering and sorting the whole
+    key set (three times; it's slow).
+    """
+    rng = random.Random(1)
+    for count in args.names:
+        names = [f"bucket-{i:010d}" for i in range(count)]
+        shuffled = names[:]
+        rng.shuffle(shuffled)
+        print(f"{count} names")
+        print(f"{'insert':<16} {'order':<8} {'ns/name':>8} {'overhead':>9}")
+        for order, source in (("sorted", names), ("random", shuffled)):
+            plain, table, _ = _insert_names(source, False)
+            del table
+            indexed, table, index = _insert_names(source, True)
+            print(f"{'dict':<16} {order:<8} {plain * 1e9:>8.0f}")
+            print(
+                f"{'dict+SortedNames':<16} {order:<8} {indexed * 1e9:>8.0f} "
+                f"{indexed / plain - 1:>9.0%}"
+            )
+        del shuffled
+
+        print(
+            f"{'query':<14} {'matches':>8} {'p50 us':>8} {'p99 us':>8} {'scan ms':>9}  result"
+        )
+        # Names that differ only in their last few digits share a prefix.
+        rows = [(f"prefix, {10**digits}", digits) for digits in range(1, 5)]
+        rows.append((f"range, {args.page}", None))
+        for label, digits in rows:
+            queries = []
+            for _ in range(args.queries):
+                i = rng.randrange(count)
+                if digits is None:
+                    queries.append((names[i], names[min(i + args.page, count - 1)]))
+                else:
+                    prefix = names[i][:-digits]
+                    queries.append((prefix, prefix_end(prefix)))
+            latencies, matches = [], 0
+            for start, end in queries:
+                t = time.perf_counter()
+                found = index.after(start, args.page, end, inclusive=True)
+                latencies.append(time.perf_counter() - t)
+                matches = max(matches, len(found))
+            latencies.sort()
+            scans = []
+            for start, end in queries[:3]:
+                t = time.perf_counter()
+                scanned = sorted(n for n in table if start <= n < end)[: args.page]
+                scans.append(time.perf_counter() - t)
+            ok = scanned == index.after(start, args.page, end, inclusive=True)
+            print(
+                f"{label:<14} {matches:>8} {_percentile(latencies, 0.5) * 1e6:>8.1f} "
+                f"{_percentile(latencies, 0.99) * 1e6:>8.1f} {sorted(scans)[1] * 1000:>9.0f}  "
+                + ("PASS" if ok else "FAIL")
+            )
+        del names, table, index
+
+
+def bench_reads(args):
+    """
+    Lookups mixed with writes, from many threads, with lookups going
+    lock-free (get_bucket()) or taking the shard lock as a mutation does.
+    Writes walk other buckets through their lifecycle; lookups pick from
+    --buckets existing ones.
+    """
+    print(
+        f"{'reads':>6} {'threads':>7} {'lookups':<9} {'reads/s':>10} {'writes/s':>9} {'read p50 us':>11} {'read p99 us':>11}"
+    )
+    for fraction in args.read_fraction:
+        for threads in args.threads:
+            for mode in ("locked", "lock-free"):
+                db = BucketNameDatabase(shards=args.shards)
+                names = [f"bucket-{i:08d}" for i in range(args.buckets)]
+                for name in names:
+                    db.add_bucket(name, "cluster", "owner")
+                    db.update_bucket(name, "cluster", "owner", BucketState.CREATED)
+
+                if mode == "locked":
+
+                    def lookup(name):
+                        shard = db._shard(name)
+                        with shard.lock:
+                            return shard.buckets.get(name)
+
+                else:
+                    lookup = db.get_bucket
+
+                deadline = time.monotonic() + args.seconds
+
+                def worker(seed):
+                    rng = random.Random(seed)
+                    steps = (
+                        lambda n: db.add_bucket(n, "cluster", "owner"),
+                        lambda n: db.update_bucket(
+                            n, "cluster", "owner", BucketState.CREATED
+                        ),
+                        lambda n: db.update_bucket(
+                            n, "cluster", "owner", BucketState.DELETING
+                        ),
+                        lambda n: db.delete_bucket(n, "cluster", "owner"),
+                    )
+                    latencies, writes, step, k = [], 0, 0, 0
+                    while time.monotonic() < deadline:
+                        if rng.random() < fraction:
+                            name = rng.choice(names)
+                            start = time.perf_counter()
+                            lookup(name)
+                            latencies.append(time.perf_counter() - start)
+                        else:
+                            steps[step](f"writer-{seed}-{k}")
+                            step = (step + 1) % len(steps)
+                            k += step == 0
+                            writes += 1
+                    return latencies, writes
+
+                with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+                    results = list(pool.map(worker, range(threads)))
+                latencies = sorted(l for r in results for l in r[0])
+                writes = sum(r[1] for r in results)
+                print(
+                    f"{fraction:>6.0%} {threads:>7} {mode:<9} {len(latencies) / args.seconds:>10.0f} "
+                    f"{writes / args.seconds:>9.0f} {_percentile(latencies, 0.5) * 1e6:>11.2f} "
+                    f"{_percentile(latencies, 0.99) * 1e6:>11.2f}"
+                )
+
+
+def _tombstones_child(retention, threads, seconds):
+    """
+    Churn unique bucket names through their lifecycle in a fresh process,
+    returning (ops, p99 and max op latency, tombstones left, purged, RSS
+    growth less the latency samples).
+    """
+    logging.basicConfig(level=logging.CRITICAL)
+    db = BucketNameDatabase()
+    if retention != float("inf"):
+        db.start_compactor(retention)
+    before = _rss_bytes()
+    deadline = time.monotonic() + seconds
+
+    def worker(t):
+        latencies, i = array("d"), 0
+        while time.monotonic() < deadline:
+            # Build fresh strings each time, as decoding a request would.
+            name, cluster = f"churn-{t}-{i:010d}", f"cluster-{t % 8}"
+            for op in (
+                lambda: db.add_bucket(name, cluster, "owner"),
+                lambda: db.update_bucket(name, cluster, "owner", BucketState.CREATED),
+                lambda: db.update_bucket(name, cluster, "owner", BucketState.DELETING),
+                lambda: db.delete_bucket(name, cluster, "owner"),
+            ):
+                start = time.perf_counter()
+                op()
+                latencies.append(time.perf_counter() - start)
+            i += 1
+        return latencies
+
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        samples = list(pool.map(worker, range(threads)))
+    grown = _rss_bytes() - before - sum(sys.getsizeof(s) for s in samples)
+    latencies = sorted(l for s in samples for l in s)
+    left = sum(len(shard.tombstones) for shard in db.shards)
+    return (
+        len(latencies),
+        _percentile(latencies, 0.99),
+        latencies[-1],
+        left,
+        db.tombstones_purged,
+        grown,
+    )
+
+
+def bench_tombstones(args):
+    """
+    Create/destroy churn on unique names with tombstones kept for each
+    --retention (inf: never purged), each in a fresh process. Purges take
+    shard locks, so the op latency tail shows whether they stall mutations.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    print(
+        f"{'retention':>9} {'ops/s':>8} {'p99 us':>8} {'max ms':>8} {'tombstones':>10} {'purged':>9} {'MiB':>6} {'bytes/tomb':>10}"
+    )
+    for retention in args.retention:
+        with ctx.Pool(1) as pool:
+            ops, p99, worst, left, purged, grown = pool.apply(
+                _tombstones_child, (retention, args.threads, args.seconds)
+            )
+        per = f"{grown / left:.0f}" if left else "-"
+        print(
+            f"{retention:>9} {ops / args.seconds:>8.0f} {p99 * 1e6:>8.1f} "
+            f"{worst * 1e3:>8.2f} {left:>10} {purged:>9} {grown / 2**20:>6.0f} {per:>10}"
+        )
+
+
+def _startup_entries(buckets, clusters, owners):
+    """
+    (bucket, cluster, owner, state) for the startup bench's table, in name
+    order. A quarter of the buckets are CREATED, the rest CREATING.
+    """
+    for i in range(buckets):
+        yield (
+            f"bucket-{i:010d}",
+            f"cluster-{i % clusters}",
+            f"owner-{i % owners}",
+            BucketState.CREATED if i % 4 == 0 else BucketState.CREATING,
+        )
+
+
+def _write_json_snapshot(data_dir, entries):
+    """A snapshot in the JSON lines format that came before ubns_snapshot."""
+    with open(os.path.join(data_dir, JSON_SNAPSHOT_NAME), "w") as f:
+        f.write(json.dumps({"version": 1, "last_seq": 0}) + "\n")
+        for name, cluster, owner, state in entries:
+            record = dict(
+                op="put", bucket=name, cluster=cluster, owner=owner, state=state.name
+            )
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def _write_mmap_snapshot(data_dir, entries):
+    ubns_snapshot.write(
+        os.path.join(data_dir, SNAPSHOT_NAME),
+        0,
+        ((n, c, o, state.value) for n, c, o, state in entries),
+    )
+
+
+def _wait_serving(address, bucket, timeout):
+    """Poll GetBucketEntry until it finds `bucket`."""
+    request = ubdb_pb2.GetBucketEntryRequest(bucket=bucket)
+    deadline = time.monotonic() + timeout
+    with grpc.insecure_channel(address) as channel:
+        stub = ubdb_pb2_grpc.UBDBServiceStub(channel)
+        while True:
+            try:
+                stub.GetBucketEntry(request, timeout=1)
+                return
+            except grpc.RpcError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+
+def bench_startup(args):
+    """
+    Time from starting the server on a data directory holding a snapshot of
+    --buckets buckets to it answering a lookup, with the snapshot in the
+    JSON format, which is parsed into the table, and in the memory-mapped
+    one, which is served from as it is. Also the time to write each
+    snapshot, its size, and the server's resident memory once it's up.
+    """
+    writers = {"json": _write_json_snapshot, "mmap": _write_mmap_snapshot}
+    print(
+        f"{'buckets':>10} {'format':<6} {'write s':>8} {'MiB':>7} "
+        f"{'startup s':>10} {'RSS MiB':>8}"
+    )
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ubns_server.py")
+    for buckets in args.buckets:
+        for fmt in args.format:
+            data_dir = tempfile.mkdtemp(prefix="ubns-bench-", dir=args.dir)
+            try:
+                entries = _startup_entries(buckets, args.clusters, args.owners)
+                start = time.perf_counter()
+                writers[fmt](data_dir, entries)
+                written = time.perf_counter() - start
+                size = sum(
+                    os.path.getsize(os.path.join(data_dir, f))
+                    for f in os.listdir(data_dir)
+                )
+
+                port = _free_port()
+                start = time.perf_counter()
+                proc = subprocess.Popen(
+                    [sys.executable, server, "127.0.0.1", str(port)]
+                    + ["--data-dir", data_dir],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+                try:
+                    _wait_serving(
+                        f"127.0.0.1:{port}", f"bucket-{buckets - 1:010d}", args.timeout
+                    )
+                    ready = time.perf_counter() - start
+                    rss = _rss_bytes(proc.pid)
+                finally:
+                    stop_server(proc)
+                print(
+                    f"{buckets:>10} {fmt:<6} {written:>8.1f} {size / 2**20:>7.0f} "
+                    f"{ready:>10.2f} {rss / 2**20:>8.0f}"
+                )
+            finally:
+                shutil.rmtree(data_dir)
+
+
+async def _drive_open_loop(address, rate, seconds, deadline, channels):
+    """
+    Start `rate` AddBucketEntry calls a second for `seconds`, each with a
+    `deadline`, however long they take. Returns a Counter of outcomes and
+    the sorted latencies of the calls that succeeded.
+    """
+    chans = [grpc.aio.insecure_channel(address) for _ in range(channels)]
+    stubs = [ubdb_pb2_grpc.UBDBServiceStub(c) for c in chans]
+    outcomes, latencies = Counter(), []
+
+    async def call(i):
+        req = ubdb_pb2.AddBucketEntryRequest(
+            bucket=f"bucket-{rate}-{i}", cluster="cluster", owner="owner"
+        )
+        start = time.perf_counter()
+        try:
+            await stubs[i % len(stubs)].AddBucketEntry(req, timeout=deadline)
+            latencies.append(time.perf_counter() - start)
+            outcomes["ok"] += 1
+        except grpc.aio.AioRpcError as e:
+            if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+                outcomes[e.code().name.lower()] += 1
+            elif e.details().startswith("shed:"):
+                outcomes["shed"] += 1
+            else:
+                outcomes["refused"] += 1
+
+    calls = []
+    start = time.monotonic()
+    while (elapsed := time.monotonic() - start) < seconds:
+        while len(calls) < elapsed * rate:
+            calls.append(asyncio.ensure_future(call(len(calls))))
+        await asyncio.sleep(0.001)
+    await asyncio.gather(*calls)
+    for c in chans:
+        await c.close()
+    return outcomes, sorted(latencies)
+
+
+def bench_overload(args):
+    """
+    Open-loop AddBucketEntry load at increasing rates, past what the server
+    can serve, against a server admitting everything and one with
+    --max-concurrent-rpcs and deadline shedding. Without admission control
+    every caller waits in one queue, so once it's overloaded most calls
+    miss their deadline; with it, the excess fails fast and the calls that
+    are admitted keep their latency.
+
+    The server has to be what saturates, not the load generator. With few
+    cores, --server-nice helps by giving the generator the CPU first.
+    """
+    print(
+        f"{'mode':<9} {'offered/s':>9} {'ok/s':>7} {'refused':>8} {'shed':>6} "
+        f"{'timeout':>8} {'ok p50 ms':>9} {'ok p99 ms':>9}"
+    )
+    modes = {
+        "unlimited": ["--no-deadline-shedding"],
+        "admission": ["--max-concurrent-rpcs", str(args.max_concurrent_rpcs)],
+    }
+    for mode, extra in modes.items():
+        data_dir = tempfile.mkdtemp(prefix="ubns-bench-", dir=args.dir)
+        proc, address = spawn_server(
+            [
+                "--max-workers",
+                str(args.max_workers),
+                "--data-dir",
+                data_dir,
+                "--wal-sync",
+                args.wal_sync,
+                *extra,
+            ],
+            args.server_nice,
+        )
+        try:
+            for rate in args.rate:
+                outcomes, latencies = asyncio.run(
+                    _drive_open_loop(
+                        address, rate, args.seconds, args.deadline, args.channels
+                    )
+                )
+                if latencies:
+                    p50 = f"{_percentile(latencies, 0.5) * 1000:>9.1f}"
+                    p99 = f"{_percentile(latencies, 0.99) * 1000:>9.1f}"
+                else:
+                    p50 = p99 = f"{'-':>9}"
+                print(
+                    f"{mode:<9} {rate:>9} {outcomes['ok'] / args.seconds:>7.0f} "
+                    f"{outcomes['refused']:>8} {outcomes['shed']:>6} "
+                    f"{outcomes['deadline_exceeded']:>8} {p50} {p99}"
+                )
+        finally:
+            stop_server(proc)
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+async def _drive_aggressor(address, tasks, seconds, deadline, channels):
+    """
+    `tasks` callers of one cluster making AddBucketEntry calls as fast as
+    they can for `seconds`, ignoring failures. Returns a Counter of outcomes.
+    """
+    chans = [grpc.aio.insecure_channel(address) for _ in range(channels)]
+    stubs = [ubdb_pb2_grpc.UBDBServiceStub(c) for c in chans]
+    outcomes = Counter()
+    stop = time.monotonic() + seconds
+
+    async def caller(t):
+        stub = stubs[t % len(stubs)]
+        n = 0
+        while time.monotonic() < stop:
+            req = ubdb_pb2.AddBucketEntryRequest(
+                bucket=f"aggressive-{os.getpid()}-{t}-{n}",
+                cluster="aggressive",
+                owner="owner",
+            )
+            n += 1
+            try:
+                await stub.AddBucketEntry(req, timeout=deadline)
+                outcomes["ok"] += 1
+            except grpc.aio.AioRpcError as e:
+                outcomes[e.code().name.lower()] += 1
+
+    await asyncio.gather(*(caller(t) for t in range(tasks)))
+    for c in chans:
+        await c.close()
+    return outcomes
+
+
+def _aggressor_process(address, tasks, seconds, deadline, channels, nice):
+    """
+    The aggressor in a process of its own, `nice` lower in priority, so
+    that it loads the server rather than the CPU the server runs on.
+    """
+    os.nice(nice)
+    return asyncio.run(_drive_aggressor(address, tasks, seconds, deadline, channels))
+
+
+async def _drive_polite(address, args):
+    """
+    --polite clusters each starting --polite-rate AddBucketEntry calls a
+    second, open-loop. Returns a Counter of outcomes and the sorted
+    latencies of the calls that succeeded.
+    """
+    chans = [grpc.aio.insecure_channel(address) for _ in range(args.channels)]
+    stubs = [ubdb_pb2_grpc.UBDBServiceStub(c) for c in chans]
+    outcomes, latencies = Counter(), []
+
+    async def call(cluster, i):
+        req = ubdb_pb2.AddBucketEntryRequest(
+            bucket=f"{cluster}-{i}", cluster=cluster, owner="owner"
+        )
+        start = time.perf_counter()
+        try:
+            await stubs[i % len(stubs)].AddBucketEntry(req, timeout=args.deadline)
+            latencies.append(time.perf_counter() - start)
+            outcomes["ok"] += 1
+        except grpc.aio.AioRpcError as e:
+            outcomes[e.code().name.lower()] += 1
+
+    async def cluster_calls(cluster):
+        calls = []
+        start = time.monotonic()
+        while (elapsed := time.monotonic() - start) < args.seconds:
+            while len(calls) < elapsed * args.polite_rate:
+                calls.append(asyncio.ensure_future(call(cluster, len(calls))))
+            await asyncio.sleep(0.001)
+        await asyncio.gather(*calls)
+
+    await asyncio.gather(*(cluster_calls(f"polite-{c}") for c in range(args.polite)))
+    for c in chans:
+        await c.close()
+    return outcomes, sorted(latencies)
+
+
+def bench_fairness(args):
+    """
+    Latency of well-behaved clusters' calls while one cluster calls in a
+    tight loop, with no per-cluster admission, with a rate limit per
+    cluster, with the fair queue, and with both. The first row has no
+    aggressor, for reference.
+
+    The aggressor runs in its own process at a lower priority, standing in
+    for a client on another machine: on a small box it would otherwise
+    slow the server by taking its CPU, which no admission policy can help.
+    """
+    print(
+        f"{'mode':<5} {'aggressor':>9} {'polite ok/s':>11} {'p50 ms':>8} "
+        f"{'p99 ms':>8} {'failed':>7} {'aggr ok/s':>9} {'refused':>8}"
+    )
+    rate = ["--cluster-rate", str(args.cluster_rate)]
+    fair = [
+        "--fair-slots",
+        str(args.fair_slots),
+        "--fair-queue-depth",
+        str(args.fair_queue_depth),
+    ]
+    modes = {"none": [], "rate": rate, "fair": fair, "both": rate + fair}
+    runs = [("none", 0)] + [(mode, args.aggressor) for mode in args.mode]
+    ctx = multiprocessing.get_context("spawn")
+    for mode, aggressor in runs:
+        data_dir = tempfile.mkdtemp(prefix="ubns-bench-", dir=args.dir)
+        proc, address = spawn_server(
+            [
+                "--max-workers",
+                str(args.max_workers),
+                "--data-dir",
+                data_dir,
+                "--wal-sync",
+                args.wal_sync,
+                "--no-deadline-shedding",
+                *modes[mode],
+            ],
+            args.server_nice,
+        )
+        try:
+            aggressive = Counter()
+            with ctx.Pool(1) as pool:
+                result = None
+                if aggressor:
+                    result = pool.apply_async(
+                        _aggressor_process,
+                        (
+                            address,
+                            aggressor,
+                            args.seconds,
+                            args.deadline,
+                            args.channels,
+                            args.aggressor_nice,
+                        ),
+                    )
+                polite, latencies = asyncio.run(_drive_polite(address, args))
+                if result is not None:
+                    aggressive = result.get()
+        finally:
+            stop_server(proc)
+            shutil.rmtree(data_dir, ignore_errors=True)
+        if latencies:
+            p50 = f"{_percentile(latencies, 0.5) * 1000:>8.1f}"
+            p99 = f"{_percentile(latencies, 0.99) * 1000:>8.1f}"
+        else:
+            p50 = p99 = f"{'-':>8}"
+        print(
+            f"{mode:<5} {aggressor:>9} {polite['ok'] / args.seconds:>11.0f} {p50} {p99} "
+            f"{sum(polite.values()) - polite['ok']:>7} "
+            f"{aggressive['ok'] / args.seconds:>9.0f} "
+            f"{aggressive['resource_exhausted']:>8}"
+        )
+
+
+def main(argv):
+    p = argparse.ArgumentParser(description="UBNS microbenchmarks")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    pwal = sub.add_parser("wal", help="write-ahead log sync modes")
+    pwal.add_argument("--ops", type=int, default=20000, help="mutations per run")
+    pwal.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=[1, 10],
+        help="concurrent writer counts to try",
+    )
+    pwal.add_argument("--dir", help="parent directory for the log (default: $TMPDIR)")
+    pwal.set_defaults(func=bench_wal)
+
+    pstress = sub.add_parser("stress", help="concurrency consistency check")
+    pstress.add_argument("--threads", type=int, default=32)
+    pstress.add_argument("--names", type=int, default=64, help="contended names")
+    pstress.add_argument("--shards", type=int, default=16)
+    pstress.add_argument("--seconds", type=float, default=10)
+    pstress.add_argument("--dir", help="parent directory for the log (default: $TMPDIR)")
+    pstress.set_defaults(func=bench_stress)
+
+    pconf = sub.add_parser(
+        "conformance", help="check that the storage backends behave the same"
+    )
+    pconf.add_argument(
+        "--backend", choices=["memory", "sqlite"], nargs="+", default=["memory", "sqlite"]
+    )
+    pconf.add_argument("--ops", type=int, default=5000)
+    pconf.add_argument("--threads", type=int, default=8)
+    pconf.add_argument("--seed", type=int, default=1)
+    pconf.add_argument(
+        "--dir", help="parent directory for the tables (default: $TMPDIR)"
+    )
+    pconf.set_defaults(func=bench_conformance)
+
+    pbackends = sub.add_parser(
+        "backends", help="throughput and memory of each storage backend"
+    )
+    pbackends.add_argument(
+        "--backend", choices=["memory", "sqlite"], nargs="+", default=["memory", "sqlite"]
+    )
+    pbackends.add_argument(
+        "--buckets", type=int, nargs="+", default=[1000000, 10000000]
+    )
+    pbackends.add_argument(
+        "--memory-limit",
+        type=int,
+        help="cap each backend's address space at this many MiB (default: none)",
+    )
+    pbackends.add_argument("--threads", type=int, default=8)
+    pbackends.add_argument("--seconds", type=float, default=5)
+    pbackends.add_argument(
+        "--wal-sync", choices=[m.value for m in SyncMode], default="group"
+    )
+    pbackends.add_argument(
+        "--dir", help="parent directory for the tables (default: $TMPDIR)"
+    )
+    pbackends.set_defaults(func=bench_backends)
+
+    pbloom = sub.add_parser("bloom", help="Bloom filter accuracy and create latency")
+    pbloom.add_argument("--buckets", type=int, default=1000000)
+    pbloom.add_argument(
+        "--fp-rate", type=float, nargs="+", default=[0.001, 0.01, 0.05]
+    )
+    pbloom.add_argument("--probes", type=int, default=1000000)
+    pbloom.add_argument("--creates", type=int, default=20000)
+    pbloom.add_argument("--rounds", type=int, default=2)
+    pbloom.add_argument(
+        "--cache-mb", type=int, default=8, help="SQLite page cache for the creates"
+    )
+    pbloom.add_argument(
+        "--dir", help="parent directory for the table (default: $TMPDIR)"
+    )
+    pbloom.set_defaults(func=bench_bloom)
+
+    pworkers = sub.add_parser("workers", help="RPC throughput vs handler threads")
+    pworkers.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32]
+    )
+    pworkers.add_argument("--shards", type=int, nargs="+", default=[1, 16])
+    pworkers.add_argument("--seconds", type=float, default=5)
+    pworkers.set_defaults(func=bench_workers)
+
+    pinflight = sub.add_parser(
+        "inflight", help="sync vs asyncio server under many concurrent RPCs"
+    )
+    pinflight.add_argument(
+        "--concurrency", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    pinflight.add_argument(
+        "--mode", choices=["sync", "async"], nargs="+", default=["sync", "async"]
+    )
+    pinflight.add_argument("--channels", type=int, default=8)
+    pinflight.add_argument("--seconds", type=float, default=5)
+    pinflight.set_defaults(func=bench_inflight)
+
+    pclient = sub.add_parser(
+        "client", help="channel per call vs the asyncio client library"
+    )
+    pclient.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 128])
+    pclient.add_argument("--channels", type=int, default=4)
+    pclient.add_argument("--seconds", type=float, default=5)
+    pclient.set_defaults(func=bench_client)
+
+    pprocs = sub.add_parser(
+        "processes", help="RPC throughput vs server worker processes"
+    )
+    pprocs.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    pprocs.add_argument(
+        "--clients", type=int, default=os.cpu_count(), help="client processes"
+    )
+    pprocs.add_argument(
+        "--threads", type=int, default=4, help="connections per client process"
+    )
+    pprocs.add_argument("--seconds", type=float, default=5)
+    pprocs.set_defaults(func=bench_processes)
+
+    plogging = sub.add_parser("logging", help="per-RPC cost of request logging")
+    plogging.add_argument(
+        "--mode",
+        choices=list(LOGGING_MODES),
+        nargs="+",
+        default=list(LOGGING_MODES),
+    )
+    plogging.add_argument("--threads", type=int, default=4)
+    plogging.add_argument("--seconds", type=float, default=3)
+    plogging.add_argument(
+        "--sink-latency",
+        type=float,
+        default=0,
+        help="seconds each log write takes (default: %(default)s)",
+    )
+    plogging.set_defaults(func=bench_logging)
+
+    pmetrics = sub.add_parser("metrics", help="per-RPC cost of the metrics interceptor")
+    pmetrics.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    pmetrics.add_argument("--seconds", type=float, default=3)
+    pmetrics.add_argument("--scrape-interval", type=float, default=0.1)
+    pmetrics.set_defaults(func=bench_metrics)
+
+    pprofile = sub.add_parser("profile", help="per-RPC cost of the profiler")
+    pprofile.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    pprofile.add_argument("--seconds", type=float, default=5)
+    pprofile.add_argument(
+        "--interval-ms", type=float, default=10, help="stack sampling interval"
+    )
+    pprofile.set_defaults(func=bench_profile)
+
+    pcapture = sub.add_parser("capture", help="per-RPC cost of traffic capture")
+    pcapture.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    pcapture.add_argument("--seconds", type=float, default=5)
+    pcapture.add_argument("--dir", help="where to write the trace (default: $TMPDIR)")
+    pcapture.set_defaults(func=bench_capture)
+
+    pwatch = sub.add_parser(
+        "watch", help="mutation cost of the change feed, and watcher lag"
+    )
+    pwatch.add_argument(
+        "--watchers", type=int, nargs="+", default=[0, 1, 8], help="fast watchers"
+    )
+    pwatch.add_argument(
+        "--slow", type=int, default=2, help="slow watchers, added to the most fast"
+    )
+    pwatch.add_argument(
+        "--slow-ms", type=float, default=50, help="time a slow watcher takes per batch"
+    )
+    pwatch.add_argument("--buffer", type=int, default=100000, help="changes held")
+    pwatch.add_argument("--threads", type=int, default=4, help="mutating threads")
+    pwatch.add_argument("--seconds", type=float, default=3)
+    pwatch.set_defaults(func=bench_watch)
+
+    pmemory = sub.add_parser("memory", help="resident bytes per bucket")
+    pmemory.add_argument(
+        "--buckets", type=int, nargs="+", default=[1000000, 10000000]
+    )
+    pmemory.add_argument("--clusters", type=int, default=8)
+    pmemory.add_argument("--owners", type=int, default=1000)
+    pmemory.set_defaults(func=bench_memory)
+
+    preconcile = sub.add_parser("reconcile", help="Reconcile bytes and time")
+    preconcile.add_argument("--buckets", type=int, default=1000000)
+    preconcile.add_argument(
+        "--divergence", type=float, nargs="+", default=[0, 0.0001, 0.001, 0.01]
+    )
+    preconcile.set_defaults(func=bench_reconcile)
+
+    plist = sub.add_parser("list", help="indexed listing vs full scan")
+    plist.add_argument("--buckets", type=int, default=1000000)
+    plist.add_argument("--clusters", type=int, default=8)
+    plist.add_argument("--owners", type=int, default=10000)
+    plist.set_defaults(func=bench_list)
+
+    pnames = sub.add_parser(
+        "names", help="ordered name index insert cost and prefix query latency"
+    )
+    pnames.add_argument(
+        "--names", type=int, nargs="+", default=[1000000, 10000000]
+    )
+    pnames.add_argument("--queries", type=int, default=1000, help="queries per row")
+    pnames.add_argument("--page", type=int, default=1000, help="names per query")
+    pnames.set_defaults(func=bench_names)
+
+    preads = sub.add_parser("reads", help="lock-free lookups mixed with writes")
+    preads.add_argument(
+        "--read-fraction", type=float, nargs="+", default=[0.95, 0.99]
+    )
+    preads.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    preads.add_argument("--buckets", type=int, default=100000)
+    preads.add_argument("--shards", type=int, default=16)
+    preads.add_argument("--seconds", type=float, default=3)
+    preads.set_defaults(func=bench_reads)
+
+    poverload = sub.add_parser(
+        "overload", help="latency past saturation, with and without admission control"
+    )
+    poverload.add_argument(
+        "--rate",
+        type=int,
+        nargs="+",
+        default=[300, 600, 1200],
+        help="calls started per second",
+    )
+    poverload.add_argument(
+        "--deadline", type=float, default=0.5, help="per-call deadline, seconds"
+    )
+    poverload.add_argument("--max-concurrent-rpcs", type=int, default=64)
+    poverload.add_argument("--max-workers", type=int, default=10)
+    poverload.add_argument(
+        "--wal-sync", choices=[m.value for m in SyncMode], default="group"
+    )
+    poverload.add_argument("--channels", type=int, default=8)
+    poverload.add_argument(
+        "--server-nice", type=int, default=0, help="lower the server's priority by this"
+    )
+    poverload.add_argument("--seconds", type=float, default=5)
+    poverload.add_argument(
+        "--dir", help="parent directory for the log (default: $TMPDIR)"
+    )
+    poverload.set_defaults(func=bench_overload)
+
+    pfair = sub.add_parser(
+        "fairness", help="well-behaved clusters' latency beside an aggressive one"
+    )
+    pfair.add_argument(
+        "--mode",
+        choices=["none", "rate", "fair", "both"],
+        nargs="+",
+        default=["none", "rate", "fair", "both"],
+    )
+    pfair.add_argument("--polite", type=int, default=4, help="well-behaved clusters")
+    pfair.add_argument(
+        "--polite-rate", type=float, default=25, help="calls/sec per polite cluster"
+    )
+    pfair.add_argument(
+        "--aggressor", type=int, default=32, help="aggressive calls in flight"
+    )
+    pfair.add_argument(
+        "--cluster-rate", type=float, default=100, help="per-cluster limit"
+    )
+    pfair.add_argument("--fair-slots", type=int, default=6)
+    pfair.add_argument("--fair-queue-depth", type=int, default=2)
+    pfair.add_argument(
+        "--aggressor-nice", type=int, default=10, help="lower its priority by this"
+    )
+    pfair.add_argument("--deadline", type=float, default=2, help="per-call deadline")
+    pfair.add_argument("--max-workers", type=int, default=10)
+    pfair.add_argument(
+        "--wal-sync", choices=[m.value for m in SyncMode], default="group"
+    )
+    pfair.add_argument("--channels", type=int, default=8)
+    pfair.add_argument(
+        "--server-nice", type=int, default=0, help="lower the server's priority by this"
+    )
+    pfair.add_argument("--seconds", type=float, default=5)
+    pfair.add_argument("--dir", help="parent directory for the log (default: $TMPDIR)")
+    pfair.set_defaults(func=bench_fairness)
+
+    pstartup = sub.add_parser(
+        "startup", help="time to serve from a snapshot, JSON vs memory-mapped"
+    )
+    pstartup.add_argument(
+        "--buckets", type=int, nargs="+", default=[1000000, 10000000]
+    )
+    pstartup.add_argument(
+        "--format", choices=["json", "mmap"], nargs="+", default=["json", "mmap"]
+    )
+    pstartup.add_argument("--clusters", type=int, default=8)
+    pstartup.add_argument("--owners", type=int, default=10000)
+    pstartup.add_argument(
+        "--timeout", type=float, default=3600, help="give up on a startup after this"
+    )
+    pstartup.add_argument(
+        "--dir", help="parent directory for the snapshots (default: $TMPDIR)"
+    )
+    pstartup.set_defaults(func=bench_startup)
+
+    ptomb = sub.add_parser(
+        "tombstones", help="create/destroy churn with tombstones retained"
+    )
+    ptomb.add_argument(
+        "--retention",
+        type=float,
+        nargs="+",
+        default=[0, 5, float("inf")],
+        help="seconds tombstones are kept; inf to never purge them",
+    )
+    ptomb.add_argument("--threads", type=int, default=8)
+    ptomb.add_argument("--seconds", type=float, default=20)
+    ptomb.set_defaults(func=bench_tombstones)
+
+    args = p.parse_args(argv)
+    # Request logging is not what we're measuring, except in `logging`.
+    logging.basicConfig(level=logging.CRITICAL)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
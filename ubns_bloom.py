@@ -0,0 +1,75 @@
+"""
+Counting Bloom filter of bucket names.
+
+A disk-backed table pays a lookup to find out that a name isn't there, and
+most creates are for names that aren't. A Bloom filter in memory answers
+"certainly not there" for almost all of those without touching the disk,
+and "maybe" otherwise, in which case the table is asked. Buckets are
+deleted as well as added, so it's a counting filter: each slot is a counter
+rather than a bit, and removing a name decrements what adding it
+incremented.
+
+With the default 1% false-positive rate, that's about 9.6 slots and 7
+hashes per name, at one byte per slot.
+"""
+
+import hashlib
+import math
+
+_SATURATED = 255
+
+
+class CountingBloomFilter:
+    """
+    A multiset of names that can say for certain that a name isn't in it.
+    A counter that reaches 255 stays there, as it no longer knows how many
+    names share it; that only costs some precision.
+    """
+
+    def __init__(self, capacity: int, fp_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.slots = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.slots / capacity * math.log(2)))
+        self.counters = bytearray(self.slots)
+        self.count = 0
+        # A create probes the same name several times before adding it.
+        self._last = (None, None)
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, name: str):
+        last_name, positions = self._last
+        if name == last_name:
+            return positions
+        # Double hashing: k positions from two halves of one digest.
+        digest = hashlib.blake2b(name.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        positions = [(h1 + i * h2) % self.slots for i in range(self.hashes)]
+        self._last = (name, positions)
+        return positions
+
+    def add(self, name: str):
+        counters = self.counters
+        for p in self._positions(name):
+            if counters[p] != _SATURATED:
+                counters[p] += 1
+        self.count += 1
+
+    def remove(self, name: str):
+        """Remove a name that was added."""
+        counters = self.counters
+        for p in self._positions(name):
+            if counters[p] != _SATURATED:
+                counters[p] -= 1
+        self.count -= 1
+
+    def __contains__(self, name: str) -> bool:
+        counters = self.counters
+        for p in self._positions(name):
+            if not counters[p]:
+                return False
+        return True
@@ -0,0 +1,349 @@
+"""
+Traffic capture for the UBNS server, for replay against another build.
+
+While a capture runs, every unary RPC the server is sent is recorded to a
+trace file: its method, the request as it was serialized on the wire, when
+it arrived, its deadline and request ID, and the code and time it finished
+with. `ubns_client.py replay` sends a trace back to a server at the pace it
+was captured, or faster, and compares the results. Streams aren't captured,
+nor are calls one worker forwards to another (the worker they were sent to
+captures them).
+
+Nothing here runs until a capture starts, so an idle server pays one
+attribute check per RPC. While one runs, an RPC thread only appends a tuple
+to a queue; a writer thread serializes and writes the queue out every
+FLUSH_INTERVAL seconds. If the writer falls MAX_PENDING calls behind, any
+more are dropped and counted rather than slowing the server down.
+
+A trace is MAGIC and the capture's start time as a little-endian double of
+Unix time, then records, each a kind byte:
+
+- b"M": a method name, which later calls refer to by number: the number
+  (a byte), the name's length (a byte) and the name.
+- b"C": a call: the header CALL (method number; arrival, microseconds after
+  the start; duration and deadline in microseconds, 0 for no deadline;
+  status code; request ID length; request length), the request ID and the
+  request.
+
+Calls are written as they finish, so they aren't quite in order of arrival.
+"""
+
+import collections
+import grpc
+import logging
+import struct
+import threading
+import time
+
+from ubdb.v1 import ubdb_pb2
+from ubns_dedup import REQUEST_ID_METADATA
+from ubns_partition import is_forwarded
+
+MAGIC = b"UBNSCAP\x01"
+HEADER = struct.Struct("<d")
+METHOD = struct.Struct("<BB")
+CALL = struct.Struct("<BQIIBHI")
+FLUSH_INTERVAL = 0.05
+MAX_PENDING = 100000
+
+# Microsecond fields are clipped to what fits in them: about 71 minutes.
+_MAX_US = 2**32 - 1
+_CODES = {code.value[0]: code for code in grpc.StatusCode}
+_SERVICE = ubdb_pb2.DESCRIPTOR.services_by_name["UBDBService"]
+
+TracedCall = collections.namedtuple(
+    "TracedCall", "method arrival duration deadline code request_id request"
+)
+TracedCall.__doc__ = """
+One captured call. arrival is seconds after the capture started, duration
+and deadline are seconds (deadline None if there wasn't one), code is a
+grpc.StatusCode, request_id a str (empty if none) and request the
+serialized request.
+"""
+
+
+class CaptureBusyError(Exception):
+    """A capture is already running."""
+
+
+class TraceFormatError(Exception):
+    """A file that isn't a trace, or is cut short."""
+
+
+def decode_request(method: str, data: bytes):
+    """The request message of a call to `method`, from its serialized form."""
+    input_type = _SERVICE.methods_by_name[method].input_type
+    return getattr(ubdb_pb2, input_type.name).FromString(data)
+
+
+class TraceReader:
+    """
+    The calls in a trace file, in the order they were written. start is the
+    capture's start time, as Unix time.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        head = f.read(len(MAGIC) + HEADER.size)
+        if len(head) < len(MAGIC) + HEADER.size or not head.startswith(MAGIC):
+            raise TraceFormatError("not a UBNS trace")
+        (self.start,) = HEADER.unpack_from(head, len(MAGIC))
+
+    def _read(self, n: int) -> bytes:
+        data = self.f.read(n)
+        if len(data) < n:
+            raise TraceFormatError("trace cut short")
+        return data
+
+    def __iter__(self):
+        methods = {}
+        while kind := self.f.read(1):
+            if kind == b"M":
+                number, length = METHOD.unpack(self._read(METHOD.size))
+                methods[number] = self._read(length).decode()
+            elif kind == b"C":
+                number, arrival, duration, deadline, code, id_length, length = (
+                    CALL.unpack(self._read(CALL.size))
+                )
+                yield TracedCall(
+                    methods[number],
+                    arrival / 1e6,
+                    duration / 1e6,
+                    deadline / 1e6 if deadline else None,
+                    _CODES.get(code, grpc.StatusCode.UNKNOWN),
+                    self._read(id_length).decode(),
+                    self._read(length),
+                )
+            else:
+                raise TraceFormatError(f"unknown record kind {kind!r}")
+
+
+class _Recording:
+    """One capture in progress, writing to a binary file."""
+
+    def __init__(self, f):
+        self.f = f
+        self.start = time.monotonic()
+        self.pending = collections.deque()
+        self.calls = 0
+        self.dropped = 0
+        self._methods = {}
+        self._drop_lock = threading.Lock()
+        self._stopped = threading.Event()
+        f.write(MAGIC + HEADER.pack(time.time()))
+        self._writer = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._writer.start()
+
+    def add(self, method, request, metadata, arrival, deadline, duration, code):
+        """Queue a finished call to be written. Called on the RPC's thread."""
+        if len(self.pending) >= MAX_PENDING:
+            with self._drop_lock:
+                self.dropped += 1
+            return
+        self.pending.append(
+            (method, request, metadata, arrival, deadline, duration, code)
+        )
+
+    def _encode(self, method, request, metadata, arrival, deadline, duration, code):
+        number = self._methods.get(method)
+        prefix = b""
+        if number is None:
+            number = self._methods[method] = len(self._methods)
+            name = method.encode()
+            prefix = b"M" + METHOD.pack(number, len(name)) + name
+        request_id = b""
+        for k, v in metadata or ():
+            if k == REQUEST_ID_METADATA:
+                request_id = v.encode()[:65535]
+        data = request.SerializeToString()
+        return b"".join(
+            (
+                prefix,
+                b"C",
+                CALL.pack(
+                    number,
+                    max(0, int((arrival - self.start) * 1e6)),
+                    min(_MAX_US, int(duration * 1e6)),
+                    0 if deadline is None else min(_MAX_US, max(1, int(deadline * 1e6))),
+                    code.value[0],
+                    len(request_id),
+                    len(data),
+                ),
+                request_id,
+                data,
+            )
+        )
+
+    def _drain(self):
+        pending, encode = self.pending, self._encode
+        records = []
+        while pending:
+            records.append(encode(*pending.popleft()))
+        if records:
+            self.f.write(b"".join(records))
+            self.calls += len(records)
+        # So that a server that's killed leaves a trace that can be read.
+        self.f.flush()
+
+    def _run(self):
+        while not self._stopped.wait(FLUSH_INTERVAL):
+            self._drain()
+        self._drain()
+
+    def stop(self):
+        """Write out what's queued, and stop. Calls still running are lost."""
+        self._stopped.set()
+        self._writer.join()
+
+
+class Capture:
+    """
+    Captures for one server process. Put its interceptor outermost on the
+    server, so that calls refused by admission control are captured too.
+    """
+
+    def __init__(self):
+        # The capture in progress, if any; read by the interceptors.
+        self.recording = None
+        self._lock = threading.Lock()
+
+    def start(self, f):
+        """Start capturing to the binary file f."""
+        with self._lock:
+            if self.recording is not None:
+                raise CaptureBusyError("a traffic capture is already running")
+            self.recording = _Recording(f)
+
+    def stop(self):
+        """Finish the capture in progress. Returns (calls, dropped)."""
+        with self._lock:
+            recording, self.recording = self.recording, None
+        if recording is None:
+            return 0, 0
+        recording.stop()
+        if recording.dropped:
+            logging.warning(
+                "capture: dropped %d calls the writer couldn't keep up with",
+                recording.dropped,
+            )
+        return recording.calls, recording.dropped
+
+    def record(self, f, seconds: float):
+        """Capture to f for `seconds`, from this thread. Returns (calls, dropped)."""
+        self.start(f)
+        try:
+            time.sleep(seconds)
+        finally:
+            result = self.stop()
+        return result
+
+
+def _code(context) -> grpc.StatusCode:
+    return context.code() or grpc.StatusCode.OK
+
+
+def _raised_code(context) -> grpc.StatusCode:
+    return context.code() or grpc.StatusCode.UNKNOWN
+
+
+def _wrap_handler(handler, method: str, recording, wrap_unary):
+    # Only unary calls are captured; streams pass through.
+    if handler is None or handler.unary_unary is None:
+        return handler
+    return grpc.unary_unary_rpc_method_handler(
+        wrap_unary(handler.unary_unary, method, recording),
+        request_deserializer=handler.request_deserializer,
+        response_serializer=handler.response_serializer,
+    )
+
+
+def _captured_unary(behavior, method, recording):
+    def wrapper(request, context):
+        if is_forwarded(context):
+            return behavior(request, context)
+        arrival = time.monotonic()
+        deadline = context.time_remaining()
+        code = grpc.StatusCode.UNKNOWN
+        try:
+            response = behavior(request, context)
+            code = _code(context)
+            return response
+        except BaseException:
+            code = _raised_code(context)
+            raise
+        finally:
+            recording.add(
+                method,
+                request,
+                context.invocation_metadata(),
+                arrival,
+                deadline,
+                time.monotonic() - arrival,
+                code,
+            )
+
+    return wrapper
+
+
+def _captured_unary_async(behavior, method, recording):
+    async def wrapper(request, context):
+        if is_forwarded(context):
+            return await behavior(request, context)
+        arrival = time.monotonic()
+        deadline = context.time_remaining()
+        code = grpc.StatusCode.UNKNOWN
+        try:
+            response = await behavior(request, context)
+            code = _code(context)
+            return response
+        except BaseException:
+            code = _raised_code(context)
+            raise
+        finally:
+            recording.add(
+                method,
+                request,
+                context.invocation_metadata(),
+                arrival,
+                deadline,
+                time.monotonic() - arrival,
+                code,
+            )
+
+    return wrapper
+
+
+class CaptureInterceptor(grpc.ServerInterceptor):
+    """Captures unary RPCs on a thread-pool server while a capture runs."""
+
+    def __init__(self, capture: Capture):
+        self.capture = capture
+
+    def intercept_service(self, continuation, handler_call_details):
+        recording = self.capture.recording
+        if recording is None:
+            return continuation(handler_call_details)
+        return _wrap_handler(
+            continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            recording,
+            _captured_unary,
+        )
+
+
+class AsyncCaptureInterceptor(grpc.aio.ServerInterceptor):
+    """Captures unary RPCs on a grpc.aio server while a capture runs."""
+
+    def __init__(self, capture: Capture):
+        self.capture = capture
+
+    async def intercept_service(self, continuation, handler_call_details):
+        recording = self.capture.recording
+        if recording is None:
+            return await continuation(handler_call_details)
+        return _wrap_handler(
+            await continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            recording,
+            _captured_unary_async,
+        )
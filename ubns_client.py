@@ -1,113 +1,723 @@
 #!/usr/bin/env python3
 """
-Simple test client for the AuthService gRPC protocol.
+Simple test client for the AuthService gRPC protocol, over the
+ubns_aioclient library.
 """
 
 import argparse
-import base64
-from google.rpc import code_pb2
-from google.rpc import error_details_pb2
-from google.rpc import status_pb2
+import asyncio
+import collections
 import grpc
-from grpc_status import rpc_status
+import itertools
+import json
 import logging
+import math
 import os
+import random
 import sys
+import time
 
-from ubdb.v1 import ubdb_pb2_grpc
 from ubdb.v1 import ubdb_pb2
+from ubns_aioclient import UPDATE_STATES, UBNSClient, UBNSError
+from ubns_capture import TraceFormatError, TraceReader, decode_request
 
 
-def unpack_grpc_error(e: grpc.RpcError):
-    status = rpc_status.from_call(e)
-    if status is None:
-        logging.error(f"RPC failed: {e}")
-    else:
+def log_error(e: UBNSError):
+    logging.error(f"RPC failed: code={e.code.value[0]} ({e.code.name}) message='{e.details}'")
+    if e.s3_error is not None:
+        tstr = ubdb_pb2.S3ErrorDetails.Type.DESCRIPTOR.values_by_number[
+            e.s3_error.type
+        ].name  # String form of the S3 error type.
         logging.error(
-            f"RPC failed: error={e} code={status.code} message='{status.details}'"
+            f"S3ErrorDetails: type={tstr} http_status_code={e.s3_error.http_status_code}"
         )
-        for detail in status.details:
-            # Unpack the ANY if it's a specific type.
-            if detail.Is(ubdb_pb2.S3ErrorDetails.DESCRIPTOR):
-                s3_error = ubdb_pb2.S3ErrorDetails()
-                detail.Unpack(s3_error)
-                tstr = ubdb_pb2.S3ErrorDetails.Type.DESCRIPTOR.values_by_number[
-                    s3_error.type
-                ].name  # String form of the S3 error type.
-                logging.error(
-                    f"S3ErrorDetails: type={tstr} http_status_code={s3_error.http_status_code}"
-                )
-
+    if e.retry_after is not None:
+        logging.error(f"RetryInfo: retry_delay={e.retry_after:.3f}s")
 
-def add(stub: ubdb_pb2_grpc.UBDBServiceStub, args):
-    req = ubdb_pb2.AddBucketEntryRequest()
-    req.bucket = args.bucket
-    req.owner = args.owner
-    req.cluster = args.cluster
 
+async def _mutate(call, args, *extra):
     try:
-        response: ubdb_pb2.AddBucketResponse = stub.AddBucketEntry(req)
+        response = await call(
+            args.bucket, args.cluster, args.owner, *extra, request_id=args.request_id
+        )
         logging.info(f"server response: {response}")
         return True
 
-    except grpc.RpcError as e:
-        unpack_grpc_error(e)
+    except UBNSError as e:
+        log_error(e)
+        return False
+
+
+async def add(client: UBNSClient, args):
+    return await _mutate(client.add, args)
+
+
+async def delete(client: UBNSClient, args):
+    return await _mutate(client.delete, args)
+
+
+async def create(client: UBNSClient, args):
+    return await _mutate(client.create, args)
+
+
+async def destroy(client: UBNSClient, args):
+    return await _mutate(client.destroy, args)
+
+
+async def update(client: UBNSClient, args):
+    if args.update_state not in UPDATE_STATES:
+        logging.error(f"Unknown state '{args.update_state}'")
         return False
+    return await _mutate(client.update, args, args.update_state)
 
 
-def delete(stub: ubdb_pb2_grpc.UBDBServiceStub, args):
-    req = ubdb_pb2.DeleteBucketEntryRequest()
-    req.bucket = args.bucket
-    req.cluster = args.cluster
-    req.owner = args.owner
+def _print_entry(entry: ubdb_pb2.BucketEntry):
+    state = ubdb_pb2.BucketState.Name(entry.state)
+    print(f"{entry.bucket} {entry.cluster} {entry.owner} {state}")
+
+
+def _read_names_file(path):
+    """Yield the bucket names in a file, one per line, skipping blanks and '#'."""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+async def get(client: UBNSClient, args):
+    cluster, owner = args.cluster or "", args.owner or ""
+    if not args.file:
+        try:
+            _print_entry(await client.get(args.bucket, cluster, owner))
+            return True
+
+        except UBNSError as e:
+            log_error(e)
+            return False
+
+    # Many buckets, --batch-size per call.
+    names = list(_read_names_file(args.file))
     try:
-        response: ubdb_pb2.DeleteBucketResponse = stub.DeleteBucketEntry(req)
-        logging.info(f"server response: {response}")
-        return True
+        results = await client.get_many(names, cluster, owner, args.batch_size)
+    except UBNSError as e:
+        log_error(e)
+        return False
+    failed = 0
+    for name, result in zip(names, results):
+        if isinstance(result, UBNSError):
+            failed += 1
+            logging.error(f"{name}: {result.code.name}: {result.details}")
+        else:
+            _print_entry(result)
+    return failed == 0
 
-    except grpc.RpcError as e:
-        unpack_grpc_error(e)
+
+def _read_batch_file(path):
+    """
+    Yield (line number, BucketEntryOperation) for each entry in a batch
+    file. Each line is one of::
+
+        add <bucket> <cluster> <owner>
+        update <bucket> <cluster> <owner> created|deleting
+        delete <bucket> <cluster> <owner>
+        create <bucket> <cluster> <owner>
+        destroy <bucket> <cluster> <owner>
+
+    Blank lines and lines starting with '#' are ignored.
+    """
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            op = ubdb_pb2.BucketEntryOperation()
+            if fields[0] == "add" and len(fields) == 4:
+                entry = op.add_entry
+            elif fields[0] == "delete" and len(fields) == 4:
+                entry = op.delete_entry
+            elif fields[0] == "create" and len(fields) == 4:
+                entry = op.create_entry
+            elif fields[0] == "destroy" and len(fields) == 4:
+                entry = op.destroy_entry
+            elif fields[0] == "update" and len(fields) == 5:
+                entry = op.update_entry
+                if fields[4] in UPDATE_STATES:
+                    entry.state = UPDATE_STATES[fields[4]]
+                else:
+                    raise ValueError(f"{path}:{lineno}: unknown state '{fields[4]}'")
+            else:
+                raise ValueError(f"{path}:{lineno}: can't parse '{line.strip()}'")
+            entry.bucket, entry.cluster, entry.owner = fields[1:4]
+            yield lineno, op
+
+
+async def batch(client: UBNSClient, args):
+    # Line numbers of the operations sent, so results can be reported
+    # against the file. Results come back in request order.
+    sent = collections.deque()
+
+    def operations():
+        for lineno, op in _read_batch_file(args.file):
+            sent.append(lineno)
+            yield op
+
+    total = failed = 0
+    try:
+        async for error in client.batch(operations(), args.batch_size):
+            lineno = sent.popleft()
+            total += 1
+            if error is not None:
+                failed += 1
+                logging.error(f"{args.file}:{lineno}: {error.code.name}: {error.details}")
+    except UBNSError as e:
+        log_error(e)
         return False
 
+    logging.info(f"batch: {total} operations, {failed} failed")
+    return failed == 0
 
-def update(stub: ubdb_pb2_grpc.UBDBServiceStub, args):
-    req = ubdb_pb2.UpdateBucketEntryRequest()
-    req.bucket = args.bucket
-    req.cluster = args.cluster
-    req.owner = args.owner
-    if args.update_state == "created":
-        req.state = ubdb_pb2.BucketState.BUCKET_STATE_CREATED
-    elif args.update_state == "deleting":
-        req.state = ubdb_pb2.BucketState.BUCKET_STATE_DELETING
-    else:
-        logging.error(f"Unknown state '{args.state}'")
+
+def _read_reconcile_file(path):
+    """
+    Yield (bucket, owner) for each line of a cluster's bucket list, which
+    has one `<bucket> <owner>` pair per line. Blank lines and lines starting
+    with '#' are ignored.
+    """
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) != 2:
+                raise ValueError(f"{path}:{lineno}: can't parse '{line.strip()}'")
+            yield fields[0], fields[1]
+
+
+async def reconcile(client: UBNSClient, args):
+    try:
+        result = await client.reconcile(args.cluster, _read_reconcile_file(args.file))
+    except UBNSError as e:
+        log_error(e)
         return False
 
+    for bucket, owner in result.missing_from_ubdb:
+        print(f"missing-from-ubdb {bucket} {owner}")
+    for bucket, owner in result.missing_from_cluster:
+        print(f"missing-from-cluster {bucket} {owner}")
+    for bucket, owner, ubdb_owner in result.owner_mismatch:
+        print(f"owner-mismatch {bucket} {owner} {ubdb_owner}")
+    logging.info(
+        f"reconcile: {len(result.missing_from_ubdb)} missing from UBDB, "
+        f"{len(result.missing_from_cluster)} missing from cluster, "
+        f"{len(result.owner_mismatch)} owner mismatches; "
+        f"{result.calls} calls, {result.bytes_sent} bytes sent, {result.bytes_received} received"
+    )
+    return result.in_sync()
+
+
+# Filter values for the list command's --state.
+LIST_STATES = {
+    "creating": ubdb_pb2.BucketState.BUCKET_STATE_CREATING,
+    "created": ubdb_pb2.BucketState.BUCKET_STATE_CREATED,
+    "deleting": ubdb_pb2.BucketState.BUCKET_STATE_DELETING,
+    "deleted": ubdb_pb2.BucketState.BUCKET_STATE_DELETED,
+}
+
+
+async def list_entries(client: UBNSClient, args):
+    pages = client.list_pages(
+        args.cluster or "",
+        args.owner or "",
+        LIST_STATES[args.state] if args.state else 0,
+        args.page_size,
+        args.page_token or "",
+        prefix=args.prefix or "",
+        start_at=args.start_at or "",
+        end_before=args.end_before or "",
+    )
+    listed = 0
     try:
-        response: ubdb_pb2.UpdateBucketEntryResponse = stub.UpdateBucketEntry(req)
-        logging.info(f"server response: {response}")
-        return True
+        async for page in pages:
+            for entry in page.entries:
+                state = ubdb_pb2.BucketState.Name(entry.state)
+                if entry.state == ubdb_pb2.BucketState.BUCKET_STATE_DELETED:
+                    # Tombstones have a deletion sequence number, not an owner.
+                    print(f"{entry.bucket} {entry.cluster} {state} {entry.deleted_seq}")
+                else:
+                    print(f"{entry.bucket} {entry.cluster} {entry.owner} {state}")
+            listed += len(page.entries)
+            if args.limit and listed >= args.limit and page.next_page_token:
+                # Stopping at a page boundary, so the listing can carry on
+                # from here.
+                logging.info(
+                    f"list: stopped; resume with --page-token '{page.next_page_token}'"
+                )
+                break
+    except UBNSError as e:
+        log_error(e)
+        return False
+    finally:
+        await pages.aclose()
+
+    logging.info(f"list: {listed} entries")
+    return True
+
 
-    except grpc.RpcError as e:
-        unpack_grpc_error(e)
+async def watch(client: UBNSClient, args):
+    changes = client.watch(args.cluster or "", args.owner or "", args.after_seq)
+    try:
+        async for response in changes:
+            for change in response.changes:
+                entry = change.entry
+                state = ubdb_pb2.BucketState.Name(entry.state)
+                print(
+                    f"{change.seq} {entry.bucket} {entry.cluster} {entry.owner} {state}",
+                    flush=True,
+                )
+            if response.resync:
+                logging.error(
+                    f"watch: changes were lost; re-list, and resume with --after-seq {response.seq}"
+                )
+                return False
+            logging.debug(f"watch: at seq {response.seq}")
+    except UBNSError as e:
+        log_error(e)
         return False
+    finally:
+        await changes.aclose()
+    return True
 
 
-def issue(channel, args):
+async def issue(client: UBNSClient, args):
     """
-    Issue the RPC. Factored out so we can use different types of channel.
+    Issue the RPC.
     """
-    stub = ubdb_pb2_grpc.UBDBServiceStub(channel)
-
     if args.command == "add":
-        success = add(stub, args)
+        success = await add(client, args)
     elif args.command == "delete":
-        success = delete(stub, args)
+        success = await delete(client, args)
     elif args.command == "update":
-        success = update(stub, args)
+        success = await update(client, args)
+    elif args.command == "create":
+        success = await create(client, args)
+    elif args.command == "destroy":
+        success = await destroy(client, args)
+    elif args.command == "batch":
+        success = await batch(client, args)
+    elif args.command == "reconcile":
+        success = await reconcile(client, args)
+    elif args.command == "list":
+        success = await list_entries(client, args)
+    elif args.command == "get":
+        success = await get(client, args)
+    elif args.command == "watch":
+        success = await watch(client, args)
     else:
         logging.error(f"Unknown command '{args.command}'")
         sys.exit(2)
+    return success
+
+
+class LatencyHistogram:
+    """
+    HDR-style log-linear histogram of integer microsecond values.
+
+    Values below 2**SUB_BUCKET_BITS are counted exactly; above that, each
+    power of two is split into 2**(SUB_BUCKET_BITS - 1) equal sub-buckets,
+    so any value is recorded to within 1/64 (about 1.6%) whatever its
+    magnitude. Recording is O(1) and histograms merge by adding counts.
+    """
+
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value: int) -> int:
+        if value < (1 << cls.SUB_BUCKET_BITS):
+            return value
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS
+        return (shift << (cls.SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+    @classmethod
+    def _lowest(cls, index: int) -> int:
+        """Smallest value recorded at index."""
+        half = 1 << (cls.SUB_BUCKET_BITS - 1)
+        if index < (1 << cls.SUB_BUCKET_BITS):
+            return index
+        shift = index // half - 1
+        return (index - shift * half) << shift
+
+    def record(self, seconds: float):
+        value = int(seconds * 1e6)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> int:
+        """Value (in microseconds) at or below which p percent of values fall."""
+        if self.total == 0:
+            return 0
+        rank = max(1, math.ceil(self.total * p / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                # Report the top of the sub-bucket, but never beyond the
+                # largest value actually seen.
+                return min(self._lowest(index + 1) - 1, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """Percentiles in milliseconds."""
+        out = {"count": self.total}
+        if self.total:
+            out["mean"] = round(self.sum / self.total / 1000, 3)
+            for p in (50, 90, 99, 99.9):
+                out[f"p{p}"] = round(self.percentile(p) / 1000, 3)
+            out["max"] = round(self.max / 1000, 3)
+        return out
+
+
+class _BenchStats:
+    """Per-thread results, merged once the run is over."""
+
+    def __init__(self):
+        self.rpcs = collections.defaultdict(LatencyHistogram)
+        self.rpc_codes = collections.defaultdict(collections.Counter)
+        self.lifecycles = collections.defaultdict(LatencyHistogram)
+        self.lifecycle_failures = collections.Counter()
+
+    def merge(self, other: "_BenchStats"):
+        for method, hist in other.rpcs.items():
+            self.rpcs[method].merge(hist)
+        for method, codes in other.rpc_codes.items():
+            self.rpc_codes[method].update(codes)
+        for name, hist in other.lifecycles.items():
+            self.lifecycles[name].merge(hist)
+        self.lifecycle_failures.update(other.lifecycle_failures)
+
+
+# Bench lifecycles: the sequence of calls made against one fresh bucket.
+# "conflict" deliberately adds the same name twice, to exercise the error
+# path. The "one-step" ones use CreateBucketEntry and DestroyBucketEntry.
+BENCH_LIFECYCLES = {
+    "create": ("add", "created"),
+    "full": ("add", "created", "deleting", "delete"),
+    "conflict": ("add", "add"),
+    "one-step-create": ("create",),
+    "one-step-full": ("create", "destroy"),
+}
+
+
+def _parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in BENCH_LIFECYCLES:
+            raise ValueError(
+                f"unknown lifecycle '{name}', expected one of {', '.join(BENCH_LIFECYCLES)}"
+            )
+        weights[name] = float(weight or 1)
+    return weights
+
+
+async def _bench_lifecycle(client, args, stats: _BenchStats, name: str, bucket: str):
+    """Run one lifecycle. Returns False if any step failed."""
+    ok = True
+    for step in BENCH_LIFECYCLES[name]:
+        if step == "add":
+            method, call = "AddBucketEntry", client.add(bucket, args.cluster, args.owner)
+        elif step == "delete":
+            method, call = "DeleteBucketEntry", client.delete(
+                bucket, args.cluster, args.owner
+            )
+        elif step == "create":
+            method, call = "CreateBucketEntry", client.create(
+                bucket, args.cluster, args.owner
+            )
+        elif step == "destroy":
+            method, call = "DestroyBucketEntry", client.destroy(
+                bucket, args.cluster, args.owner
+            )
+        else:
+            method, call = "UpdateBucketEntry", client.update(
+                bucket, args.cluster, args.owner, step
+            )
+        start = time.perf_counter()
+        try:
+            await call
+            code = grpc.StatusCode.OK
+        except UBNSError as e:
+            code = e.code
+        stats.rpcs[method].record(time.perf_counter() - start)
+        stats.rpc_codes[method][code.name] += 1
+        ok = ok and code == grpc.StatusCode.OK
+    return ok
+
+
+async def run_bench(client_factory, args):
+    """
+    Drive a mix of bucket lifecycles at the server and report throughput,
+    latency percentiles and error codes as JSON.
+
+    Without --qps the run is closed-loop: each of --concurrency workers
+    starts a new lifecycle as soon as its last one finishes. With --qps,
+    lifecycles are started on a fixed schedule regardless of how the server
+    is keeping up, and lifecycle latency is measured from the scheduled start
+    so that queueing behind a slow server isn't hidden (coordinated
+    omission). The workers are tasks sharing one client, with --channels
+    connections.
+    """
+    weights = _parse_mix(args.mix)
+    names, cum_weights = list(weights), list(itertools.accumulate(weights.values()))
+    prefix = args.prefix or f"bench-{os.getpid()}-{int(time.time())}"
+    client = client_factory(args.channels, args.timeout)
+    schedule = asyncio.Queue()
+    start = time.perf_counter()
+    end = start + args.duration
+
+    async def scheduler():
+        interval = 1 / args.qps
+        n = 0
+        while True:
+            due = start + n * interval
+            if due >= end:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            schedule.put_nowait(due)
+            n += 1
+        for _ in range(args.concurrency):
+            schedule.put_nowait(None)
+
+    async def worker(w):
+        stats = _BenchStats()
+        rng = random.Random(w)
+        n = 0
+        while True:
+            if args.qps:
+                due = await schedule.get()
+                if due is None:
+                    break
+            else:
+                due = time.perf_counter()
+                if due >= end:
+                    break
+            name = rng.choices(names, cum_weights=cum_weights)[0]
+            ok = await _bench_lifecycle(client, args, stats, name, f"{prefix}-{w}-{n}")
+            stats.lifecycles[name].record(time.perf_counter() - due)
+            if not ok:
+                stats.lifecycle_failures[name] += 1
+            n += 1
+        return stats
+
+    tasks = [worker(w) for w in range(args.concurrency)]
+    if args.qps:
+        tasks.append(scheduler())
+    results = (await asyncio.gather(*tasks))[: args.concurrency]
+    elapsed = time.perf_counter() - start
+    await client.close()
+
+    stats = _BenchStats()
+    for r in results:
+        stats.merge(r)
+    errors = collections.Counter()
+    for codes in stats.rpc_codes.values():
+        errors.update({k: v for k, v in codes.items() if k != "OK"})
+    rpcs = sum(h.total for h in stats.rpcs.values())
+    lifecycles = sum(h.total for h in stats.lifecycles.values())
+    report = {
+        "config": {
+            "concurrency": args.concurrency,
+            "channels": args.channels,
+            "duration": args.duration,
+            "qps": args.qps,
+            "mix": weights,
+        },
+        "elapsed": round(elapsed, 3),
+        "rpcs": rpcs,
+        "rpcs_per_sec": round(rpcs / elapsed, 1),
+        "lifecycles": lifecycles,
+        "lifecycles_per_sec": round(lifecycles / elapsed, 1),
+        "errors": dict(errors),
+        "methods": {
+            method: {
+                "latency_ms": hist.summary(),
+                "codes": dict(stats.rpc_codes[method]),
+            }
+            for method, hist in sorted(stats.rpcs.items())
+        },
+        "lifecycle_latency_ms": {
+            name: dict(hist.summary(), failed=stats.lifecycle_failures[name])
+            for name, hist in sorted(stats.lifecycles.items())
+        },
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return True
+
+
+def _read_traces(paths):
+    """
+    The calls in the traces, as (seconds after the earliest capture
+    started, call) in order of arrival. Traces taken together, such as one
+    from each worker, are lined up by their start times.
+    """
+    traces = []
+    for path in paths:
+        with open(path, "rb") as f:
+            trace = TraceReader(f)
+            calls = []
+            try:
+                calls.extend(trace)
+            except TraceFormatError as e:
+                # As from a server that was killed while capturing.
+                logging.warning(f"replay: {path}: {e}, after {len(calls)} calls")
+            traces.append((trace.start, calls))
+    first = min(start for start, _ in traces)
+    calls = [
+        (start - first + call.arrival, call) for start, calls in traces for call in calls
+    ]
+    calls.sort(key=lambda item: item[0])
+    return calls
+
+
+def _speed(value: str) -> float:
+    return 0.0 if value == "max" else float(value)
+
+
+async def run_replay(client_factory, args):
+    """
+    Send the calls in captured traces to the server, and report how their
+    results and latencies compare with the capture's, as JSON.
+
+    Each call is sent --speed times as soon after the first as it arrived at
+    the server captured, or with --speed max, as soon as one of --concurrency
+    slots is free; it also waits for a slot at any speed, and how late that
+    made calls is reported as schedule_lag_ms. A call on a bucket waits for
+    the call before it on that bucket to finish, so that a lifecycle is
+    applied in the order it was, whatever the speed. A call is sent with the
+    deadline and request ID it had; one that had no deadline gets --timeout.
+    Captured latencies are the server's, from the first interceptor to the
+    last; replayed ones are the client's, so include the network.
+    """
+    try:
+        calls = _read_traces(args.trace)
+    except TraceFormatError as e:
+        logging.error(f"replay: {e}")
+        return False
+    if not calls:
+        logging.error("replay: no calls in the trace")
+        return False
+    client = client_factory(args.channels, args.timeout)
+    slots = asyncio.Semaphore(args.concurrency)
+    running = set()
+    # The last call sent on each bucket that hasn't finished.
+    last = {}
+    captured = collections.defaultdict(LatencyHistogram)
+    replayed = collections.defaultdict(LatencyHistogram)
+    captured_codes = collections.defaultdict(collections.Counter)
+    replayed_codes = collections.defaultdict(collections.Counter)
+    mismatches = collections.defaultdict(collections.Counter)
+    lag = LatencyHistogram()
+
+    async def send(call, request, previous):
+        if previous is not None:
+            await asyncio.wait((previous,))
+        sent = time.perf_counter()
+        try:
+            await client.call(
+                call.method, request, call.deadline, call.request_id or None
+            )
+            code = grpc.StatusCode.OK
+        except UBNSError as e:
+            code = e.code
+        finally:
+            slots.release()
+        replayed[call.method].record(time.perf_counter() - sent)
+        captured[call.method].record(call.duration)
+        replayed_codes[call.method][code.name] += 1
+        captured_codes[call.method][call.code.name] += 1
+        if code != call.code:
+            mismatches[call.method][f"{call.code.name}->{code.name}"] += 1
+
+    def finished(task, bucket):
+        running.discard(task)
+        if last.get(bucket) is task:
+            del last[bucket]
+
+    start, first = time.perf_counter(), calls[0][0]
+    for at, call in calls:
+        due = start + (at - first) / args.speed if args.speed else time.perf_counter()
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await slots.acquire()
+        lag.record(max(0.0, time.perf_counter() - due))
+        request = decode_request(call.method, call.request)
+        bucket = getattr(request, "bucket", "")
+        task = asyncio.ensure_future(send(call, request, last.get(bucket)))
+        running.add(task)
+        if bucket:
+            last[bucket] = task
+        task.add_done_callback(lambda task, bucket=bucket: finished(task, bucket))
+    if running:
+        await asyncio.gather(*running)
+    elapsed = time.perf_counter() - start
+    await client.close()
+
+    diverged = sum(sum(m.values()) for m in mismatches.values())
+    report = {
+        "config": {
+            "traces": args.trace,
+            "speed": args.speed or "max",
+            "concurrency": args.concurrency,
+            "channels": args.channels,
+        },
+        "calls": len(calls),
+        "captured_seconds": round(calls[-1][0] - calls[0][0], 3),
+        "elapsed": round(elapsed, 3),
+        "rpcs_per_sec": round(len(calls) / elapsed, 1),
+        "schedule_lag_ms": lag.summary(),
+        "mismatches": diverged,
+        "methods": {
+            method: {
+                "captured_latency_ms": captured[method].summary(),
+                "replayed_latency_ms": hist.summary(),
+                "captured_codes": dict(captured_codes[method]),
+                "replayed_codes": dict(replayed_codes[method]),
+                "mismatches": dict(mismatches[method]),
+            }
+            for method, hist in sorted(replayed.items())
+        },
+    }
+    if diverged:
+        logging.warning(f"replay: {diverged} calls ended differently than captured")
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return True
 
 
 def _load_credential_from_file(filepath):
@@ -120,9 +730,24 @@ def _load_credential_from_file(filepath):
 def main(argv):
     p = argparse.ArgumentParser(description="AuthService client")
     p.add_argument(
-        "command", help="command to run", choices=["add", "delete", "update"]
+        "command",
+        help="command to run",
+        choices=[
+            "add",
+            "delete",
+            "update",
+            "create",
+            "destroy",
+            "batch",
+            "bench",
+            "replay",
+            "reconcile",
+            "list",
+            "get",
+            "watch",
+        ],
     )
-    p.add_argument("--bucket", help="bucket name", required=True)
+    p.add_argument("--bucket", help="bucket name")
     p.add_argument(
         "-t", "--tls", help="connect to the server using TLS", action="store_true"
     )
@@ -133,12 +758,117 @@ def main(argv):
 
     p.add_argument("-o", "--owner", help="owner of the bucket")
     p.add_argument("-c", "--cluster", help="client cluster ID")
+    p.add_argument(
+        "--prefix",
+        help="bucket name prefix: list only lists buckets whose names start with it, and bench names its buckets with it (default for bench: unique per run)",
+    )
     p.add_argument(
         "-s",
         "--update-state",
         choices=["created", "deleting"],
         help="update state of the bucket",
     )
+    p.add_argument(
+        "--request-id",
+        help="request ID for add, delete, update, create and destroy, so a retry with the same ID gets the first attempt's outcome",
+    )
+    p.add_argument(
+        "-f",
+        "--file",
+        help="file of entries for the batch and reconcile commands, or of bucket names to get",
+    )
+    p.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="operations per batch message (default: %(default)s)",
+    )
+
+    plist = p.add_argument_group(
+        "list arguments",
+        "--cluster, --owner and --prefix also filter the listing",
+    )
+    plist.add_argument(
+        "--state",
+        choices=list(LIST_STATES),
+        help="only list buckets in this state; 'deleted' lists tombstones",
+    )
+    plist.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        help="entries per page (default: %(default)s)",
+    )
+    plist.add_argument("--page-token", help="resume a listing from this token")
+    plist.add_argument("--start-at", help="only list buckets named this or later")
+    plist.add_argument("--end-before", help="only list buckets named before this")
+    plist.add_argument(
+        "--limit",
+        type=int,
+        default=0,
+        help="stop after the page that reaches this many entries (default: no limit)",
+    )
+
+    pwatch = p.add_argument_group(
+        "watch arguments", "--cluster and --owner also filter the changes watched"
+    )
+    pwatch.add_argument(
+        "--after-seq",
+        type=int,
+        default=0,
+        help="resume after the change with this sequence number (default: start with the next change)",
+    )
+
+    pbench = p.add_argument_group("bench arguments")
+    pbench.add_argument(
+        "--duration", type=float, default=10, help="seconds to run (default: %(default)s)"
+    )
+    pbench.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="lifecycles in progress at once (default: %(default)s)",
+    )
+    pbench.add_argument(
+        "--channels",
+        type=int,
+        default=4,
+        help="connections shared by the workers (default: %(default)s)",
+    )
+    pbench.add_argument(
+        "--qps",
+        type=float,
+        default=0,
+        help="start lifecycles at this fixed rate, open-loop (default: closed-loop, as fast as possible)",
+    )
+    pbench.add_argument(
+        "--mix",
+        default="full=1",
+        help="lifecycle weights, from "
+        + ", ".join(BENCH_LIFECYCLES)
+        + " (default: %(default)s)",
+    )
+    pbench.add_argument(
+        "--timeout", type=float, default=10, help="per-RPC deadline in seconds"
+    )
+    pbench.add_argument("--output", help="write the JSON report here, not stdout")
+
+    preplay = p.add_argument_group(
+        "replay arguments",
+        "--concurrency, --channels, --timeout and --output are as for bench",
+    )
+    preplay.add_argument(
+        "--trace",
+        nargs="+",
+        metavar="FILE",
+        help="traces captured by the server (ubns_server.py --capture, or /debug/capture) to send again",
+    )
+    preplay.add_argument(
+        "--speed",
+        type=_speed,
+        default=1,
+        help="send calls this many times faster than they were captured, or 'max' for as fast as --concurrency allows (default: %(default)s)",
+    )
 
     ptls = p.add_argument_group("TLS arguments")
     ptls.add_argument("--ca-cert", help="CA certificate file")
@@ -168,6 +898,20 @@ def main(argv):
     success = False
 
     if args.command:
+        takes_bucket = args.command not in (
+            "batch",
+            "bench",
+            "replay",
+            "reconcile",
+            "list",
+            "watch",
+        )
+        if args.command == "get" and args.file:
+            takes_bucket = False
+        if takes_bucket and not args.bucket:
+            logging.error(f"{args.command} command requires a bucket")
+            sys.exit(1)
+
         if args.command == "add":
             if not args.cluster:
                 logging.error("add command requires a cluster")
@@ -195,18 +939,68 @@ def main(argv):
                 logging.error("update command requires an update state")
                 sys.exit(1)
 
+        elif args.command in ("create", "destroy"):
+            if not args.cluster:
+                logging.error(f"{args.command} command requires a cluster")
+                sys.exit(1)
+            if not args.owner:
+                logging.error(f"{args.command} command requires an owner")
+                sys.exit(1)
+
+        elif args.command == "batch":
+            if not args.file:
+                logging.error("batch command requires a file")
+                sys.exit(1)
+
+        elif args.command == "reconcile":
+            if not args.cluster:
+                logging.error("reconcile command requires a cluster")
+                sys.exit(1)
+            if not args.file:
+                logging.error("reconcile command requires a file")
+                sys.exit(1)
+
+        elif args.command in ("list", "watch"):
+            pass
+
+        elif args.command == "get":
+            # --cluster and --owner are optional: if given, they're checked.
+            pass
+
+        elif args.command == "bench":
+            args.cluster = args.cluster or "bench-cluster"
+            args.owner = args.owner or "bench-owner"
+
+        elif args.command == "replay":
+            if not args.trace:
+                logging.error("replay command requires --trace")
+                sys.exit(1)
+
         else:
             logging.error(f"Unknown command '{args.command}'")
             sys.exit(1)
 
+    channel_credential = None
     if args.tls:
         root_crt = _load_credential_from_file(args.ca_cert)
         channel_credential = grpc.ssl_channel_credentials(root_crt)
-        with grpc.secure_channel(server_address, channel_credential) as channel:
-            issue(channel, args)
-    else:
-        with grpc.insecure_channel(server_address) as channel:
-            issue(channel, args)
+    client_factory = lambda channels=1, timeout=None: UBNSClient(
+        server_address, channels, channel_credential, timeout
+    )
+
+    async def run():
+        if args.command == "bench":
+            return await run_bench(client_factory, args)
+        if args.command == "replay":
+            return await run_replay(client_factory, args)
+        async with client_factory() as client:
+            return await issue(client, args)
+
+    try:
+        success = asyncio.run(run())
+    except KeyboardInterrupt:
+        # The usual way to end a watch.
+        success = args.command == "watch"
 
     if success:
         sys.exit(0)
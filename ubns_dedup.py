@@ -0,0 +1,116 @@
+"""
+Deduplication of retried mutations by request ID.
+
+A client that sends a request ID in the REQUEST_ID_METADATA metadata of a
+mutation gets the same outcome for every retry with that ID as the first
+attempt got, rather than, say, ALREADY_EXISTS for retrying an add that
+succeeded but timed out. A retry that arrives while the first attempt is
+still running waits for it.
+
+Outcomes are kept in a RequestCache: a dict in least-recently-used order,
+bounded in size and with entries expiring after a TTL, so lookups are O(1)
+and memory stays bounded however many IDs are seen.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+REQUEST_ID_METADATA = "ubns-request-id"
+MAX_REQUEST_ID_LENGTH = 128
+
+
+class RequestIdReusedError(Exception):
+    def __init__(self, request_id):
+        super().__init__(
+            f"request ID '{request_id}' was already used for a different request"
+        )
+
+
+class RequestIdTooLongError(Exception):
+    def __init__(self):
+        super().__init__(f"request ID is over {MAX_REQUEST_ID_LENGTH} characters")
+
+
+def request_id_of(context) -> str:
+    """The request ID in an RPC's metadata, or None."""
+    for k, v in context.invocation_metadata():
+        if k == REQUEST_ID_METADATA:
+            if len(v) > MAX_REQUEST_ID_LENGTH:
+                raise RequestIdTooLongError()
+            return v
+    return None
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "outcome", "expires")
+
+    def __init__(self, fingerprint: int, expires: float):
+        self.fingerprint = fingerprint
+        # Resolved with the first attempt's outcome when it finishes. It's
+        # marked running so that a waiter giving up can't cancel it.
+        self.outcome = Future()
+        self.outcome.set_running_or_notify_cancel()
+        self.expires = expires
+
+
+class RequestCache:
+    """Outcomes of recent requests, by (method, request ID)."""
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def begin(self, method: str, request_id: str, request) -> tuple[Future, bool]:
+        """
+        Look up a request. Returns the Future of its outcome and whether
+        this is the first attempt, in which case the caller must run it and
+        then call finish(). Otherwise the Future resolves to the first
+        attempt's outcome, if it hasn't already.
+        """
+        key = (method, request_id)
+        fingerprint = hash(request.SerializeToString(deterministic=True))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires < now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    raise RequestIdReusedError(request_id)
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry.outcome, False
+
+            self.misses += 1
+            entry = self._entries[key] = _Entry(fingerprint, now + self.ttl)
+            # Make room, dropping expired entries from the cold end as we go.
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if len(self._entries) <= self.max_entries and oldest.expires >= now:
+                    break
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return entry.outcome, True
+
+    def finish(self, method: str, request_id: str, future: Future, outcome, keep=True):
+        """
+        Record the first attempt's outcome. With keep=False, it is handed
+        to any retries already waiting, but later ones run afresh.
+        """
+        if not keep:
+            with self._lock:
+                entry = self._entries.get((method, request_id))
+                if entry is not None and entry.outcome is future:
+                    del self._entries[(method, request_id)]
+        future.set_result(outcome)
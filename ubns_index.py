@@ -0,0 +1,199 @@
+"""
+Secondary indexes over the UBNS bucket table.
+
+Each index maps a key (a cluster, an owner or a state) to the bucket names
+with that key, kept sorted so they can be paged through by name: a page is
+"the next n names after the last one returned", which stays correct however
+the table changes between pages. A page can be bounded by name too, which
+is how a listing of the names with a prefix, or in a range, finds them
+without looking at any others.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+import sys
+import threading
+
+
+def prefix_end(prefix: str) -> str:
+    """
+    The first name after every name starting with prefix, or None if there
+    isn't one (an empty prefix, or one of all sys.maxunicode).
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    last = ord(prefix[-1]) + 1
+    if 0xD800 <= last < 0xE000:
+        # Surrogates can't be names (they don't encode), so skip over them.
+        last = 0xE000
+    return prefix[:-1] + chr(last)
+
+
+class SortedNames:
+    """
+    A sorted set of names, as a list of sorted blocks of at most 2 * LOAD
+    names each, so inserting or removing only moves one block's worth of
+    references rather than the whole set's.
+    """
+
+    LOAD = 1000
+
+    __slots__ = ("_blocks", "_maxes", "_len")
+
+    def __init__(self):
+        self._blocks: list[list[str]] = []
+        # The last (largest) name of each block.
+        self._maxes: list[str] = []
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def add(self, name: str):
+        if not self._blocks:
+            self._blocks.append([name])
+            self._maxes.append(name)
+        else:
+            i = bisect_left(self._maxes, name)
+            if i == len(self._maxes):
+                i -= 1
+                self._blocks[i].append(name)
+                self._maxes[i] = name
+            else:
+                insort(self._blocks[i], name)
+            block = self._blocks[i]
+            if len(block) > 2 * self.LOAD:
+                self._blocks[i : i + 1] = [block[: self.LOAD], block[self.LOAD :]]
+                self._maxes[i : i + 1] = [block[self.LOAD - 1], block[-1]]
+        self._len += 1
+
+    def remove(self, name: str):
+        i = bisect_left(self._maxes, name)
+        block = self._blocks[i]
+        del block[bisect_left(block, name)]
+        if block:
+            self._maxes[i] = block[-1]
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+        self._len -= 1
+
+    def after(
+        self, name: str, n: int, end: str = None, inclusive: bool = False
+    ) -> list[str]:
+        """
+        Up to n names greater than `name`, or not less if inclusive, and
+        less than `end` if it's set, in order. Takes O(log len + n).
+        """
+        find = bisect_left if inclusive else bisect_right
+        blocks, maxes = self._blocks, self._maxes
+        i = find(maxes, name)
+        if i == len(blocks):
+            return []
+        j = find(blocks[i], name)
+        names = []
+        while len(names) < n and i < len(blocks):
+            block = blocks[i]
+            stop = j + n - len(names)
+            if end is not None and maxes[i] >= end:
+                # The last block with any names before end.
+                names.extend(block[j : min(stop, bisect_left(block, end, j))])
+                break
+            names.extend(block[j:stop])
+            i, j = i + 1, 0
+        return names
+
+
+class BucketIndex:
+    """
+    Bucket names by cluster, by owner and by state, plus all of them, in
+    name order.
+
+    Mutations update the index while holding the bucket's shard lock, then
+    this index's own lock, so an index update can't be seen apart from its
+    table update by anyone going through the shard. Readers must not hold
+    a shard lock when they call in here, and should re-check whatever they
+    read from the table, since it may have changed by then.
+    """
+
+    def __init__(self, states):
+        self.lock = threading.Lock()
+        self.all = SortedNames()
+        self.by_cluster: dict[str, SortedNames] = {}
+        self.by_owner: dict[str, SortedNames] = {}
+        self.by_state = {state: SortedNames() for state in states}
+
+    @staticmethod
+    def _add(index: dict, key, name: str):
+        names = index.get(key)
+        if names is None:
+            names = index[key] = SortedNames()
+        names.add(name)
+
+    @staticmethod
+    def _remove(index: dict, key, name: str):
+        names = index[key]
+        names.remove(name)
+        if not names:
+            del index[key]
+
+    def insert(self, bucket):
+        with self.lock:
+            self.all.add(bucket.name)
+            self._add(self.by_cluster, bucket.cluster, bucket.name)
+            self._add(self.by_owner, bucket.owner, bucket.name)
+            self.by_state[bucket.state].add(bucket.name)
+
+    def remove(self, bucket):
+        with self.lock:
+            self.all.remove(bucket.name)
+            self._remove(self.by_cluster, bucket.cluster, bucket.name)
+            self._remove(self.by_owner, bucket.owner, bucket.name)
+            self.by_state[bucket.state].remove(bucket.name)
+
+    def add_tombstone(self, name: str, state):
+        """Index a deleted bucket's tombstone, which is only listed by state."""
+        with self.lock:
+            self.by_state[state].add(name)
+
+    def remove_tombstone(self, name: str, state):
+        with self.lock:
+            self.by_state[state].remove(name)
+
+    def set_state(self, bucket, old, new):
+        with self.lock:
+            self.by_state[old].remove(bucket.name)
+            self.by_state[new].add(bucket.name)
+
+    def _candidates(self, cluster, owner, state) -> SortedNames:
+        """The smallest index that covers every bucket matching the filters."""
+        options = []
+        if cluster:
+            options.append(self.by_cluster.get(cluster, SortedNames()))
+        if owner:
+            options.append(self.by_owner.get(owner, SortedNames()))
+        if state is not None:
+            options.append(self.by_state[state])
+        if not options:
+            return self.all
+        return min(options, key=len)
+
+    def candidates_after(
+        self,
+        cluster,
+        owner,
+        state,
+        after: str,
+        n: int,
+        end: str = None,
+        inclusive: bool = False,
+    ):
+        """
+        Up to n names after `after` (or from it, if inclusive) and before
+        `end`, from the most selective index for the filters. They may not
+        match the other filters; the caller checks.
+        """
+        with self.lock:
+            return self._candidates(cluster, owner, state).after(
+                after, n, end, inclusive
+            )
@@ -0,0 +1,170 @@
+"""
+Logging for the UBNS server that stays off the RPC hot path.
+
+Handlers run on a background thread: RPC threads only put records on a
+queue. Messages are formatted on that thread too, as long as their
+arguments are immutable; anything else is formatted before it's queued, so
+a record can't show state that changed after it was logged.
+
+Every RPC gets one structured line on the "ubns.access" logger. Successful
+RPCs can be sampled; failures are always logged.
+"""
+
+import logging
+import logging.handlers
+import queue
+import random
+
+# Argument types that are safe to format on the listener thread.
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener where it can."""
+
+    def prepare(self, record):
+        if record.exc_info or not all(
+            isinstance(arg, _IMMUTABLE) for arg in (record.args or ())
+        ):
+            return super().prepare(record)
+        return record
+
+
+def setup_logging(level: int, stream=None) -> logging.handlers.QueueListener:
+    """
+    Send all logging through a queue to a stream handler on a background
+    thread. Returns the running listener; stop() it to flush on exit. Call
+    this again in a forked child, since the listener thread doesn't survive
+    the fork.
+    """
+    q = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(DeferredQueueHandler(q))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(q, handler)
+    listener.start()
+    return listener
+
+
+class AccessLog:
+    """One structured line per RPC, with successful RPCs sampled."""
+
+    def __init__(self, sample_rate: float = 1.0):
+        self.logger = logging.getLogger("ubns.access")
+        self.sample_rate = sample_rate
+
+    def _sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def request(
+        self, method, request, code, details, duration, forwarded_to=None, replayed=False
+    ):
+        """
+        Log a unary RPC on a bucket. `replayed` marks a retry answered with
+        an earlier attempt's outcome.
+        """
+        ok = code.name == "OK"
+        if ok and not self._sampled():
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        fmt = "method=%s bucket=%s cluster=%s owner=%s code=%s duration_ms=%.3f"
+        args = [
+            method,
+            request.bucket,
+            request.cluster,
+            request.owner,
+            code.name,
+            duration * 1000,
+        ]
+        if forwarded_to is not None:
+            fmt += " forwarded_to=%d"
+            args.append(forwarded_to)
+        if replayed:
+            fmt += " replayed=1"
+        if not ok:
+            fmt += " details=%r"
+            args.append(details)
+        self.logger.info(fmt, *args)
+
+    def batch(self, method, operations, failed, duration):
+        """Log a batch, with a count of its failed operations."""
+        if failed == 0 and not self._sampled():
+            return
+        self.logger.info(
+            "method=%s operations=%d failed=%d duration_ms=%.3f",
+            method,
+            operations,
+            failed,
+            duration * 1000,
+        )
+
+    def reconcile(self, method, request, response, code, details, duration):
+        """Log one call of a reconciliation."""
+        ok = code.name == "OK"
+        if ok and not self._sampled():
+            return
+        fmt = "method=%s cluster=%s digests=%d entry_nodes=%d mismatched=%d code=%s duration_ms=%.3f"
+        args = [
+            method,
+            request.cluster,
+            len(request.digests),
+            len(request.entries),
+            len(response.mismatched),
+            code.name,
+            duration * 1000,
+        ]
+        if not ok:
+            fmt += " details=%r"
+            args.append(details)
+        self.logger.info(fmt, *args)
+
+    def listing(self, method, request, entries, pages, code, details, duration):
+        """Log a listing, with the number of entries and pages streamed."""
+        ok = code.name == "OK"
+        if ok and not self._sampled():
+            return
+        fmt = "method=%s cluster=%s owner=%s state=%d page_size=%d entries=%d pages=%d code=%s duration_ms=%.3f"
+        args = [
+            method,
+            request.cluster,
+            request.owner,
+            request.state,
+            request.page_size,
+            entries,
+            pages,
+            code.name,
+            duration * 1000,
+        ]
+        for field in ("prefix", "start_at", "end_before"):
+            if value := getattr(request, field):
+                fmt += f" {field}=%r"
+                args.append(value)
+        if not ok:
+            fmt += " details=%r"
+            args.append(details)
+        self.logger.info(fmt, *args)
+
+    def watch(self, method, request, changes, code, details, duration):
+        """
+        Log a watch when it ends, with the number of changes it streamed.
+        Watches are few and long-lived, so every one is logged.
+        """
+        fmt = "method=%s cluster=%s owner=%s after_seq=%d changes=%d code=%s duration_ms=%.3f"
+        args = [
+            method,
+            request.cluster,
+            request.owner,
+            request.after_seq,
+            changes,
+            code.name,
+            duration * 1000,
+        ]
+        if code.name != "OK":
+            fmt += " details=%r"
+            args.append(details)
+        self.logger.info(fmt, *args)
@@ -0,0 +1,468 @@
+"""
+Prometheus metrics for the UBNS server.
+
+An interceptor counts every RPC by method and status code, times it into a
+latency histogram and tracks how many are in flight. The counters are kept
+per thread, so an RPC only ever touches its own thread's dicts and never
+takes a lock; a scrape adds them up. Gauges that are cheap to read on
+demand, like the bucket counts, are computed at scrape time instead.
+
+The metrics are served in the Prometheus text format from a small HTTP
+server on its own port, away from the gRPC listener. The same server takes
+profile captures (ubns_profile) at /debug/profile and /debug/rpcs, traffic
+captures (ubns_capture) at /debug/capture, and shows and changes
+per-cluster admission (ubns_admission) at /admin/limits.
+"""
+
+from bisect import bisect_left
+import grpc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from ubns_capture import CaptureBusyError
+from ubns_profile import ProfileBusyError, render_folded, render_phases
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _ThreadStats:
+    """One thread's share of the RPC metrics. Only that thread writes it."""
+
+    def __init__(self):
+        # (method, code name) -> count
+        self.requests: dict[tuple[str, str], int] = {}
+        self.started: dict[str, int] = {}
+        self.finished: dict[str, int] = {}
+        # method -> [per-bucket counts..., +Inf count, sum]
+        self.latency: dict[str, list] = {}
+
+
+class RPCMetrics:
+    """RPC counters, aggregated per thread and summed when scraped."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads: list[_ThreadStats] = []
+
+    def _stats(self) -> _ThreadStats:
+        try:
+            return self._local.stats
+        except AttributeError:
+            stats = _ThreadStats()
+            with self._lock:
+                self._threads.append(stats)
+            self._local.stats = stats
+            return stats
+
+    def start(self, method: str):
+        started = self._stats().started
+        started[method] = started.get(method, 0) + 1
+
+    def finish(self, method: str, code: grpc.StatusCode, duration: float):
+        stats = self._stats()
+        stats.finished[method] = stats.finished.get(method, 0) + 1
+        key = (method, code.name)
+        stats.requests[key] = stats.requests.get(key, 0) + 1
+        hist = stats.latency.get(method)
+        if hist is None:
+            hist = stats.latency[method] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        hist[bisect_left(LATENCY_BUCKETS, duration)] += 1
+        hist[-1] += duration
+
+    @staticmethod
+    def _sum(dicts) -> dict:
+        total = {}
+        for d in dicts:
+            # Copy first: the owning thread may add a key while we iterate.
+            for k, v in d.copy().items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+    def render(self) -> list[str]:
+        with self._lock:
+            threads = list(self._threads)
+
+        lines = [
+            "# HELP ubns_rpc_requests_total RPCs completed, by method and status code.",
+            "# TYPE ubns_rpc_requests_total counter",
+        ]
+        for (method, code), n in sorted(self._sum(t.requests for t in threads).items()):
+            lines.append(
+                f'ubns_rpc_requests_total{{method="{method}",code="{code}"}} {n}'
+            )
+
+        # Read finished before started, so in-flight can't go negative.
+        finished = self._sum(t.finished for t in threads)
+        started = self._sum(t.started for t in threads)
+        lines += [
+            "# HELP ubns_rpc_in_flight RPCs currently being handled, by method.",
+            "# TYPE ubns_rpc_in_flight gauge",
+        ]
+        for method in sorted(started):
+            lines.append(
+                f'ubns_rpc_in_flight{{method="{method}"}} {started[method] - finished.get(method, 0)}'
+            )
+
+        lines += [
+            "# HELP ubns_rpc_duration_seconds RPC handling time, by method.",
+            "# TYPE ubns_rpc_duration_seconds histogram",
+        ]
+        hists = {}
+        for t in threads:
+            for method, hist in t.latency.copy().items():
+                total = hists.setdefault(method, [0] * len(hist))
+                for i, v in enumerate(list(hist)):
+                    total[i] += v
+        for method, hist in sorted(hists.items()):
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), hist):
+                cumulative += n
+                lines.append(
+                    f'ubns_rpc_duration_seconds_bucket{{method="{method}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'ubns_rpc_duration_seconds_sum{{method="{method}"}} {hist[-1]}'
+            )
+            lines.append(
+                f'ubns_rpc_duration_seconds_count{{method="{method}"}} {cumulative}'
+            )
+        return lines
+
+
+def _method_name(full_method: str) -> str:
+    """'/ubdb.v1.UBDBService/AddBucketEntry' -> 'AddBucketEntry'"""
+    return full_method.rsplit("/", 1)[-1]
+
+
+def _code(context) -> grpc.StatusCode:
+    return context.code() or grpc.StatusCode.OK
+
+
+def _raised_code(context) -> grpc.StatusCode:
+    # context.abort() sets the code before it raises; anything else that
+    # escapes a handler is reported to the client as UNKNOWN.
+    return context.code() or grpc.StatusCode.UNKNOWN
+
+
+def _wrap_handler(handler, method: str, metrics: RPCMetrics, wrap_unary, wrap_stream):
+    if handler is None:
+        return None
+    if handler.unary_unary is not None:
+        return grpc.unary_unary_rpc_method_handler(
+            wrap_unary(handler.unary_unary, method, metrics),
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+    if handler.unary_stream is not None:
+        return grpc.unary_stream_rpc_method_handler(
+            wrap_stream(handler.unary_stream, method, metrics),
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+    if handler.stream_stream is not None:
+        return grpc.stream_stream_rpc_method_handler(
+            wrap_stream(handler.stream_stream, method, metrics),
+            request_deserializer=handler.request_deserializer,
+            response_serializer=handler.response_serializer,
+        )
+    # Nothing else in the service yet; pass it through uninstrumented.
+    return handler
+
+
+def _timed_unary(behavior, method, metrics):
+    def wrapper(request, context):
+        metrics.start(method)
+        start = time.perf_counter()
+        code = grpc.StatusCode.UNKNOWN
+        try:
+            response = behavior(request, context)
+            code = _code(context)
+            return response
+        except BaseException:
+            code = _raised_code(context)
+            raise
+        finally:
+            metrics.finish(method, code, time.perf_counter() - start)
+
+    return wrapper
+
+
+def _timed_stream(behavior, method, metrics):
+    # For both unary-stream and stream-stream RPCs: the first argument is
+    # passed through either way.
+    def wrapper(request_iterator, context):
+        metrics.start(method)
+        start = time.perf_counter()
+        code = grpc.StatusCode.UNKNOWN
+        try:
+            yield from behavior(request_iterator, context)
+            code = _code(context)
+        finally:
+            metrics.finish(method, code, time.perf_counter() - start)
+
+    return wrapper
+
+
+def _timed_unary_async(behavior, method, metrics):
+    async def wrapper(request, context):
+        metrics.start(method)
+        start = time.perf_counter()
+        code = grpc.StatusCode.UNKNOWN
+        try:
+            response = await behavior(request, context)
+            code = _code(context)
+            return response
+        except BaseException:
+            code = _raised_code(context)
+            raise
+        finally:
+            metrics.finish(method, code, time.perf_counter() - start)
+
+    return wrapper
+
+
+def _timed_stream_async(behavior, method, metrics):
+    async def wrapper(request_iterator, context):
+        metrics.start(method)
+        start = time.perf_counter()
+        code = grpc.StatusCode.UNKNOWN
+        try:
+            async for response in behavior(request_iterator, context):
+                yield response
+            code = _code(context)
+        finally:
+            metrics.finish(method, code, time.perf_counter() - start)
+
+    return wrapper
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    """Records RPCMetrics for every RPC on a thread-pool server."""
+
+    def __init__(self, metrics: RPCMetrics):
+        self.metrics = metrics
+
+    def intercept_service(self, continuation, handler_call_details):
+        return _wrap_handler(
+            continuation(handler_call_details),
+            _method_name(handler_call_details.method),
+            self.metrics,
+            _timed_unary,
+            _timed_stream,
+        )
+
+
+class AsyncMetricsInterceptor(grpc.aio.ServerInterceptor):
+    """Records RPCMetrics for every RPC on a grpc.aio server."""
+
+    def __init__(self, metrics: RPCMetrics):
+        self.metrics = metrics
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return _wrap_handler(
+            await continuation(handler_call_details),
+            _method_name(handler_call_details.method),
+            self.metrics,
+            _timed_unary_async,
+            _timed_stream_async,
+        )
+
+
+class MetricsRegistry:
+    """
+    Everything exported on /metrics: the RPC metrics plus any number of
+    gauges and counters kept elsewhere, each a callable returning (labels,
+    value) pairs, read at scrape time.
+    """
+
+    def __init__(self):
+        self.rpc = RPCMetrics()
+        self._families = []
+
+    def add_gauge(self, name: str, help: str, read):
+        self._families.append((name, "gauge", help, read))
+
+    def add_counter(self, name: str, help: str, read):
+        self._families.append((name, "counter", help, read))
+
+    def render(self) -> str:
+        lines = self.rpc.render()
+        for name, kind, help, read in self._families:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in read():
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(
+                    f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def _seconds(query) -> float:
+    """A capture's ?seconds= (default 10)."""
+    seconds = float(parse_qs(query).get("seconds", ["10"])[0])
+    if not 0 < seconds <= 600:
+        raise ValueError("seconds must be in (0, 600]")
+    return seconds
+
+
+def _capture(profiler, path, query) -> str:
+    """Run the capture for a /debug path, for ?seconds= (default 10)."""
+    seconds = _seconds(query)
+    if path == "/debug/profile":
+        return render_folded(profiler.sample_stacks(seconds))
+    return render_phases(profiler.time_rpcs(seconds), seconds)
+
+
+_LIMIT_PARAMS = {"cluster", "owner", "rate", "burst", "weight", "slots", "depth"}
+
+
+def _configure_admission(admission, query) -> str:
+    """
+    Apply an /admin/limits change: a rate (and burst) or weight for
+    ?cluster= or ?owner=, '*' for the default, and/or the queue's slots
+    and depth. Returns the settings after.
+    """
+    params = {k: v[-1] for k, v in parse_qs(query).items()}
+    unknown = set(params) - _LIMIT_PARAMS
+    if unknown:
+        raise ValueError(f"unknown parameters: {', '.join(sorted(unknown))}")
+    rate = float(params["rate"]) if "rate" in params else None
+    burst = float(params["burst"]) if "burst" in params else None
+    weight = float(params["weight"]) if "weight" in params else None
+    if (rate is not None and rate < 0) or (burst is not None and burst < 1):
+        raise ValueError("rate must be at least 0, and burst at least 1")
+    if weight is not None and (weight <= 0 or params.get("cluster", "*") == "*"):
+        raise ValueError("weight must be more than 0, for a named cluster")
+    kinds = [kind for kind in ("cluster", "owner") if kind in params]
+    if (rate is not None or burst is not None) and len(kinds) != 1:
+        raise ValueError("a rate or burst needs one of cluster= or owner=")
+    if "slots" in params or "depth" in params:
+        slots = int(params.get("slots", admission.queue.slots))
+        depth = int(params["depth"]) if "depth" in params else None
+        if slots < 0 or (depth is not None and depth < 1):
+            raise ValueError("slots must be at least 0, and depth at least 1")
+        admission.set_slots(slots, depth)
+    if rate is not None or burst is not None:
+        kind = kinds[0]
+        key = None if params[kind] == "*" else params[kind]
+        if rate is None:
+            buckets = admission.clusters if kind == "cluster" else admission.owners
+            rate = buckets.limits.get(key, buckets.default)[0]
+        admission.set_limit(kind, key, rate, burst)
+    if weight is not None:
+        admission.set_weight(params["cluster"], weight)
+    return admission.describe()
+
+
+def serve_metrics(
+    registry: MetricsRegistry,
+    address: str,
+    port: int,
+    profiler=None,
+    admission=None,
+    capture=None,
+):
+    """
+    Serve /metrics from a background thread, and with a profiler, its
+    captures, with a ubns_admission.ClusterAdmission, its settings, and with
+    a ubns_capture.Capture, traffic captures. Returns the HTTP server.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, body: bytes):
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_capture(self, query):
+            # Spooled to disk, as a busy server can capture a lot.
+            with tempfile.TemporaryFile() as f:
+                try:
+                    calls, dropped = capture.record(f, _seconds(query))
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                except CaptureBusyError as e:
+                    self.send_error(409, str(e))
+                    return
+                logging.info("capture: %d calls captured, %d dropped", calls, dropped)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(f.tell()))
+                self.end_headers()
+                f.seek(0)
+                shutil.copyfileobj(f, self.wfile)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if admission is None or url.path != "/admin/limits":
+                self.send_error(404)
+                return
+            try:
+                body = _configure_admission(admission, url.query).encode()
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            logging.info("admission: changed to %s", url.query)
+            self._reply(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/metrics":
+                body = registry.render().encode()
+            elif admission is not None and url.path == "/admin/limits":
+                body = admission.describe().encode()
+            elif capture is not None and url.path == "/debug/capture":
+                self._send_capture(url.query)
+                return
+            elif profiler is not None and url.path in ("/debug/profile", "/debug/rpcs"):
+                try:
+                    body = _capture(profiler, url.path, url.query).encode()
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                except ProfileBusyError as e:
+                    self.send_error(409, str(e))
+                    return
+            else:
+                self.send_error(404)
+                return
+            self._reply(body)
+
+        def log_message(self, format, *args):
+            logging.debug("metrics: " + format, *args)
+
+    httpd = ThreadingHTTPServer((address, port), Handler)
+    httpd.daemon_threads = True
+    t = threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True)
+    t.start()
+    logging.info(f"Metrics on http://{address}:{port}/metrics")
+    return httpd
@@ -0,0 +1,131 @@
+"""
+Bucket-name partitioning across UBNS worker processes.
+
+In multi-process mode every worker listens on the public port with
+SO_REUSEPORT, so the kernel hands each incoming connection to an arbitrary
+worker. Each worker only stores the buckets whose names hash to it; a
+request for any other bucket is forwarded to its owner over the owner's
+private unix socket. Uniqueness still holds because exactly one process
+ever decides on a given name.
+"""
+
+import grpc
+import os
+import threading
+import zlib
+
+from ubdb.v1 import ubdb_pb2_grpc
+
+
+# Sent with a request one worker makes of another to get the answer for the
+# receiver's partition alone, for RPCs that span every partition. Only
+# believed from another worker (see from_worker()).
+PARTITION_LOCAL_METADATA = ("ubns-partition-local", "1")
+
+# Sent with every request one worker makes of another, so that what's done
+# once per call from a client, such as admission, isn't done again. Only
+# believed from another worker, like PARTITION_LOCAL_METADATA.
+FORWARDED_METADATA = ("ubns-forwarded", "1")
+
+
+def partition_for(bucket_name: str, partitions: int) -> int:
+    """Owning partition of a bucket. Stable across processes, unlike hash()."""
+    return zlib.crc32(bucket_name.encode()) % partitions
+
+
+def forward_timeout(context):
+    """
+    The caller's remaining deadline, for passing on, or None if it didn't
+    set one (in which case gRPC reports an effectively infinite remainder
+    that overflows if used as a timeout).
+    """
+    remaining = context.time_remaining()
+    if remaining is None or remaining > 1e9:
+        return None
+    return remaining
+
+
+def forwardable_metadata(context):
+    """
+    Client metadata that can be passed on to another worker as-is, marked
+    as forwarded.
+    """
+    return tuple(
+        (k, v)
+        for k, v in context.invocation_metadata()
+        if not k.startswith((":", "grpc-"))
+        and k not in ("user-agent", FORWARDED_METADATA[0], PARTITION_LOCAL_METADATA[0])
+    ) + (FORWARDED_METADATA,)
+
+
+def from_worker(context) -> bool:
+    """
+    Whether a call came from another worker: over a private unix socket,
+    which only the workers can reach, rather than the public port, which is
+    always TCP. Metadata that only workers may send is ignored otherwise,
+    since any client could send it.
+    """
+    return context.peer().startswith("unix:")
+
+
+def is_partition_local(context) -> bool:
+    return (
+        PARTITION_LOCAL_METADATA in context.invocation_metadata()
+        and from_worker(context)
+    )
+
+
+def is_forwarded(context) -> bool:
+    return (
+        FORWARDED_METADATA in context.invocation_metadata()
+        and from_worker(context)
+    )
+
+
+class PartitionRouter:
+    """
+    Knows which worker owns which bucket, and holds the channels used to
+    forward requests to the other workers.
+    """
+
+    def __init__(self, index: int, count: int, socket_dir: str):
+        self.index = index
+        self.count = count
+        self.socket_dir = socket_dir
+        self._lock = threading.Lock()
+        self._stubs: dict[int, ubdb_pb2_grpc.UBDBServiceStub] = {}
+        self._aio_stubs: dict[int, ubdb_pb2_grpc.UBDBServiceStub] = {}
+
+    def address(self, index: int) -> str:
+        """The private address worker `index` listens on."""
+        return f"unix:{os.path.join(self.socket_dir, f'worker-{index}.sock')}"
+
+    def owner(self, bucket_name: str) -> int:
+        return partition_for(bucket_name, self.count)
+
+    def is_local(self, bucket_name: str) -> bool:
+        return self.owner(bucket_name) == self.index
+
+    def stub(self, index: int) -> ubdb_pb2_grpc.UBDBServiceStub:
+        """A stub for worker `index` on a (shared, lazily opened) sync channel."""
+        with self._lock:
+            stub = self._stubs.get(index)
+            if stub is None:
+                stub = ubdb_pb2_grpc.UBDBServiceStub(
+                    grpc.insecure_channel(self.address(index))
+                )
+                self._stubs[index] = stub
+            return stub
+
+    def aio_stub(self, index: int) -> ubdb_pb2_grpc.UBDBServiceStub:
+        """
+        A stub for worker `index` on a grpc.aio channel. Only call this from
+        the event loop thread.
+        """
+        stub = self._aio_stubs.get(index)
+        if stub is None:
+            stub = ubdb_pb2_grpc.UBDBServiceStub(
+                grpc.aio.insecure_channel(self.address(index))
+            )
+            self._aio_stubs[index] = stub
+        return stub
@@ -0,0 +1,377 @@
+"""
+On-demand profiling of a running UBNS server.
+
+Nothing here runs until it's asked for, so a server that isn't being
+profiled pays nothing for it beyond one attribute check per RPC. Two kinds
+of capture can be asked for, over HTTP on the metrics port or with SIGUSR1:
+
+- Stack samples. A thread wakes every --profile-interval-ms, takes every
+  Python thread's stack and counts it, and after N seconds the counts are
+  written in the collapsed format that flamegraph.pl and speedscope read:
+  one "thread;outermost;...;innermost count" line per distinct stack. The
+  sampler needs the GIL to look, so a thread is only ever seen where it
+  would let go of it.
+
+- Per-RPC phase times. For N seconds the servicer's database and access
+  log are swapped for wrappers that time every call, and an interceptor
+  times each RPC's request decoding, handler and response encoding. The
+  report gives calls, wall and CPU time for each method and phase. The
+  handler's times include its database and logging calls; database calls
+  are listed under the database method, as with --async they run on
+  another thread than the RPC. With --async, a handler's CPU time also
+  includes whatever else the event loop ran meanwhile.
+"""
+
+import grpc
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+PHASES = ("deserialize", "handler", "db", "log", "serialize")
+
+
+class ProfileBusyError(Exception):
+    """A capture of the same kind is already running."""
+
+
+def _frame_label(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def render_folded(stacks: dict) -> str:
+    """Stack counts in the collapsed format, busiest stack first."""
+    lines = [
+        f"{stack} {n}"
+        for stack, n in sorted(stacks.items(), key=lambda kv: (-kv[1], kv[0]))
+    ]
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def render_phases(phases: dict, seconds: float) -> str:
+    """A phase report as a table, by method and then in order of phase."""
+    lines = [
+        f"# {seconds:g}s of RPCs",
+        f"{'method':<24} {'phase':<11} {'calls':>8} {'wall ms':>10} {'cpu ms':>10} {'wall us/call':>12}",
+    ]
+    order = {phase: i for i, phase in enumerate(PHASES)}
+    for (method, phase), (calls, wall, cpu) in sorted(
+        phases.items(), key=lambda kv: (kv[0][0], order[kv[0][1]])
+    ):
+        lines.append(
+            f"{method:<24} {phase:<11} {calls:>8} {wall * 1e3:>10.1f} "
+            f"{cpu * 1e3:>10.1f} {wall / calls * 1e6:>12.1f}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+class _PhaseTimes:
+    """(method, phase) -> [calls, wall, cpu] for one capture."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def record(self, method: str, phase: str, wall: float, cpu: float):
+        with self.lock:
+            entry = self.times.get((method, phase))
+            if entry is None:
+                self.times[(method, phase)] = [1, wall, cpu]
+                return
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+
+
+class _Timed:
+    """
+    Stands in for an object, timing every method called on it. The label
+    is the method's name or, with by_first_arg, its first argument.
+    """
+
+    def __init__(self, target, phase: str, times: _PhaseTimes, by_first_arg=False):
+        self._target = target
+        self._phase = phase
+        self._times = times
+        self._by_first_arg = by_first_arg
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                label = args[0] if self._by_first_arg and args else name
+                self._times.record(
+                    label,
+                    self._phase,
+                    time.perf_counter() - wall,
+                    time.thread_time() - cpu,
+                )
+
+        return timed
+
+
+def _timed_call(fn, method, phase, times):
+    if fn is None:
+        return None
+
+    def wrapper(arg):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return fn(arg)
+        finally:
+            times.record(
+                method, phase, time.perf_counter() - wall, time.thread_time() - cpu
+            )
+
+    return wrapper
+
+
+def _timed_unary(behavior, method, times):
+    def wrapper(request, context):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return behavior(request, context)
+        finally:
+            times.record(
+                method, "handler", time.perf_counter() - wall, time.thread_time() - cpu
+            )
+
+    return wrapper
+
+
+def _timed_stream(behavior, method, times):
+    def wrapper(request_iterator, context):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield from behavior(request_iterator, context)
+        finally:
+            times.record(
+                method, "handler", time.perf_counter() - wall, time.thread_time() - cpu
+            )
+
+    return wrapper
+
+
+def _timed_unary_async(behavior, method, times):
+    async def wrapper(request, context):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return await behavior(request, context)
+        finally:
+            times.record(
+                method, "handler", time.perf_counter() - wall, time.thread_time() - cpu
+            )
+
+    return wrapper
+
+
+def _timed_stream_async(behavior, method, times):
+    async def wrapper(request_iterator, context):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            async for response in behavior(request_iterator, context):
+                yield response
+        finally:
+            times.record(
+                method, "handler", time.perf_counter() - wall, time.thread_time() - cpu
+            )
+
+    return wrapper
+
+
+def _wrap_handler(handler, method: str, times: _PhaseTimes, wrap_unary, wrap_stream):
+    if handler is None:
+        return None
+    deserializer = _timed_call(handler.request_deserializer, method, "deserialize", times)
+    serializer = _timed_call(handler.response_serializer, method, "serialize", times)
+    if handler.unary_unary is not None:
+        return grpc.unary_unary_rpc_method_handler(
+            wrap_unary(handler.unary_unary, method, times),
+            request_deserializer=deserializer,
+            response_serializer=serializer,
+        )
+    if handler.unary_stream is not None:
+        return grpc.unary_stream_rpc_method_handler(
+            wrap_stream(handler.unary_stream, method, times),
+            request_deserializer=deserializer,
+            response_serializer=serializer,
+        )
+    if handler.stream_stream is not None:
+        return grpc.stream_stream_rpc_method_handler(
+            wrap_stream(handler.stream_stream, method, times),
+            request_deserializer=deserializer,
+            response_serializer=serializer,
+        )
+    return handler
+
+
+class Profiler:
+    """
+    Captures for one server process. attach() it to the servicer, and put
+    its interceptor innermost on the server, so that it times the handler
+    alone.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.servicer = None
+        # The capture in progress, if any; read by the interceptors.
+        self.phases = None
+        self._sampling = threading.Lock()
+        self._timing = threading.Lock()
+
+    def attach(self, servicer):
+        self.servicer = servicer
+
+    def sample_stacks(self, seconds: float) -> dict:
+        """
+        Sample every thread's stack for `seconds`, from this thread. Returns
+        {collapsed stack: samples}.
+        """
+        if not self._sampling.acquire(blocking=False):
+            raise ProfileBusyError("a stack capture is already running")
+        try:
+            me = threading.get_ident()
+            labels = {}
+            stacks = {}
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        label = labels.get(code)
+                        if label is None:
+                            label = labels[code] = _frame_label(code)
+                        stack.append(label)
+                        frame = frame.f_back
+                    stack.append(names.get(ident, f"thread-{ident}"))
+                    key = ";".join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+                del frame
+                time.sleep(self.interval)
+            return stacks
+        finally:
+            self._sampling.release()
+
+    def time_rpcs(self, seconds: float) -> dict:
+        """
+        Time the phases of every RPC for `seconds`. Returns {(method,
+        phase): (calls, wall seconds, CPU seconds)}.
+        """
+        if not self._timing.acquire(blocking=False):
+            raise ProfileBusyError("an RPC capture is already running")
+        servicer = self.servicer
+        times = _PhaseTimes()
+        try:
+            if servicer is not None:
+                db, access_log = servicer.db, servicer.access_log
+                servicer.db = _Timed(db, "db", times)
+                servicer.access_log = _Timed(access_log, "log", times, by_first_arg=True)
+            self.phases = times
+            try:
+                time.sleep(seconds)
+            finally:
+                self.phases = None
+                if servicer is not None:
+                    servicer.db, servicer.access_log = db, access_log
+        finally:
+            self._timing.release()
+        with times.lock:
+            return {key: tuple(entry) for key, entry in times.times.items()}
+
+    def capture_to(self, directory: str, seconds: float):
+        """Take both captures at once and write them to files in directory."""
+        stem = os.path.join(
+            directory, f"ubns-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+        )
+        result = {}
+
+        def timing():
+            try:
+                result["phases"] = self.time_rpcs(seconds)
+            except ProfileBusyError as e:
+                logging.warning("profile: %s", e)
+
+        t = threading.Thread(target=timing, name="profile-rpcs", daemon=True)
+        t.start()
+        try:
+            stacks = self.sample_stacks(seconds)
+        except ProfileBusyError as e:
+            logging.warning("profile: %s", e)
+        else:
+            with open(stem + ".folded", "w") as f:
+                f.write(render_folded(stacks))
+            logging.info("profile: wrote %s.folded", stem)
+        t.join()
+        if "phases" in result:
+            with open(stem + ".rpcs", "w") as f:
+                f.write(render_phases(result["phases"], seconds))
+            logging.info("profile: wrote %s.rpcs", stem)
+
+    def install_signal(self, directory: str, seconds: float, signum=signal.SIGUSR1):
+        """
+        Capture for `seconds` into directory whenever this process gets
+        signum. Must be called from the main thread.
+        """
+
+        def handler(signum, frame):
+            logging.info("profile: capturing for %gs", seconds)
+            threading.Thread(
+                target=self.capture_to,
+                args=(directory, seconds),
+                name="profile",
+                daemon=True,
+            ).start()
+
+        signal.signal(signum, handler)
+
+
+class ProfilingInterceptor(grpc.ServerInterceptor):
+    """Times RPC phases on a thread-pool server while a capture runs."""
+
+    def __init__(self, profiler: Profiler):
+        self.profiler = profiler
+
+    def intercept_service(self, continuation, handler_call_details):
+        times = self.profiler.phases
+        if times is None:
+            return continuation(handler_call_details)
+        return _wrap_handler(
+            continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            times,
+            _timed_unary,
+            _timed_stream,
+        )
+
+
+class AsyncProfilingInterceptor(grpc.aio.ServerInterceptor):
+    """Times RPC phases on a grpc.aio server while a capture runs."""
+
+    def __init__(self, profiler: Profiler):
+        self.profiler = profiler
+
+    async def intercept_service(self, continuation, handler_call_details):
+        times = self.profiler.phases
+        if times is None:
+            return await continuation(handler_call_details)
+        return _wrap_handler(
+            await continuation(handler_call_details),
+            handler_call_details.method.rsplit("/", 1)[-1],
+            times,
+            _timed_unary_async,
+            _timed_stream_async,
+        )
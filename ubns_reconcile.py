@@ -0,0 +1,245 @@
+"""
+Digest-based reconciliation of a cluster's bucket set with UBDB.
+
+Both sides hash every (bucket, owner) entry to a 64-bit entry hash, and
+place it in a tree with fanout FANOUT by the CRC-32 of the bucket name: node
+(level, index) holds the entries whose name CRC starts with the
+FANOUT_BITS * level bits of index. A node's digest is the XOR of the entry
+hashes under it. Placement depends on the name alone, so an entry whose
+owner differs lands in the same node on both sides.
+
+The server keeps the digests of the LEAF_DEPTH level, the leaves, up to
+date as buckets come and go, along with the buckets in each leaf, and works
+out the levels below that on demand from a leaf's buckets. The caller walks
+the tree from the root, asking only about the children of nodes that
+differ, and once a differing node is small swaps entry hashes for it. When
+most of the set matches, that's a small fraction of the bytes needed to send
+the whole list. See the Reconcile RPC in ubdb.proto for the wire side.
+"""
+
+from bisect import bisect_left
+from functools import reduce
+import hashlib
+from operator import xor
+import zlib
+
+from ubdb.v1 import ubdb_pb2
+
+FANOUT_BITS = 4
+FANOUT = 1 << FANOUT_BITS
+# The level whose digests the server maintains.
+LEAF_DEPTH = 3
+LEAVES = FANOUT**LEAF_DEPTH
+# How far down the tree can go, using all 32 bits of the CRC but 4.
+MAX_DEPTH = 7
+
+# A differing node with at most this many of the caller's entries has them
+# sent, rather than its children's digests.
+SMALL_NODE = 32
+# Per-call limits. A response holds UBDB's entries under the nodes asked
+# about, so the node count bounds that too.
+DIGESTS_PER_CALL = 20000
+ENTRY_NODES_PER_CALL = 64
+HASHES_PER_CALL = 100000
+
+
+def name_hash(bucket_name: str) -> int:
+    """The hash that places a bucket name in the tree."""
+    return zlib.crc32(bucket_name.encode())
+
+
+def node_at(h: int, level: int) -> int:
+    """Index of the node at `level` holding names with name_hash() h."""
+    return h >> (32 - FANOUT_BITS * level)
+
+
+def leaf_of(bucket_name: str) -> int:
+    """The leaf a bucket name belongs in."""
+    return node_at(name_hash(bucket_name), LEAF_DEPTH)
+
+
+def leaf_above(level: int, index: int) -> int:
+    """The leaf containing node (level, index), which is at or below it."""
+    return index >> (FANOUT_BITS * (level - LEAF_DEPTH))
+
+
+def entry_hash(bucket_name: str, owner: str) -> int:
+    """64-bit hash of a bucket entry, as XORed into digests."""
+    h = hashlib.blake2b(f"{bucket_name}\0{owner}".encode(), digest_size=8)
+    return int.from_bytes(h.digest(), "big")
+
+
+def tree_levels(leaves: list[int]) -> list[list[int]]:
+    """Every level of the digest tree over LEAVES leaf digests, root first."""
+    levels = [list(leaves)]
+    while len(levels[0]) > 1:
+        below = levels[0]
+        levels.insert(
+            0,
+            [reduce(xor, below[i : i + FANOUT]) for i in range(0, len(below), FANOUT)],
+        )
+    return levels
+
+
+def children(level: int, index: int) -> list[tuple[int, int]]:
+    return [(level + 1, index * FANOUT + i) for i in range(FANOUT)]
+
+
+def valid_node(level: int, index: int) -> bool:
+    return level <= MAX_DEPTH and index < FANOUT**level
+
+
+class LeafEntries:
+    """
+    One leaf's (bucket, owner) entries, hashed, for working out the digests
+    and contents of the nodes below it.
+    """
+
+    def __init__(self, entries):
+        self.entries = [
+            (name_hash(name), entry_hash(name, owner), name, owner)
+            for name, owner in entries
+        ]
+        # level -> {index: digest}, filled in a level at a time.
+        self._digests = {}
+
+    def under(self, level: int, index: int):
+        return [e for e in self.entries if node_at(e[0], level) == index]
+
+    def digest(self, level: int, index: int) -> int:
+        digests = self._digests.get(level)
+        if digests is None:
+            digests = self._digests[level] = {}
+            for e in self.entries:
+                node = node_at(e[0], level)
+                digests[node] = digests.get(node, 0) ^ e[1]
+        return digests.get(index, 0)
+
+    def compare(self, level: int, index: int, caller_hashes):
+        """
+        Compare the entries under a node with the caller's entry hashes for
+        it. Returns the (bucket, owner) entries the caller lacks and the set
+        of caller hashes missing here.
+        """
+        remaining = set(caller_hashes)
+        missing_from_cluster = []
+        for _, h, name, owner in self.under(level, index):
+            if h in remaining:
+                remaining.discard(h)
+            else:
+                missing_from_cluster.append((name, owner))
+        return missing_from_cluster, remaining
+
+
+class ReconcileResult:
+    """Differences found by reconcile(), and what it took to find them."""
+
+    def __init__(self):
+        # (bucket, owner) the cluster has and UBDB doesn't.
+        self.missing_from_ubdb: list[tuple[str, str]] = []
+        # (bucket, owner) UBDB has and the cluster doesn't.
+        self.missing_from_cluster: list[tuple[str, str]] = []
+        # (bucket, cluster's owner, UBDB's owner)
+        self.owner_mismatch: list[tuple[str, str, str]] = []
+        self.calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Differing nodes whose entries were compared.
+        self.compared_nodes = 0
+
+    def in_sync(self) -> bool:
+        return not (
+            self.missing_from_ubdb or self.missing_from_cluster or self.owner_mismatch
+        )
+
+
+def reconcile(stub, cluster: str, entries, timeout: float = None) -> ReconcileResult:
+    """
+    Compare the (bucket, owner) pairs in `entries`, a cluster's complete
+    bucket set, with UBDB's entries for that cluster.
+    """
+    result = ReconcileResult()
+
+    def call(request):
+        response = stub.Reconcile(request, timeout=timeout)
+        result.calls += 1
+        result.bytes_sent += request.ByteSize()
+        result.bytes_received += response.ByteSize()
+        return response
+
+    # Sorted by name hash, every node's entries are a contiguous run.
+    local = sorted(
+        (name_hash(name), entry_hash(name, owner), name, owner)
+        for name, owner in entries
+    )
+    name_hashes = [e[0] for e in local]
+    known = {e[1]: (e[2], e[3]) for e in local}
+
+    def span(level, index):
+        shift = 32 - FANOUT_BITS * level
+        return (
+            bisect_left(name_hashes, index << shift),
+            bisect_left(name_hashes, (index + 1) << shift),
+        )
+
+    def digest(level, index):
+        lo, hi = span(level, index)
+        return reduce(xor, (e[1] for e in local[lo:hi]), 0)
+
+    # Walk down the tree, a level per round, until the differing nodes are
+    # small enough to compare outright.
+    to_compare = []
+    nodes = [(0, 0)]
+    while nodes:
+        mismatched = []
+        for i in range(0, len(nodes), DIGESTS_PER_CALL):
+            request = ubdb_pb2.ReconcileRequest(cluster=cluster)
+            for level, index in nodes[i : i + DIGESTS_PER_CALL]:
+                request.digests.add(
+                    level=level, index=index, digest=digest(level, index)
+                )
+            response = call(request)
+            mismatched.extend((d.level, d.index) for d in response.mismatched)
+        nodes = []
+        for level, index in mismatched:
+            lo, hi = span(level, index)
+            if level < LEAF_DEPTH or (hi - lo > SMALL_NODE and level < MAX_DEPTH):
+                nodes.extend(children(level, index))
+            else:
+                to_compare.append((level, index))
+    result.compared_nodes = len(to_compare)
+
+    missing_from_ubdb, missing_from_cluster = [], []
+
+    def compare(request):
+        response = call(request)
+        missing_from_ubdb.extend(response.missing_from_ubdb)
+        missing_from_cluster.extend(response.missing_from_cluster)
+
+    request = ubdb_pb2.ReconcileRequest(cluster=cluster)
+    hashes = 0
+    for level, index in to_compare:
+        lo, hi = span(level, index)
+        if len(request.entries) == ENTRY_NODES_PER_CALL or (
+            request.entries and hashes + hi - lo > HASHES_PER_CALL
+        ):
+            compare(request)
+            request = ubdb_pb2.ReconcileRequest(cluster=cluster)
+            hashes = 0
+        request.entries.add(
+            level=level, index=index, entry_hashes=[e[1] for e in local[lo:hi]]
+        )
+        hashes += hi - lo
+    if request.entries:
+        compare(request)
+
+    # A bucket on both sides with different owners shows up in both lists.
+    ours = dict(known[h] for h in missing_from_ubdb)
+    for entry in missing_from_cluster:
+        owner = ours.pop(entry.bucket, None)
+        if owner is None:
+            result.missing_from_cluster.append((entry.bucket, entry.owner))
+        else:
+            result.owner_mismatch.append((entry.bucket, owner, entry.owner))
+    result.missing_from_ubdb = sorted(ours.items())
+    return result
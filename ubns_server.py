@@ -7,6 +7,9 @@ Usage::
 """
 
 import argparse
+import asyncio
+from bisect import bisect_right
+from collections import deque
 from concurrent import futures
 from enum import Enum
 from google.protobuf import any_pb2
@@ -15,13 +18,64 @@ from google.rpc import error_details_pb2
 from google.rpc import status_pb2
 import grpc
 from grpc_status import rpc_status
+import heapq
+import itertools
 import logging
+import multiprocessing
+import multiprocessing.connection
 import re
 import os
+import shutil
+import signal
 import sys
+import tempfile
+import threading
+import time
 
 from ubdb.v1 import ubdb_pb2_grpc
 from ubdb.v1 import ubdb_pb2
+from ubns_admission import (
+    AsyncClusterAdmissionInterceptor,
+    AsyncSheddingInterceptor,
+    ClusterAdmission,
+    ClusterAdmissionInterceptor,
+    DeadlineShedder,
+    FairQueue,
+    SheddingInterceptor,
+    TokenBuckets,
+)
+from ubns_capture import AsyncCaptureInterceptor, Capture, CaptureInterceptor
+from ubns_dedup import RequestCache, request_id_of
+from ubns_index import BucketIndex, prefix_end
+from ubns_log import AccessLog, setup_logging
+from ubns_metrics import (
+    AsyncMetricsInterceptor,
+    MetricsInterceptor,
+    MetricsRegistry,
+    serve_metrics,
+)
+from ubns_profile import AsyncProfilingInterceptor, Profiler, ProfilingInterceptor
+from ubns_partition import (
+    PARTITION_LOCAL_METADATA,
+    PartitionRouter,
+    forward_timeout,
+    forwardable_metadata,
+    is_partition_local,
+)
+from ubns_reconcile import (
+    LEAF_DEPTH,
+    LEAVES,
+    LeafEntries,
+    entry_hash,
+    leaf_above,
+    leaf_of,
+    tree_levels,
+    valid_node,
+)
+from ubns_snapshot import Snapshot
+from ubns_sqlite import BucketTable, StoreFailedError
+from ubns_watch import ChangeFeed
+from ubns_wal import SyncMode, WALFailedError, WriteAheadLog
 
 
 class BucketNotFoundError(Exception):
@@ -34,6 +88,13 @@ class BucketAlreadyExistsError(Exception):
         super().__init__(f"bucket '{bucket}' already exists")
 
 
+class BucketRecentlyDeletedError(Exception):
+    def __init__(self, bucket, cluster):
+        super().__init__(
+            f"bucket '{bucket}' was recently deleted from cluster '{cluster}', and only that cluster can re-create it until its tombstone expires"
+        )
+
+
 class BucketDeleteWhenNotInDeletingState(Exception):
     def __init__(self, bucket):
         super().__init__(f"bucket '{bucket}' is not in the DELETING state for deletion")
@@ -61,115 +122,1188 @@ class BucketState(Enum):
     DELETED = 4
 
 
+# The bucket lifecycle: each state a bucket can be moved to, and the state it
+# has to be in first. NONE stands for not being in the table, so moving to
+# CREATING adds a bucket and moving to NONE removes it.
+_TRANSITIONS = {
+    BucketState.CREATING: BucketState.NONE,
+    BucketState.CREATED: BucketState.CREATING,
+    BucketState.DELETING: BucketState.CREATED,
+    BucketState.NONE: BucketState.DELETING,
+}
+
+# Each mutation as the states it moves a bucket through, in order. An update
+# moves it to the one state it names, if that's in _UPDATE_STATES.
+_OPERATIONS = {
+    "add": (BucketState.CREATING,),
+    "create": (BucketState.CREATING, BucketState.CREATED),
+    "destroy": (BucketState.DELETING, BucketState.NONE),
+    "delete": (BucketState.NONE,),
+}
+_UPDATE_STATES = (BucketState.CREATED, BucketState.DELETING)
+
+
+class InvalidStateTransitionError(Exception):
+    def __init__(self, bucket, state, required):
+        if state == BucketState.NONE:
+            super().__init__(f"bucket '{bucket}' is not in the {required.name} state")
+        else:
+            super().__init__(
+                f"bucket '{bucket}' is not in the {required.name} state for {state.name} update"
+            )
+
+
 class Bucket:
+    """
+    A bucket record. Once a record is in the table it is never modified: a
+    state change puts a new record in its place. That lets readers use
+    whatever record they find without taking a lock.
+    """
+
+    # There can be tens of millions of these, so no per-instance __dict__,
+    # and the cluster and owner strings (of which there are few distinct
+    # values) are shared between buckets rather than held per bucket.
+    __slots__ = ("name", "owner", "cluster", "state")
+
     def __init__(self, name, cluster, owner):
         self.name = name
-        self.owner = owner
-        self.cluster = cluster
+        self.owner = sys.intern(owner)
+        self.cluster = sys.intern(cluster)
         self.state = BucketState.NONE
 
-    def state(self):
-        return self.state
-
-    def owner(self):
-        return self.owner
-
-    def cluster(self):
-        return self.cluster
+    def with_state(self, state: BucketState) -> "Bucket":
+        """A copy of this record in another state."""
+        b = Bucket.__new__(Bucket)
+        b.name, b.owner, b.cluster = self.name, self.owner, self.cluster
+        b.state = state
+        return b
 
     def __str__(self):
         return f"Bucket(name={self.name}, owner={self.owner}, cluster={self.cluster}, state={self.state})"
 
 
-class BucketNameDatabase:
+class _Leaf:
+    """A cluster's buckets in one reconciliation leaf, and their digest."""
+
+    __slots__ = ("digest", "names")
 
     def __init__(self):
+        self.digest = 0
+        self.names: list[str] = []
+
+
+class _Shard:
+    """One stripe of the bucket table, with the lock that guards it."""
+
+    def __init__(self, index: BucketIndex):
+        self.lock = threading.Lock()
         self.buckets: dict[str, Bucket] = {}
+        # Names whose base snapshot entry is out of date: the bucket has
+        # been changed since, and is in `buckets` if it still exists.
+        self.shadowed: set[str] = set()
+        # The secondary indexes, shared by all shards and updated with each
+        # change made here.
+        self.index = index
+        # Number of buckets in each state. Every state has a key from the
+        # start, so readers can sum these without taking the lock.
+        self.states = {state: 0 for state in BucketState}
+        # cluster -> leaf -> _Leaf, for the leaves this shard owns.
+        self.leaves: dict[str, dict[int, _Leaf]] = {}
+        # name -> (deletion seq, cluster) for recently deleted buckets, in
+        # deletion order, until compaction purges them.
+        self.tombstones: dict[str, tuple[int, str]] = {}
 
-    def add_bucket(self, bucket_name: str, cluster: str, owner: str):
-        if bucket_name in self.buckets:
-            logging.error(f"Bucket '{bucket_name}' already exists")
+    def insert(self, bucket: Bucket):
+        if bucket.name in self.tombstones:
+            self.unbury(bucket.name)
+        self.buckets[bucket.name] = bucket
+        self.states[bucket.state] += 1
+        leaves = self.leaves.setdefault(bucket.cluster, {})
+        index = leaf_of(bucket.name)
+        leaf = leaves.get(index)
+        if leaf is None:
+            leaf = leaves[index] = _Leaf()
+        leaf.digest ^= entry_hash(bucket.name, bucket.owner)
+        leaf.names.append(bucket.name)
+        self.index.insert(bucket)
+
+    def remove(self, bucket: Bucket):
+        del self.buckets[bucket.name]
+        self.states[bucket.state] -= 1
+        leaves = self.leaves[bucket.cluster]
+        index = leaf_of(bucket.name)
+        leaf = leaves[index]
+        leaf.digest ^= entry_hash(bucket.name, bucket.owner)
+        leaf.names.remove(bucket.name)
+        # A leaf with no names may still be backing out base entries.
+        if not leaf.names and not leaf.digest:
+            del leaves[index]
+            if not leaves:
+                del self.leaves[bucket.cluster]
+        self.index.remove(bucket)
+
+    def set_state(self, bucket: Bucket, state: BucketState) -> Bucket:
+        """Replace a bucket's record with one in another state, and return it."""
+        self.states[bucket.state] -= 1
+        self.states[state] += 1
+        self.index.set_state(bucket, bucket.state, state)
+        new = bucket.with_state(state)
+        self.buckets[bucket.name] = new
+        return new
+
+    def bury(self, bucket_name: str, cluster: str, seq: int):
+        """Leave a tombstone for a bucket deleted by log record `seq`."""
+        if bucket_name in self.tombstones:
+            self.unbury(bucket_name)
+        self.tombstones[bucket_name] = (seq, cluster)
+        self.states[BucketState.DELETED] += 1
+        self.index.add_tombstone(bucket_name, BucketState.DELETED)
+
+    def unbury(self, bucket_name: str):
+        del self.tombstones[bucket_name]
+        self.states[BucketState.DELETED] -= 1
+        self.index.remove_tombstone(bucket_name, BucketState.DELETED)
+
+    def purge(self, upto_seq: int, limit: int) -> int:
+        """
+        Drop up to `limit` of the oldest tombstones, those of deletions up
+        to upto_seq. Returns how many were dropped.
+        """
+        names = []
+        for name, (seq, _) in self.tombstones.items():
+            if seq > upto_seq or len(names) == limit:
+                break
+            names.append(name)
+        for name in names:
+            self.unbury(name)
+        return len(names)
+
+    def adopt(self, bucket: Bucket):
+        """
+        Take a bucket over from the base snapshot, ahead of changing it.
+        The base's counts and digests include it already, so those are
+        backed out here as it's inserted. It goes in before it's marked
+        shadowed, so a lock-free reader finds it in one place or the other.
+        """
+        self.states[bucket.state] -= 1
+        leaves = self.leaves.setdefault(bucket.cluster, {})
+        index = leaf_of(bucket.name)
+        leaf = leaves.get(index)
+        if leaf is None:
+            leaf = leaves[index] = _Leaf()
+        leaf.digest ^= entry_hash(bucket.name, bucket.owner)
+        self.insert(bucket)
+        self.shadowed.add(bucket.name)
+
+
+def _update_path(state: BucketState) -> tuple:
+    if state not in _UPDATE_STATES:
+        raise Exception(f"Unknown state '{state}'")
+    return (state,)
+
+
+def _batch_path(op: tuple) -> tuple:
+    """The states a batch operation (see apply_batch()) moves its bucket through."""
+    if op[0] == "update":
+        return _update_path(op[4])
+    if op[0] in _OPERATIONS:
+        return _OPERATIONS[op[0]]
+    raise Exception(f"Unknown batch operation '{op[0]}'")
+
+
+def _row_bucket(bucket_name: str, cluster: str, owner: str, state: int) -> Bucket:
+    """A bucket record from a stored row, with the state as its number."""
+    b = Bucket.__new__(Bucket)
+    b.name, b.cluster, b.owner = bucket_name, cluster, owner
+    b.state = BucketState(state)
+    return b
+
+
+def _check_transition(
+    bucket: Bucket, bucket_name: str, cluster: str, owner: str, path: tuple, tombstone
+) -> BucketState:
+    """
+    Check each step of moving a bucket, whose current record is `bucket`
+    (None if there isn't one), through the states in `path` against
+    _TRANSITIONS, and return the state it ends up in. tombstone(name) gives
+    the (seq, cluster) tombstone of a deleted bucket, or None.
+    """
+    # Whether the bucket exists is checked first, then that the cluster and
+    # owner match, then the states.
+    if _TRANSITIONS[path[0]] == BucketState.NONE:
+        if bucket is not None:
             raise BucketAlreadyExistsError(bucket_name)
+        buried = tombstone(bucket_name)
+        if buried is not None and buried[1] != cluster:
+            raise BucketRecentlyDeletedError(bucket_name, buried[1])
+        state = BucketState.NONE
+    elif bucket is None:
+        raise BucketNotFoundError(bucket_name)
+    elif bucket.cluster != cluster:
+        raise MismatchedClusterError(bucket_name, bucket.cluster, cluster)
+    elif bucket.owner != owner:
+        raise MismatchedOwnerError(bucket_name, bucket.owner, owner)
+    else:
+        state = bucket.state
 
-        bucket = Bucket(bucket_name, cluster, owner)
-        logging.info(f"add_bucket: new bucket={bucket_name}")
+    for target in path:
+        required = _TRANSITIONS[target]
+        if state != required:
+            raise InvalidStateTransitionError(bucket_name, target, required)
+        state = target
+    return state
 
-        self.buckets[bucket_name] = bucket
-        self.buckets[bucket_name].state = BucketState.CREATING
-        logging.info(f"Added bucket: {self.buckets[bucket_name]}")
 
-    def delete_bucket(self, bucket_name: str, cluster: str, owner: str):
-        if bucket_name not in self.buckets:
-            logging.error(f"Bucket '{bucket_name}' not found")
-            raise BucketNotFoundError(bucket_name)
+class BucketDatabase:
+    """
+    The bucket table as the servicers use it, whatever stores it.
 
-        bucket = self.buckets[bucket_name]
-        logging.info(f"delete_bucket: current bucket={bucket}")
+    Backends implement the methods that raise NotImplementedError here,
+    checking mutations with _check_transition() so that they all follow
+    the same lifecycle and fail the same way. They also have `seq`, the
+    sequence number of the last mutation, and `tombstones_purged`.
+    """
 
-        if bucket.cluster != cluster:
-            logging.error(
-                f"Cluster '{cluster}' does not match existing cluster '{bucket.cluster}'"
-            )
-            raise MismatchedClusterError(bucket_name, bucket.cluster, cluster)
+    # Whether operations can block for a while, say on an fsync, so that
+    # the asyncio servicer has to run them on its executor.
+    blocking = False
 
-        if bucket.owner != owner:
-            logging.error(
-                f"Owner '{owner}' does not match existing owner '{bucket.owner}'"
-            )
-            raise MismatchedOwnerError(bucket_name, bucket.owner, owner)
+    # The ChangeFeed that every mutation is published to, in sequence
+    # order as it's applied, if there is one.
+    changes: ChangeFeed = None
+
+    def __len__(self):
+        return sum(
+            n for state, n in self.state_counts().items() if state != BucketState.DELETED
+        )
 
-        if bucket.state != BucketState.DELETING:
-            msg = "bucket '{bucket_name}' is not in the DELETING state"
-            logging.error(msg)
-            raise Exception(msg)
+    def state_counts(self) -> dict[BucketState, int]:
+        """
+        Number of buckets in each state, with tombstones as DELETED, without
+        locking the table.
+        """
+        raise NotImplementedError
 
-        logging.info(f"Deleting bucket: {self.buckets[bucket_name]}")
-        del self.buckets[bucket_name]
+    def get_bucket(self, bucket_name: str) -> Bucket:
+        """A bucket's current record, or None, without locking."""
+        raise NotImplementedError
 
-    def update_bucket(self, bucket_name: str, cluster: str, owner: str, state: str):
-        if bucket_name not in self.buckets:
-            logging.error(f"Bucket '{bucket_name}' not found")
+    def lookup_bucket(
+        self, bucket_name: str, cluster: str = None, owner: str = None
+    ) -> Bucket:
+        """
+        A bucket's current record, without locking. Raises if there isn't
+        one, or if it doesn't match a cluster or owner that is given.
+        """
+        bucket = self.get_bucket(bucket_name)
+        if bucket is None:
             raise BucketNotFoundError(bucket_name)
+        if cluster and bucket.cluster != cluster:
+            raise MismatchedClusterError(bucket_name, bucket.cluster, cluster)
+        if owner and bucket.owner != owner:
+            raise MismatchedOwnerError(bucket_name, bucket.owner, owner)
+        return bucket
+
+    def list_buckets(
+        self,
+        cluster: str = None,
+        owner: str = None,
+        state: BucketState = None,
+        after: str = "",
+        limit: int = 1000,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple[str, str, str, BucketState]]:
+        """
+        Up to limit (bucket, cluster, owner, state) entries matching the
+        filters that are set, in bucket name order, starting after the
+        bucket named `after` (or with it, if inclusive) and stopping before
+        `end` if it is set. Deleted buckets aren't listed; see
+        list_tombstones().
+        """
+        raise NotImplementedError
+
+    def list_tombstones(
+        self,
+        cluster: str = None,
+        after: str = "",
+        limit: int = 1000,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple[str, str, int]]:
+        """
+        Up to limit (bucket, cluster, seq) tombstones, on the given cluster
+        if it is set, in bucket name order, between the same bounds as for
+        list_buckets().
+        """
+        raise NotImplementedError
+
+    def cluster_digests(self, cluster: str) -> list[int]:
+        """The reconciliation leaf digests of a cluster's entries."""
+        raise NotImplementedError
+
+    def cluster_leaf_entries(
+        self, cluster: str, indexes
+    ) -> dict[int, list[tuple[str, str]]]:
+        """A cluster's (bucket, owner) entries in each of the given leaves."""
+        raise NotImplementedError
+
+    def purge_tombstones(self, upto_seq: int) -> int:
+        """
+        Drop the tombstones of deletions up to upto_seq, a batch at a time.
+        Returns how many were dropped.
+        """
+        raise NotImplementedError
+
+    def start_compactor(self, retention: float, interval: float = 1.0):
+        """
+        Purge tombstones from a background thread once they are retention
+        seconds old. Every interval seconds it notes the current sequence
+        number; a deletion numbered at or below one noted at least
+        retention seconds ago is at least that old.
+        """
+
+        def loop():
+            marks = deque()
+            while True:
+                now = time.monotonic()
+                marks.append((now, self.seq))
+                upto = None
+                while marks and marks[0][0] <= now - retention:
+                    upto = marks.popleft()[1]
+                if upto is not None:
+                    try:
+                        purged = self.purge_tombstones(upto)
+                        logging.debug("Purged %d tombstones", purged)
+                    except Exception as e:
+                        logging.error(f"Tombstone compaction failed: {e}")
+                time.sleep(interval)
+
+        t = threading.Thread(target=loop, name="compactor", daemon=True)
+        t.start()
+        return t
+
+    def add_bucket(self, bucket_name: str, cluster: str, owner: str):
+        """Add a bucket in the CREATING state."""
+        self._transition(bucket_name, cluster, owner, _OPERATIONS["add"])
+
+    def create_bucket(self, bucket_name: str, cluster: str, owner: str):
+        """Add a bucket straight into the CREATED state."""
+        self._transition(bucket_name, cluster, owner, _OPERATIONS["create"])
 
-        bucket = self.buckets[bucket_name]
-        logging.info(f"update_bucket: current bucket={bucket}")
+    def delete_bucket(self, bucket_name: str, cluster: str, owner: str):
+        """Remove a bucket in the DELETING state."""
+        self._transition(bucket_name, cluster, owner, _OPERATIONS["delete"])
+
+    def destroy_bucket(self, bucket_name: str, cluster: str, owner: str):
+        """Remove a bucket in the CREATED state, by way of DELETING."""
+        self._transition(bucket_name, cluster, owner, _OPERATIONS["destroy"])
+
+    def update_bucket(
+        self, bucket_name: str, cluster: str, owner: str, state: BucketState
+    ):
+        self._transition(bucket_name, cluster, owner, _update_path(state))
+
+    def _transition(self, bucket_name: str, cluster: str, owner: str, path: tuple):
+        """
+        Move a bucket through the states in `path`, durably, or raise and
+        change nothing.
+        """
+        raise NotImplementedError
+
+    def apply_batch(self, operations: list[tuple]) -> list:
+        """
+        Apply a batch of operations, each a tuple of "add", "create",
+        "update", "delete" or "destroy" followed by the arguments of the
+        matching method, e.g. ("update", bucket_name, cluster, owner, state).
+        Each operation sees the effects of the earlier ones. Returns a list
+        with, for each operation, None if it succeeded or the exception it
+        raised.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class BucketNameDatabase(BucketDatabase):
+    """
+    The in-memory backend: the bucket table striped across shards keyed by
+    a hash of the bucket name, made durable by a write-ahead log.
+
+    Each operation holds its shard's lock for the whole check-then-act
+    sequence, so operations on one bucket are linearizable while unrelated
+    buckets in other shards proceed in parallel.
+
+    Reads take no lock at all. Records are immutable and a mutation swaps
+    one in or out with a single dict store, so a reader sees a bucket
+    either as it was before a mutation or after it, and never waits for one.
+
+    Restarting from a snapshot doesn't load it. The mapped snapshot is the
+    base of the table and the shards only hold what has changed since: a
+    bucket is copied out of the base the first time it is mutated, and
+    from then on the shard's copy, or its absence, is what counts. The
+    state counts and reconciliation digests are the base's plus the
+    shards', and listings merge the base's indexes with the shards'.
+
+    A deletion leaves a tombstone, the bucket name with the deletion's
+    sequence number and cluster, which is kept for a retention period
+    (see start_compactor()). Until it's purged, only the cluster the bucket
+    was deleted from can re-create it. Tombstones count as DELETED buckets
+    in state_counts(), but are otherwise only seen by list_tombstones().
+    """
+
+    # Tombstones purged per hold of a shard lock, so that compaction never
+    # holds up a shard's mutations for long.
+    PURGE_BATCH = 256
+
+    def __init__(self, wal: WriteAheadLog = None, shards: int = 16):
+        self.index = BucketIndex(BucketState)
+        self.shards = [_Shard(self.index) for _ in range(shards)]
+        self.wal = wal
+        self.seq = 0
+        self.base: Snapshot = None
+        self.tombstones_purged = 0
+        # Assigns sequence numbers and appends to the log as one step, so
+        # that log order matches sequence order. It is only ever taken with
+        # a shard lock held (or alone), never the other way round.
+        self._seq_lock = threading.Lock()
+        if wal is not None:
+            self.seq = wal.recover(self._apply, self._load)
+
+    def _shard_index(self, bucket_name: str) -> int:
+        # By reconciliation leaf, so that each leaf lives in one shard.
+        return leaf_of(bucket_name) % len(self.shards)
+
+    def _shard(self, bucket_name: str) -> _Shard:
+        return self.shards[self._shard_index(bucket_name)]
+
+    @property
+    def blocking(self):
+        return self.wal is not None
+
+    def state_counts(self) -> dict[BucketState, int]:
+        counts = {state: 0 for state in BucketState}
+        if self.base is not None:
+            for state in BucketState:
+                counts[state] = self.base.state_counts[state.value]
+        for shard in self.shards:
+            for state, n in shard.states.items():
+                counts[state] += n
+        return counts
+
+    def _load(self, snapshot: Snapshot):
+        """Make a mapped snapshot the base of the table, during recovery."""
+        self.base = snapshot
+        for name, cluster, seq in snapshot.tombstones():
+            self._shard(name).bury(name, cluster, seq)
+
+    def _base_bucket(self, bucket_name: str) -> Bucket:
+        """A bucket's record in the base snapshot, or None."""
+        found = self.base.get(bucket_name) if self.base is not None else None
+        if found is None:
+            return None
+        return _row_bucket(bucket_name, *found)
+
+    def _find_locked(self, shard: _Shard, bucket_name: str) -> Bucket:
+        """
+        A bucket's current record, which may still be in the base
+        snapshot, or None. Caller must hold the shard lock.
+        """
+        bucket = shard.buckets.get(bucket_name)
+        if bucket is None and bucket_name not in shard.shadowed:
+            bucket = self._base_bucket(bucket_name)
+        return bucket
+
+    @staticmethod
+    def _own(shard: _Shard, bucket: Bucket):
+        """Make sure a record is in the shard, so that it can be changed."""
+        if shard.buckets.get(bucket.name) is not bucket:
+            shard.adopt(bucket)
+
+    def _apply(self, record: dict):
+        """Apply a logged record during recovery."""
+        shard = self._shard(record["bucket"])
+        old = self._find_locked(shard, record["bucket"])
+        if old is not None:
+            self._own(shard, old)
+        if record["op"] == "put":
+            bucket = Bucket(record["bucket"], record["cluster"], record["owner"])
+            bucket.state = BucketState[record["state"]]
+            if old is not None:
+                shard.remove(old)
+            shard.insert(bucket)
+        elif record["op"] == "del":
+            if old is not None:
+                shard.remove(old)
+            # Records from before tombstones have no cluster.
+            if "cluster" in record:
+                shard.bury(record["bucket"], record["cluster"], record["seq"])
+        else:
+            raise Exception(f"Unknown log record op '{record['op']}'")
+
+    def _log_put(self, bucket: Bucket, state: BucketState):
+        """
+        Log a bucket as it will be in `state`, before it's changed. Caller
+        must hold its shard lock.
+        """
+        record = {
+            "op": "put",
+            "bucket": bucket.name,
+            "cluster": bucket.cluster,
+            "owner": bucket.owner,
+            "state": state.name,
+        }
+        return self._log(record, bucket.owner, state)
+
+    def _log_del(self, bucket: Bucket):
+        """
+        Log a bucket's removal, before it's removed. Returns the ticket and
+        the sequence number for its tombstone. Caller must hold its shard
+        lock.
+        """
+        record = {"op": "del", "bucket": bucket.name, "cluster": bucket.cluster}
+        return self._log(record, bucket.owner, BucketState.DELETED), record["seq"]
+
+    def _log(self, record: dict, owner: str, state: BucketState):
+        """
+        Number a record, append it to the log, then publish it to watchers.
+        If the log has failed this raises, and the record is neither
+        numbered nor published, so it must be called before the change is
+        made.
+        """
+        with self._seq_lock:
+            seq = self.seq + 1
+            record["seq"] = seq
+            ticket = None
+            if self.wal is not None:
+                ticket = self.wal.append(record)
+            self.seq = seq
+            if self.changes is not None:
+                self.changes.publish(
+                    seq, record["bucket"], record["cluster"], owner, state
+                )
+            return ticket
 
-        if bucket.cluster != cluster:
-            logging.error(
-                f"Cluster '{cluster}' does not match existing cluster '{bucket.cluster}'"
+    def _wait_durable(self, ticket):
+        # Called without the shard lock held, so that concurrent mutations
+        # can share an fsync.
+        if ticket is not None:
+            self.wal.wait(ticket)
+
+    def cluster_digests(self, cluster: str) -> list[int]:
+        if self.base is not None:
+            digests = self.base.leaf_digests(cluster)
+        else:
+            digests = [0] * LEAVES
+        for shard in self.shards:
+            with shard.lock:
+                leaves = shard.leaves.get(cluster, {})
+                for index, leaf in leaves.items():
+                    digests[index] ^= leaf.digest
+        return digests
+
+    def cluster_leaf_entries(
+        self, cluster: str, indexes
+    ) -> dict[int, list[tuple[str, str]]]:
+        entries = {}
+        for index in indexes:
+            shard = self.shards[index % len(self.shards)]
+            with shard.lock:
+                leaf = shard.leaves.get(cluster, {}).get(index)
+                found = (
+                    [(name, shard.buckets[name].owner) for name in leaf.names]
+                    if leaf
+                    else []
+                )
+                if self.base is not None:
+                    found.extend(
+                        entry
+                        for entry in self.base.leaf_entries(cluster, index)
+                        if entry[0] not in shard.shadowed
+                    )
+                entries[index] = found
+        return entries
+
+    def get_bucket(self, bucket_name: str) -> Bucket:
+        shard = self._shard(bucket_name)
+        # Shadowed is checked first: a bucket taken over from the base is
+        # in the shard before it's marked shadowed.
+        shadowed = bucket_name in shard.shadowed
+        bucket = shard.buckets.get(bucket_name)
+        if bucket is None and not shadowed:
+            bucket = self._base_bucket(bucket_name)
+        return bucket
+
+    def list_buckets(
+        self,
+        cluster: str = None,
+        owner: str = None,
+        state: BucketState = None,
+        after: str = "",
+        limit: int = 1000,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple[str, str, str, BucketState]]:
+        """
+        The names come from the most selective index for the filters, and
+        are checked against the rest; a filter that matches little of that
+        index can mean reading a lot of it to fill a page. The bounds are
+        found in the index, so only names between them are read.
+        """
+        entries = []
+        chunk = max(limit, 256)
+        while len(entries) < limit:
+            names = self.index.candidates_after(
+                cluster, owner, state, after, chunk, end, inclusive
             )
-            raise MismatchedClusterError(bucket_name, bucket.cluster, cluster)
+            if self.base is not None:
+                names = self._merge_base_candidates(
+                    names, cluster, owner, state, after, chunk, end, inclusive
+                )
+            if not names:
+                break
+            for name in names:
+                b = self.get_bucket(name)
+                # It may have changed since the index was read.
+                if (
+                    b is not None
+                    and (not cluster or b.cluster == cluster)
+                    and (not owner or b.owner == owner)
+                    and (state is None or b.state == state)
+                ):
+                    entries.append((b.name, b.cluster, b.owner, b.state))
+                    if len(entries) == limit:
+                        break
+            after, inclusive = names[-1], False
+        return entries
+
+    def _merge_base_candidates(
+        self, names, cluster, owner, state, after, chunk, end, inclusive
+    ):
+        """
+        The shards' candidate names merged with the base snapshot's, up to
+        where either list was cut short, so that nothing between is missed.
+        """
+        base_names = self.base.candidates_after(
+            cluster,
+            owner,
+            state.value if state is not None else None,
+            after,
+            chunk,
+            end,
+            inclusive,
+        )
+        bound = None
+        for cut in (names, base_names):
+            if len(cut) == chunk and (bound is None or cut[-1] < bound):
+                bound = cut[-1]
+        merged = sorted(set(names).union(base_names))
+        if bound is not None:
+            del merged[bisect_right(merged, bound) :]
+        return merged
+
+    def checkpoint(self):
+        """
+        Write a snapshot and drop the log segments it covers. Mutations are
+        only blocked while the log is rotated, and then one shard at a time
+        while it is copied.
 
-        if bucket.owner != owner:
-            logging.error(
-                f"Owner '{owner}' does not match existing owner '{bucket.owner}'"
+        The table keeps serving from the base snapshot it started with; the
+        new one is only mapped on the next restart.
+        """
+        with self._seq_lock:
+            last_seq = self.seq
+            self.wal.rotate(last_seq + 1)
+        buckets, tombstones = [], []
+        for shard in self.shards:
+            with shard.lock:
+                buckets.extend(shard.buckets.values())
+                tombstones.extend(
+                    (name, cluster, seq)
+                    for name, (seq, cluster) in shard.tombstones.items()
+                )
+        buckets.sort(key=lambda b: b.name)
+        tombstones.sort(key=lambda t: t[2])
+        changed = ((b.name, b.cluster, b.owner, b.state.value) for b in buckets)
+        if self.base is None:
+            entries = changed
+        else:
+            # A base entry shadowed after the shards were copied is in
+            # neither, but it changed after last_seq, so the log has it.
+            unchanged = (
+                entry
+                for entry in self.base.entries()
+                if entry[0] not in self._shard(entry[0]).shadowed
             )
-            raise MismatchedOwnerError(bucket_name, bucket.owner, owner)
+            entries = heapq.merge(changed, unchanged)
+        self.wal.write_snapshot(last_seq, entries, tombstones)
 
-        if state == BucketState.CREATED:
-            if bucket.state != BucketState.CREATING:
-                msg = f"bucket '{bucket_name}' is not in the CREATING state for CREATED update"
-                logging.error(msg)
-                raise Exception(msg)
-            else:
-                bucket.state = BucketState.CREATED
-                logging.info(f"Updated bucket: {self.buckets[bucket_name]}")
-        elif state == BucketState.DELETING:
-            if bucket.state != BucketState.CREATED:
-                msg = f"bucket '{bucket_name}' is not in the CREATED state for DELETING update"
-                logging.error(msg)
-                raise Exception(msg)
-            else:
-                bucket.state = BucketState.DELETING
-                logging.info(f"Updated bucket: {self.buckets[bucket_name]}")
+    def list_tombstones(
+        self,
+        cluster: str = None,
+        after: str = "",
+        limit: int = 1000,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple[str, str, int]]:
+        entries = []
+        chunk = max(limit, 256)
+        while len(entries) < limit:
+            names = self.index.candidates_after(
+                None, None, BucketState.DELETED, after, chunk, end, inclusive
+            )
+            if not names:
+                break
+            for name in names:
+                tombstone = self._shard(name).tombstones.get(name)
+                # It may have been purged since the index was read.
+                if tombstone is not None and (not cluster or tombstone[1] == cluster):
+                    entries.append((name, tombstone[1], tombstone[0]))
+                    if len(entries) == limit:
+                        break
+            after, inclusive = names[-1], False
+        return entries
+
+    def purge_tombstones(self, upto_seq: int) -> int:
+        # PURGE_BATCH at a time per shard.
+        purged = 0
+        for shard in self.shards:
+            while True:
+                with shard.lock:
+                    n = shard.purge(upto_seq, self.PURGE_BATCH)
+                purged += n
+                if n < self.PURGE_BATCH:
+                    break
+        self.tombstones_purged += purged
+        return purged
+
+    def close(self):
+        if self.wal is not None:
+            self.wal.close()
+
+    def start_checkpointer(self, interval: float, max_records: int):
+        """
+        Snapshot from a background thread every interval seconds, or sooner
+        if max_records have been logged since the last one.
+        """
+
+        def loop():
+            last = time.monotonic()
+            while True:
+                time.sleep(1)
+                pending = self.wal.records_since_rotate
+                if pending == 0:
+                    last = time.monotonic()
+                    continue
+                if pending >= max_records or time.monotonic() - last >= interval:
+                    try:
+                        self.checkpoint()
+                    except Exception as e:
+                        logging.error(f"Checkpoint failed: {e}")
+                    last = time.monotonic()
+
+        t = threading.Thread(target=loop, name="checkpointer", daemon=True)
+        t.start()
+        return t
+
+    def _transition(self, bucket_name: str, cluster: str, owner: str, path: tuple):
+        shard = self._shard(bucket_name)
+        with shard.lock:
+            ticket = self._transition_locked(shard, bucket_name, cluster, owner, path)
+        self._wait_durable(ticket)
+
+    def _transition_locked(
+        self, shard: _Shard, bucket_name: str, cluster: str, owner: str, path: tuple
+    ):
+        """
+        Move a bucket through the states in `path`, checking each step
+        against _TRANSITIONS, and log where it ends up. Either every step
+        is allowed and the bucket ends up at the last, in one change, or
+        nothing changes. Caller must hold the shard lock.
+        """
+        bucket = self._find_locked(shard, bucket_name)
+        logging.debug("transition: bucket=%s path=%s", bucket or bucket_name, path)
+        state = _check_transition(
+            bucket, bucket_name, cluster, owner, path, shard.tombstones.get
+        )
+
+        # Logged first, so that if the log has failed nothing changes.
+        if bucket is None:
+            bucket = Bucket(bucket_name, cluster, owner)
+            ticket = self._log_put(bucket, state)
+            bucket.state = state
+            shard.insert(bucket)
+        elif state == BucketState.NONE:
+            ticket, seq = self._log_del(bucket)
+            self._own(shard, bucket)
+            shard.remove(bucket)
+            shard.bury(bucket.name, bucket.cluster, seq)
+            logging.debug("Removed bucket: %s", bucket)
+            return ticket
+        else:
+            ticket = self._log_put(bucket, state)
+            self._own(shard, bucket)
+            bucket = shard.set_state(bucket, state)
+        logging.debug("Bucket now: %s", bucket)
+        return ticket
+
+    def apply_batch(self, operations: list[tuple]) -> list:
+        """
+        The shards the batch touches are locked once, in index order, for
+        the whole batch, and the batch waits for durability once at the end.
+        """
+        indexes = sorted({self._shard_index(op[1]) for op in operations})
+        results = []
+        ticket = None
+        for i in indexes:
+            self.shards[i].lock.acquire()
+        try:
+            for op in operations:
+                try:
+                    path = _batch_path(op)
+                    t = self._transition_locked(self._shard(op[1]), *op[1:4], path)
+                    ticket = t if t is not None else ticket
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+        finally:
+            for i in reversed(indexes):
+                self.shards[i].lock.release()
+        self._wait_durable(ticket)
+        return results
+
+
+class SQLiteBucketDatabase(BucketDatabase):
+    """
+    The SQLite backend: the bucket table in a ubns_sqlite.BucketTable on
+    disk, so it can be larger than memory.
+
+    Mutations are serialized by the table's one writer lock rather than
+    striped across shards, and wait for a group commit after releasing it.
+    Reads go through per-thread connections that take no lock and see the
+    table as of the last commit, which every mutation waits for before it
+    returns. A mutation's own lookups go through the table's Bloom filter
+    first, so a create mostly doesn't read the disk.
+    """
+
+    blocking = True
+
+    # Tombstones purged per hold of the writer lock.
+    PURGE_BATCH = 256
+
+    def __init__(self, table: BucketTable):
+        self.table = table
+        self.tombstones_purged = 0
+
+    @property
+    def seq(self):
+        return self.table.seq
+
+    def state_counts(self) -> dict[BucketState, int]:
+        counts = {state: 0 for state in BucketState}
+        for state, n in self.table.state_counts().items():
+            counts[BucketState(state)] += n
+        counts[BucketState.DELETED] += self.table.tombstone_count()
+        return counts
+
+    def get_bucket(self, bucket_name: str) -> Bucket:
+        found = self.table.get(bucket_name)
+        if found is None:
+            return None
+        return _row_bucket(bucket_name, *found)
+
+    def list_buckets(
+        self,
+        cluster: str = None,
+        owner: str = None,
+        state: BucketState = None,
+        after: str = "",
+        limit: int = 1000,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple[str, str, str, BucketState]]:
+        rows = self.table.rows_after(
+            cluster,
+            owner,
+            state.value if state is not None else None,
+            after,
+            limit,
+            end,
+            inclusive,
+        )
+        return [(name, c, o, BucketState(s)) for name, c, o, s in rows]
+
+    def list_tombstones(
+        self,
+        cluster: str = None,
+        after: str = "",
+        limit: int = 1000,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple[str, str, int]]:
+        return self.table.tombstones_after(cluster, after, limit, end, inclusive)
+
+    def cluster_digests(self, cluster: str) -> list[int]:
+        return self.table.leaf_digests(cluster)
+
+    def cluster_leaf_entries(
+        self, cluster: str, indexes
+    ) -> dict[int, list[tuple[str, str]]]:
+        return {index: self.table.leaf_entries(cluster, index) for index in indexes}
+
+    def purge_tombstones(self, upto_seq: int) -> int:
+        purged = 0
+        while True:
+            with self.table.lock:
+                n = self.table.purge(upto_seq, self.PURGE_BATCH)
+                ticket = self.table.ticket()
+            self.table.wait(ticket)
+            purged += n
+            if n < self.PURGE_BATCH:
+                break
+        self.tombstones_purged += purged
+        return purged
+
+    def _transition(self, bucket_name: str, cluster: str, owner: str, path: tuple):
+        with self.table.lock:
+            self._transition_locked(bucket_name, cluster, owner, path)
+            ticket = self.table.ticket()
+        self.table.wait(ticket)
+
+    def _transition_locked(
+        self, bucket_name: str, cluster: str, owner: str, path: tuple
+    ):
+        """As BucketNameDatabase._transition_locked(), under the writer lock."""
+        # So that once the store has failed nothing changes, as for the log.
+        self.table.check()
+        found = self.table.find(bucket_name)
+        bucket = _row_bucket(bucket_name, *found) if found is not None else None
+        logging.debug("transition: bucket=%s path=%s", bucket or bucket_name, path)
+        state = _check_transition(
+            bucket, bucket_name, cluster, owner, path, self.table.tombstone
+        )
+
+        if bucket is None:
+            self.table.insert(bucket_name, cluster, owner, state.value)
+            bucket = Bucket(bucket_name, cluster, owner)
+        elif state == BucketState.NONE:
+            self.table.remove(bucket_name, cluster, owner, bucket.state.value)
+            logging.debug("Removed bucket: %s", bucket)
+            state = BucketState.DELETED
         else:
-            raise Exception(f"Unknown state '{state}'")
+            self.table.set_state(bucket_name, bucket.state.value, state.value)
+        if self.changes is not None:
+            self.changes.publish(
+                self.table.seq, bucket_name, bucket.cluster, bucket.owner, state
+            )
+
+    def apply_batch(self, operations: list[tuple]) -> list:
+        """
+        The whole batch is applied under one hold of the writer lock, and
+        committed together.
+        """
+        results = []
+        with self.table.lock:
+            for op in operations:
+                try:
+                    self._transition_locked(*op[1:4], _batch_path(op))
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+            ticket = self.table.ticket()
+        self.table.wait(ticket)
+        return results
+
+    def close(self):
+        self.table.close()
+
+
+# How database errors are reported to clients. Anything not listed here is
+# reported as INVALID_ARGUMENT.
+_ERROR_STATUS = {
+    BucketAlreadyExistsError: grpc.StatusCode.ALREADY_EXISTS,
+    BucketRecentlyDeletedError: grpc.StatusCode.ALREADY_EXISTS,
+    BucketNotFoundError: grpc.StatusCode.NOT_FOUND,
+    MismatchedClusterError: grpc.StatusCode.FAILED_PRECONDITION,
+    MismatchedOwnerError: grpc.StatusCode.FAILED_PRECONDITION,
+    # The server can't persist anything until it's restarted on working
+    # storage; the caller should try another, or later.
+    WALFailedError: grpc.StatusCode.UNAVAILABLE,
+    StoreFailedError: grpc.StatusCode.UNAVAILABLE,
+}
+
+
+# Failures of the storage rather than of the request, which a retry of the
+# request may not meet.
+_STORAGE_ERRORS = (OSError, WALFailedError, StoreFailedError)
+
+
+def _status_for_exception(e: Exception) -> grpc.StatusCode:
+    return _ERROR_STATUS.get(type(e), grpc.StatusCode.INVALID_ARGUMENT)
+
+
+def _update_state(state: ubdb_pb2.BucketState) -> BucketState:
+    """The database state for an UpdateBucketEntryRequest state."""
+    if state == ubdb_pb2.BucketState.BUCKET_STATE_CREATED:
+        return BucketState.CREATED
+    elif state == ubdb_pb2.BucketState.BUCKET_STATE_DELETING:
+        return BucketState.DELETING
+    else:
+        raise Exception(f"Unknown update state '{state}'")
+
+
+# ListBucketEntries page sizes.
+LIST_PAGE_SIZE = 1000
+MAX_LIST_PAGE_SIZE = 10000
+
+# Database states as reported by, and filtered on by, ListBucketEntries.
+_ENTRY_STATES = {
+    BucketState.CREATING: ubdb_pb2.BucketState.BUCKET_STATE_CREATING,
+    BucketState.CREATED: ubdb_pb2.BucketState.BUCKET_STATE_CREATED,
+    BucketState.DELETING: ubdb_pb2.BucketState.BUCKET_STATE_DELETING,
+    BucketState.DELETED: ubdb_pb2.BucketState.BUCKET_STATE_DELETED,
+}
+_LIST_STATES = {v: k for k, v in _ENTRY_STATES.items()}
+
+
+def _list_state(state: ubdb_pb2.BucketState) -> BucketState:
+    """The database state for a ListBucketEntriesRequest filter, or None."""
+    if state == ubdb_pb2.BucketState.BUCKET_STATE_UNSPECIFIED:
+        return None
+    if state not in _LIST_STATES:
+        raise Exception(f"Unknown list state '{state}'")
+    return _LIST_STATES[state]
+
+
+def _list_page_size(page_size: int) -> int:
+    return min(page_size or LIST_PAGE_SIZE, MAX_LIST_PAGE_SIZE)
+
+
+def _list_bounds(request) -> tuple[str, bool, str]:
+    """
+    The names a ListBucketEntriesRequest covers, as the (after, inclusive,
+    end) of list_buckets(): from its prefix or start_at, whichever is later,
+    to its end_before or the end of its prefix, whichever is sooner. A page
+    token moves the start on.
+    """
+    start = max(request.prefix, request.start_at)
+    end = prefix_end(request.prefix) if request.prefix else None
+    if request.end_before and (end is None or request.end_before < end):
+        end = request.end_before
+    if request.page_token >= start:
+        return request.page_token, False, end
+    return start, True, end
+
+
+# Most changes read from the feed per WatchBucketEntries message, and how
+# long a watch waits for a change before checking on its caller.
+WATCH_BATCH = 1000
+WATCH_IDLE = 1.0
+
+
+def _watch_response(request, changes: list) -> ubdb_pb2.WatchBucketEntriesResponse:
+    """
+    A watch message for ChangeFeed changes, holding those that match the
+    request's filters, with seq reaching the last of them all.
+    """
+    response = ubdb_pb2.WatchBucketEntriesResponse(seq=changes[-1][0])
+    for seq, name, cluster, owner, state in changes:
+        if request.cluster and cluster != request.cluster:
+            continue
+        if request.owner and owner != request.owner:
+            continue
+        entry = response.changes.add(seq=seq).entry
+        entry.bucket = name
+        entry.cluster = cluster
+        entry.owner = owner
+        entry.state = _ENTRY_STATES[state]
+        if state == BucketState.DELETED:
+            entry.deleted_seq = seq
+    return response
+
+
+def _get_error_result(code: grpc.StatusCode, message: str):
+    return ubdb_pb2.GetBucketEntryResult(code=code.value[0], message=message)
+
+
+def _bucket_entry(bucket: Bucket) -> ubdb_pb2.BucketEntry:
+    return ubdb_pb2.BucketEntry(
+        bucket=bucket.name,
+        cluster=bucket.cluster,
+        owner=bucket.owner,
+        state=_ENTRY_STATES[bucket.state],
+    )
+
+
+def _batch_operation(op: ubdb_pb2.BucketEntryOperation) -> tuple:
+    """The BucketDatabase.apply_batch() operation for a batch entry."""
+    kind = op.WhichOneof("operation")
+    if kind == "add_entry":
+        r = op.add_entry
+        return ("add", r.bucket, r.cluster, r.owner)
+    elif kind == "update_entry":
+        r = op.update_entry
+        return ("update", r.bucket, r.cluster, r.owner, _update_state(r.state))
+    elif kind == "delete_entry":
+        r = op.delete_entry
+        return ("delete", r.bucket, r.cluster, r.owner)
+    elif kind == "create_entry":
+        r = op.create_entry
+        return ("create", r.bucket, r.cluster, r.owner)
+    elif kind == "destroy_entry":
+        r = op.destroy_entry
+        return ("destroy", r.bucket, r.cluster, r.owner)
+    else:
+        raise Exception("batch operation has no entry")
+
+
+def _batch_error_result(code: grpc.StatusCode, message: str):
+    return ubdb_pb2.BucketEntryResult(code=code.value[0], message=message)
+
+
+def _batch_result(e: Exception):
+    if e is None:
+        return ubdb_pb2.BucketEntryResult(code=grpc.StatusCode.OK.value[0])
+    return _batch_error_result(_status_for_exception(e), str(e))
+
+
+# Mutations whose outcome a retry with the same request ID gets again.
+_DEDUPLICATED = frozenset(
+    (
+        "AddBucketEntry",
+        "DeleteBucketEntry",
+        "UpdateBucketEntry",
+        "CreateBucketEntry",
+        "DestroyBucketEntry",
+    )
+)
 
 
 class UBDBServer(ubdb_pb2_grpc.UBDBServiceServicer):
 
-    def __init__(self):
-        self.db = BucketNameDatabase()
+    def __init__(
+        self,
+        db: BucketDatabase = None,
+        router: PartitionRouter = None,
+        access_log: AccessLog = None,
+        request_cache: RequestCache = None,
+        max_watchers: int = 4,
+    ):
+        self.db = db if db is not None else BucketNameDatabase()
+        # In multi-process mode, where buckets that this process doesn't own
+        # are sent.
+        self.router = router
+        self.access_log = access_log if access_log is not None else AccessLog()
+        # Outcomes of recent mutations by request ID, or None to not
+        # deduplicate. Only the worker that runs a mutation records it.
+        self.request_cache = request_cache
+        # WatchBucketEntries streams open, out of at most max_watchers, and
+        # how many have ended in a resync.
+        self.max_watchers = max_watchers
+        self.watchers = 0
+        self.watch_resyncs = 0
+        self._watch_lock = threading.Lock()
 
     def set_context_error(self, context, e: Exception):
         context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
@@ -181,64 +1315,885 @@ class UBDBServer(ubdb_pb2_grpc.UBDBServiceServicer):
         context.set_details(details)
         return
 
-    def AddBucketEntry(self, request, context):
-        logging.info(
-            f"received: AddBucketEntry: bucket={request.bucket} cluster={request.cluster} owner={request.owner}"
+    # The operations proper, shared by the sync and asyncio servicers. They
+    # raise on failure; the callers turn that into a status.
+
+    def _add_bucket_entry(self, request):
+        self.db.add_bucket(request.bucket, request.cluster, request.owner)
+        return ubdb_pb2.AddBucketEntryResponse()
+
+    def _delete_bucket_entry(self, request):
+        self.db.delete_bucket(request.bucket, request.cluster, request.owner)
+        return ubdb_pb2.DeleteBucketEntryResponse()
+
+    def _update_bucket_entry(self, request):
+        bstate = _update_state(request.state)
+        self.db.update_bucket(request.bucket, request.cluster, request.owner, bstate)
+        return ubdb_pb2.UpdateBucketEntryResponse()
+
+    def _create_bucket_entry(self, request):
+        self.db.create_bucket(request.bucket, request.cluster, request.owner)
+        return ubdb_pb2.CreateBucketEntryResponse()
+
+    def _destroy_bucket_entry(self, request):
+        self.db.destroy_bucket(request.bucket, request.cluster, request.owner)
+        return ubdb_pb2.DestroyBucketEntryResponse()
+
+    def _get_bucket_entry(self, request):
+        bucket = self.db.lookup_bucket(request.bucket, request.cluster, request.owner)
+        return ubdb_pb2.GetBucketEntryResponse(entry=_bucket_entry(bucket))
+
+    def _get_result(self, request):
+        try:
+            entry = self._get_bucket_entry(request).entry
+        except Exception as e:
+            return _get_error_result(_status_for_exception(e), str(e))
+        return ubdb_pb2.GetBucketEntryResult(
+            code=grpc.StatusCode.OK.value[0], entry=entry
+        )
+
+    def _plan_gets(self, request):
+        """
+        Look up the entries of a GetBucketEntries request that are held
+        here. Returns a results list with those filled in and, in
+        multi-process mode, sub-requests for other workers as
+        {owner: (positions, request)}.
+        """
+        results = [None] * len(request.entries)
+        remote = {}
+        for i, r in enumerate(request.entries):
+            if self._is_remote(r):
+                positions, sub = remote.setdefault(
+                    self.router.owner(r.bucket),
+                    ([], ubdb_pb2.GetBucketEntriesRequest()),
+                )
+                positions.append(i)
+                sub.entries.append(r)
+            else:
+                results[i] = self._get_result(r)
+        return results, remote
+
+    def _gets_response(self, results, remote_results, start):
+        for positions, sub_results in remote_results:
+            for i, result in zip(positions, sub_results):
+                results[i] = result
+        failed = sum(1 for r in results if r.code != grpc.StatusCode.OK.value[0])
+        self.access_log.batch(
+            "GetBucketEntries", len(results), failed, time.perf_counter() - start
+        )
+        return ubdb_pb2.GetBucketEntriesResponse(results=results)
+
+    def _plan_batch(self, request):
+        """
+        Convert a batch into database operations. Returns the local
+        operations as (position, operation) pairs, a results list with the
+        conversion failures already filled in, and, in multi-process mode,
+        sub-batches for other workers as {owner: (positions, request)}.
+        """
+        local = []
+        results = [None] * len(request.operations)
+        remote = {}
+        for i, op in enumerate(request.operations):
+            try:
+                operation = _batch_operation(op)
+            except Exception as e:
+                results[i] = _batch_result(e)
+                continue
+            if self.router is not None and not self.router.is_local(operation[1]):
+                positions, sub = remote.setdefault(
+                    self.router.owner(operation[1]),
+                    ([], ubdb_pb2.BatchBucketEntriesRequest()),
+                )
+                positions.append(i)
+                sub.operations.append(op)
+            else:
+                local.append((i, operation))
+        return local, results, remote
+
+    def _apply_local_batch(self, local, results):
+        applied = self.db.apply_batch([operation for _, operation in local])
+        for (i, _), e in zip(local, applied):
+            results[i] = _batch_result(e)
+
+    def _batch_response(self, results, remote_results, start):
+        for positions, sub_results in remote_results:
+            for i, result in zip(positions, sub_results):
+                results[i] = result
+        failed = sum(1 for r in results if r.code != grpc.StatusCode.OK.value[0])
+        self.access_log.batch(
+            "BatchBucketEntries", len(results), failed, time.perf_counter() - start
+        )
+        return ubdb_pb2.BatchBucketEntriesResponse(results=results)
+
+    def _is_remote(self, request) -> bool:
+        return self.router is not None and not self.router.is_local(request.bucket)
+
+    def _finish(
+        self, method, request, context, code, details, start, owner=None, replayed=False
+    ):
+        """Set the RPC's status and write its access log line."""
+        if code != grpc.StatusCode.OK:
+            self.set_context_code(context, code, details)
+        self.access_log.request(
+            method, request, code, details, time.perf_counter() - start, owner, replayed
         )
+
+    @staticmethod
+    def _run_local(op, request, response_type):
+        """
+        Run op, returning (response, code, details) and whether the outcome
+        can be given again to a retry. A failure to log can't: the retry
+        might succeed.
+        """
+        try:
+            return (op(request), grpc.StatusCode.OK, None), True
+        except Exception as e:
+            outcome = (response_type(), _status_for_exception(e), str(e))
+            return outcome, not isinstance(e, _STORAGE_ERRORS)
+
+    def _request_id(self, method, context):
+        """The request ID to deduplicate a call by, or None."""
+        if self.request_cache is None or method not in _DEDUPLICATED:
+            return None
+        return request_id_of(context)
+
+    def _run_once(self, method, op, request, context, response_type):
+        """
+        Run a local op, unless it's a retry of one with the same request ID,
+        in which case wait for that one's outcome. Returns (response, code,
+        details) and whether it was a retry.
+        """
         try:
-            self.db.add_bucket(request.bucket, request.cluster, request.owner)
-            return ubdb_pb2.AddBucketEntryResponse()
-        except BucketAlreadyExistsError as e:
-            self.set_context_code(context, grpc.StatusCode.ALREADY_EXISTS, str(e))
-            return ubdb_pb2.AddBucketEntryResponse()
+            rid = self._request_id(method, context)
+            if rid is None:
+                return self._run_local(op, request, response_type)[0], False
+            outcome, first = self.request_cache.begin(method, rid, request)
         except Exception as e:
-            self.set_context_error(context, e)
-            return ubdb_pb2.AddBucketEntryResponse()
+            return (response_type(), _status_for_exception(e), str(e)), False
+        if first:
+            result, keep = self._run_local(op, request, response_type)
+            self.request_cache.finish(method, rid, outcome, result, keep)
+            return result, False
+        try:
+            return outcome.result(timeout=forward_timeout(context)), True
+        except futures.TimeoutError:
+            details = "timed out waiting for the first attempt with this request ID"
+            return (response_type(), grpc.StatusCode.DEADLINE_EXCEEDED, details), True
+
+    def _invoke(self, method, op, request, context, response_type):
+        start = time.perf_counter()
+        code, details, owner, replayed = grpc.StatusCode.OK, None, None, False
+        if self._is_remote(request):
+            # Pass the RPC on to the worker that owns the bucket, verbatim.
+            owner = self.router.owner(request.bucket)
+            try:
+                response = getattr(self.router.stub(owner), method)(
+                    request,
+                    timeout=forward_timeout(context),
+                    metadata=forwardable_metadata(context),
+                )
+            except grpc.RpcError as e:
+                code, details = e.code(), e.details()
+                response = response_type()
+        else:
+            (response, code, details), replayed = self._run_once(
+                method, op, request, context, response_type
+            )
+        self._finish(method, request, context, code, details, start, owner, replayed)
+        return response
+
+    def AddBucketEntry(self, request, context):
+        return self._invoke(
+            "AddBucketEntry",
+            self._add_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.AddBucketEntryResponse,
+        )
 
     def DeleteBucketEntry(self, request, context):
-        logging.info(
-            f"received: DeleteBucketEntry: bucket={request.bucket} cluster={request.cluster} owner={request.owner}"
+        return self._invoke(
+            "DeleteBucketEntry",
+            self._delete_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.DeleteBucketEntryResponse,
+        )
+
+    def UpdateBucketEntry(self, request, context):
+        return self._invoke(
+            "UpdateBucketEntry",
+            self._update_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.UpdateBucketEntryResponse,
+        )
+
+    def CreateBucketEntry(self, request, context):
+        return self._invoke(
+            "CreateBucketEntry",
+            self._create_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.CreateBucketEntryResponse,
+        )
+
+    def DestroyBucketEntry(self, request, context):
+        return self._invoke(
+            "DestroyBucketEntry",
+            self._destroy_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.DestroyBucketEntryResponse,
+        )
+
+    def GetBucketEntry(self, request, context):
+        return self._invoke(
+            "GetBucketEntry",
+            self._get_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.GetBucketEntryResponse,
+        )
+
+    def _forward_gets(self, owner, request, context):
+        try:
+            return self.router.stub(owner).GetBucketEntries(
+                request,
+                timeout=forward_timeout(context),
+                metadata=forwardable_metadata(context),
+            ).results
+        except grpc.RpcError as e:
+            return [_get_error_result(e.code(), e.details())] * len(request.entries)
+
+    def GetBucketEntries(self, request, context):
+        start = time.perf_counter()
+        results, remote = self._plan_gets(request)
+        remote_results = [
+            (positions, self._forward_gets(owner, sub, context))
+            for owner, (positions, sub) in remote.items()
+        ]
+        return self._gets_response(results, remote_results, start)
+
+    def _forward_batch(self, owner, request, context):
+        stub = self.router.stub(owner)
+        try:
+            responses = stub.BatchBucketEntries(
+                iter([request]),
+                timeout=forward_timeout(context),
+                metadata=forwardable_metadata(context),
+            )
+            return next(responses).results
+        except grpc.RpcError as e:
+            return [_batch_error_result(e.code(), e.details())] * len(
+                request.operations
+            )
+
+    def BatchBucketEntries(self, request_iterator, context):
+        for request in request_iterator:
+            start = time.perf_counter()
+            local, results, remote = self._plan_batch(request)
+            self._apply_local_batch(local, results)
+            remote_results = [
+                (positions, self._forward_batch(owner, sub, context))
+                for owner, (positions, sub) in remote.items()
+            ]
+            yield self._batch_response(results, remote_results, start)
+
+    def _reconcile_local(self, request):
+        """
+        This process's digests for the requested nodes, the entries it has
+        under the requested nodes that the caller doesn't, and the caller's
+        hashes it doesn't have (None if no entries were sent).
+        """
+        for d in request.digests:
+            if not valid_node(d.level, d.index):
+                raise Exception(f"invalid reconcile node ({d.level}, {d.index})")
+        for n in request.entries:
+            if n.level < LEAF_DEPTH or not valid_node(n.level, n.index):
+                raise Exception(
+                    f"invalid reconcile entries node ({n.level}, {n.index})"
+                )
+
+        # Anything below the leaves is worked out from the leaves' entries.
+        deep = [
+            (d.level, d.index) for d in request.digests if d.level > LEAF_DEPTH
+        ] + [(n.level, n.index) for n in request.entries]
+        leaves = {
+            index: LeafEntries(entries)
+            for index, entries in self.db.cluster_leaf_entries(
+                request.cluster, {leaf_above(*node) for node in deep}
+            ).items()
+        }
+
+        digests = {}
+        if any(d.level <= LEAF_DEPTH for d in request.digests):
+            levels = tree_levels(self.db.cluster_digests(request.cluster))
+        for d in request.digests:
+            if d.level <= LEAF_DEPTH:
+                digests[(d.level, d.index)] = levels[d.level][d.index]
+            else:
+                leaf = leaves[leaf_above(d.level, d.index)]
+                digests[(d.level, d.index)] = leaf.digest(d.level, d.index)
+
+        missing_from_cluster, missing_from_ubdb = [], None
+        if request.entries:
+            missing_from_ubdb = set()
+            for n in request.entries:
+                leaf = leaves[leaf_above(n.level, n.index)]
+                ours, theirs = leaf.compare(n.level, n.index, n.entry_hashes)
+                missing_from_cluster.extend(ours)
+                missing_from_ubdb |= theirs
+        return digests, missing_from_cluster, missing_from_ubdb
+
+    def _reconcile(self, request, partial: bool, timeout, metadata):
+        digests, missing_from_cluster, missing_from_ubdb = self._reconcile_local(
+            request
+        )
+        if self.router is not None and not partial:
+            # Every worker holds some of the cluster's buckets. Digests
+            # combine by XOR; a hash is only missing if no worker has it.
+            for i in range(self.router.count):
+                if i == self.router.index:
+                    continue
+                other = self.router.stub(i).Reconcile(
+                    request,
+                    timeout=timeout,
+                    metadata=metadata + (PARTITION_LOCAL_METADATA,),
+                )
+                for d in other.mismatched:
+                    digests[(d.level, d.index)] ^= d.digest
+                missing_from_cluster.extend(
+                    (e.bucket, e.owner) for e in other.missing_from_cluster
+                )
+                if missing_from_ubdb is not None:
+                    missing_from_ubdb &= set(other.missing_from_ubdb)
+
+        response = ubdb_pb2.ReconcileResponse()
+        for d in request.digests:
+            ours = digests[(d.level, d.index)]
+            # For another worker, return the raw digests to be combined.
+            if partial or ours != d.digest:
+                response.mismatched.add(level=d.level, index=d.index, digest=ours)
+        for bucket_name, owner in missing_from_cluster:
+            response.missing_from_cluster.add(bucket=bucket_name, owner=owner)
+        response.missing_from_ubdb.extend(sorted(missing_from_ubdb or ()))
+        return response
+
+    def _partition_args(self, context):
+        return (
+            is_partition_local(context),
+            forward_timeout(context),
+            forwardable_metadata(context),
+        )
+
+    def _finish_reconcile(self, request, response, context, code, details, start):
+        if code != grpc.StatusCode.OK:
+            self.set_context_code(context, code, details)
+        self.access_log.reconcile(
+            "Reconcile", request, response, code, details, time.perf_counter() - start
         )
+        return response
+
+    def Reconcile(self, request, context):
+        start = time.perf_counter()
+        code, details = grpc.StatusCode.OK, None
         try:
-            self.db.delete_bucket(request.bucket, request.cluster, request.owner)
-            return ubdb_pb2.DeleteBucketEntryResponse()
-        except MismatchedClusterError as e:
-            self.set_context_code(context, grpc.StatusCode.FAILED_PRECONDITION, str(e))
-            return ubdb_pb2.DeleteBucketEntryResponse()
-        except MismatchedOwnerError as e:
-            self.set_context_code(context, grpc.StatusCode.FAILED_PRECONDITION, str(e))
-            return ubdb_pb2.DeleteBucketEntryResponse()
+            response = self._reconcile(request, *self._partition_args(context))
+        except grpc.RpcError as e:
+            code, details = e.code(), e.details()
+            response = ubdb_pb2.ReconcileResponse()
         except Exception as e:
-            self.set_context_error(context, e)
-            return ubdb_pb2.DeleteBucketEntryResponse()
+            code, details = _status_for_exception(e), str(e)
+            response = ubdb_pb2.ReconcileResponse()
+        return self._finish_reconcile(request, response, context, code, details, start)
 
-    def UpdateBucketEntry(self, request, context):
-        logging.info(
-            f"received: UpdateBucketEntry: bucket={request.bucket} cluster={request.cluster} owner={request.owner} state={request.state}"
+    def _local_entries(self, request, state, page_size):
+        """This process's entries for a listing, fetched a page at a time."""
+        after, inclusive, end = _list_bounds(request)
+        if state == BucketState.DELETED:
+            yield from self._local_tombstones(
+                request, after, inclusive, end, page_size
+            )
+            return
+        while True:
+            page = self.db.list_buckets(
+                request.cluster, request.owner, state, after, page_size, end, inclusive
+            )
+            for name, cluster, owner, bstate in page:
+                yield ubdb_pb2.BucketEntry(
+                    bucket=name,
+                    cluster=cluster,
+                    owner=owner,
+                    state=_ENTRY_STATES[bstate],
+                )
+            if len(page) < page_size:
+                return
+            after, inclusive = page[-1][0], False
+
+    def _local_tombstones(self, request, after, inclusive, end, page_size):
+        """This process's tombstones for a listing of DELETED entries."""
+        if request.owner:
+            # Tombstones don't keep the owner.
+            return
+        while True:
+            page = self.db.list_tombstones(
+                request.cluster, after, page_size, end, inclusive
+            )
+            for name, cluster, seq in page:
+                yield ubdb_pb2.BucketEntry(
+                    bucket=name,
+                    cluster=cluster,
+                    state=ubdb_pb2.BucketState.BUCKET_STATE_DELETED,
+                    deleted_seq=seq,
+                )
+            if len(page) < page_size:
+                return
+            after, inclusive = page[-1][0], False
+
+    def _list_pages(self, request, partial: bool, timeout, metadata):
+        """
+        Generate the response pages of a listing. In multi-process mode,
+        each other worker streams its own entries and they are merged in
+        name order, so only about a page per worker is held at a time.
+        """
+        state = _list_state(request.state)
+        page_size = _list_page_size(request.page_size)
+        sources = [self._local_entries(request, state, page_size)]
+        calls = []
+        try:
+            if self.router is not None and not partial:
+                for i in range(self.router.count):
+                    if i == self.router.index:
+                        continue
+                    call = self.router.stub(i).ListBucketEntries(
+                        request,
+                        timeout=timeout,
+                        metadata=metadata + (PARTITION_LOCAL_METADATA,),
+                    )
+                    calls.append(call)
+                    sources.append(
+                        entry for page in call for entry in page.entries
+                    )
+            entries = heapq.merge(*sources, key=lambda e: e.bucket)
+            while True:
+                page = list(itertools.islice(entries, page_size))
+                response = ubdb_pb2.ListBucketEntriesResponse(entries=page)
+                if len(page) == page_size:
+                    response.next_page_token = page[-1].bucket
+                yield response
+                if not response.next_page_token:
+                    return
+        finally:
+            # Stop the other workers' streams if the caller went away.
+            for call in calls:
+                call.cancel()
+
+    def _finish_list(self, request, context, code, details, entries, pages, start):
+        if code != grpc.StatusCode.OK:
+            self.set_context_code(context, code, details)
+        self.access_log.listing(
+            "ListBucketEntries",
+            request,
+            entries,
+            pages,
+            code,
+            details,
+            time.perf_counter() - start,
+        )
+
+    def ListBucketEntries(self, request, context):
+        start = time.perf_counter()
+        # Unless it gets to the end, the caller went away part way through.
+        code, details = grpc.StatusCode.CANCELLED, "cancelled by the caller"
+        entries = pages = 0
+        try:
+            for page in self._list_pages(request, *self._partition_args(context)):
+                entries += len(page.entries)
+                pages += 1
+                yield page
+            code, details = grpc.StatusCode.OK, None
+        except grpc.RpcError as e:
+            code, details = e.code(), e.details()
+        except Exception as e:
+            code, details = _status_for_exception(e), str(e)
+        finally:
+            self._finish_list(request, context, code, details, entries, pages, start)
+
+    def _start_watch(self):
+        """
+        Count in a new watch, or if it can't be had, return the (code,
+        details) to refuse it with.
+        """
+        if self.router is not None:
+            # Each worker numbers its own partition's changes.
+            return (
+                grpc.StatusCode.UNIMPLEMENTED,
+                "WatchBucketEntries is not available with --workers",
+            )
+        if self.db.changes is None:
+            return (
+                grpc.StatusCode.UNIMPLEMENTED,
+                "WatchBucketEntries is turned off (--watch-buffer 0)",
+            )
+        with self._watch_lock:
+            if self.watchers >= self.max_watchers:
+                return (
+                    grpc.StatusCode.RESOURCE_EXHAUSTED,
+                    f"already {self.watchers} watchers (--max-watchers)",
+                )
+            self.watchers += 1
+        return None
+
+    def _next_watch_response(self, request, feed: ChangeFeed, after: int):
+        """
+        A watch's next message after it has reached `after`: a resync if
+        any of the changes it needs next are gone, else those changes, or
+        None if there aren't any yet.
+        """
+        changes = feed.changes_after(after, WATCH_BATCH)
+        if changes is None:
+            with self._watch_lock:
+                self.watch_resyncs += 1
+            return ubdb_pb2.WatchBucketEntriesResponse(seq=feed.seq, resync=True)
+        if not changes:
+            return None
+        return _watch_response(request, changes)
+
+    def _finish_watch(self, request, context, code, details, changes, start):
+        if code != grpc.StatusCode.OK:
+            self.set_context_code(context, code, details)
+        self.access_log.watch(
+            "WatchBucketEntries",
+            request,
+            changes,
+            code,
+            details,
+            time.perf_counter() - start,
         )
-        if request.state == ubdb_pb2.BucketState.BUCKET_STATE_CREATED:
-            bstate = BucketState.CREATED
-        elif request.state == ubdb_pb2.BucketState.BUCKET_STATE_DELETING:
-            bstate = BucketState.DELETING
+
+    def WatchBucketEntries(self, request, context):
+        # A watch holds a handler thread until the caller goes away.
+        start = time.perf_counter()
+        refusal = self._start_watch()
+        if refusal is not None:
+            self._finish_watch(request, context, *refusal, 0, start)
+            return
+        code, details = grpc.StatusCode.CANCELLED, "cancelled by the caller"
+        changes = 0
+        try:
+            feed = self.db.changes
+            # Notice a cancel at once, not at the end of a wait.
+            context.add_callback(feed.wake)
+            after = sent = request.after_seq or feed.seq
+            yield ubdb_pb2.WatchBucketEntriesResponse(seq=after)
+            while context.is_active():
+                response = self._next_watch_response(request, feed, after)
+                if response is None:
+                    if feed.wait(after, WATCH_IDLE) or after == sent:
+                        continue
+                    # Quiet, after changes the filters left out: report
+                    # progress, so that a resume needn't go back over them.
+                    response = ubdb_pb2.WatchBucketEntriesResponse(seq=after)
+                elif not response.changes and not response.resync:
+                    after = response.seq
+                    continue
+                after = sent = response.seq
+                changes += len(response.changes)
+                yield response
+                if response.resync:
+                    code, details = grpc.StatusCode.OK, None
+                    return
+        except Exception as e:
+            code, details = _status_for_exception(e), str(e)
+        finally:
+            with self._watch_lock:
+                self.watchers -= 1
+            self._finish_watch(request, context, code, details, changes, start)
+
+
+class AsyncUBDBServer(UBDBServer):
+    """
+    grpc.aio servicer over the same operations as UBDBServer.
+
+    With no write-ahead log the in-memory database never blocks for long,
+    so operations run directly on the event loop. With a log, or on SQLite,
+    they have to wait for an fsync, so they run on an executor instead,
+    where concurrent waits still share a group commit.
+    """
+
+    def __init__(
+        self,
+        db: BucketDatabase = None,
+        max_workers: int = 10,
+        router: PartitionRouter = None,
+        access_log: AccessLog = None,
+        request_cache: RequestCache = None,
+        max_watchers: int = 4,
+    ):
+        super().__init__(db, router, access_log, request_cache, max_watchers)
+        self.executor = None
+        if self.db.blocking:
+            self.executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _invoke_async(
+        self, method, op, request, context, response_type, inline=False
+    ):
+        """
+        As _invoke(). A local op runs on the executor, if there is one,
+        unless it's `inline`: one that never waits, like a read.
+        """
+        start = time.perf_counter()
+        code, details, owner, replayed = grpc.StatusCode.OK, None, None, False
+        if self._is_remote(request):
+            owner = self.router.owner(request.bucket)
+            try:
+                response = await getattr(self.router.aio_stub(owner), method)(
+                    request,
+                    timeout=forward_timeout(context),
+                    metadata=forwardable_metadata(context),
+                )
+            except grpc.RpcError as e:
+                code, details = e.code(), e.details()
+                response = response_type()
         else:
-            raise Exception(f"Unknown update state '{request.state}'")
+            (response, code, details), replayed = await self._run_once_async(
+                method, op, request, context, response_type, inline
+            )
+        self._finish(method, request, context, code, details, start, owner, replayed)
+        return response
+
+    async def _run_local_async(self, op, request, response_type, inline):
+        if self.executor is None or inline:
+            return self._run_local(op, request, response_type)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self._run_local, op, request, response_type
+        )
+
+    async def _run_once_async(
+        self, method, op, request, context, response_type, inline
+    ):
+        """As _run_once(), without blocking the event loop."""
+        try:
+            rid = self._request_id(method, context)
+            if rid is None:
+                result, _ = await self._run_local_async(
+                    op, request, response_type, inline
+                )
+                return result, False
+            outcome, first = self.request_cache.begin(method, rid, request)
+        except Exception as e:
+            return (response_type(), _status_for_exception(e), str(e)), False
+        if first:
+            # Record the outcome even if this call is cancelled, since the
+            # op itself carries on regardless.
+            task = asyncio.ensure_future(
+                self._run_local_async(op, request, response_type, inline)
+            )
+            task.add_done_callback(
+                lambda t: self.request_cache.finish(method, rid, outcome, *t.result())
+            )
+            result, _ = await asyncio.shield(task)
+            return result, False
+        try:
+            return (
+                await asyncio.wait_for(
+                    asyncio.wrap_future(outcome), forward_timeout(context)
+                ),
+                True,
+            )
+        except asyncio.TimeoutError:
+            details = "timed out waiting for the first attempt with this request ID"
+            return (response_type(), grpc.StatusCode.DEADLINE_EXCEEDED, details), True
+
+    async def AddBucketEntry(self, request, context):
+        return await self._invoke_async(
+            "AddBucketEntry",
+            self._add_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.AddBucketEntryResponse,
+        )
+
+    async def DeleteBucketEntry(self, request, context):
+        return await self._invoke_async(
+            "DeleteBucketEntry",
+            self._delete_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.DeleteBucketEntryResponse,
+        )
+
+    async def UpdateBucketEntry(self, request, context):
+        return await self._invoke_async(
+            "UpdateBucketEntry",
+            self._update_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.UpdateBucketEntryResponse,
+        )
+
+    async def CreateBucketEntry(self, request, context):
+        return await self._invoke_async(
+            "CreateBucketEntry",
+            self._create_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.CreateBucketEntryResponse,
+        )
+
+    async def DestroyBucketEntry(self, request, context):
+        return await self._invoke_async(
+            "DestroyBucketEntry",
+            self._destroy_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.DestroyBucketEntryResponse,
+        )
+
+    async def GetBucketEntry(self, request, context):
+        return await self._invoke_async(
+            "GetBucketEntry",
+            self._get_bucket_entry,
+            request,
+            context,
+            ubdb_pb2.GetBucketEntryResponse,
+            inline=True,
+        )
+
+    async def _forward_gets_async(self, owner, request, context):
+        try:
+            response = await self.router.aio_stub(owner).GetBucketEntries(
+                request,
+                timeout=forward_timeout(context),
+                metadata=forwardable_metadata(context),
+            )
+            return response.results
+        except grpc.RpcError as e:
+            return [_get_error_result(e.code(), e.details())] * len(request.entries)
+
+    async def GetBucketEntries(self, request, context):
+        start = time.perf_counter()
+        results, remote = self._plan_gets(request)
+        remote_results = [
+            (positions, await self._forward_gets_async(owner, sub, context))
+            for owner, (positions, sub) in remote.items()
+        ]
+        return self._gets_response(results, remote_results, start)
+
+    async def _forward_batch_async(self, owner, request, context):
+        stub = self.router.aio_stub(owner)
+        try:
+            call = stub.BatchBucketEntries(
+                iter([request]),
+                timeout=forward_timeout(context),
+                metadata=forwardable_metadata(context),
+            )
+            return (await call.read()).results
+        except grpc.RpcError as e:
+            return [_batch_error_result(e.code(), e.details())] * len(
+                request.operations
+            )
+
+    async def BatchBucketEntries(self, request_iterator, context):
+        loop = asyncio.get_running_loop()
+        async for request in request_iterator:
+            start = time.perf_counter()
+            local, results, remote = self._plan_batch(request)
+            if self.executor is None:
+                self._apply_local_batch(local, results)
+            else:
+                await loop.run_in_executor(
+                    self.executor, self._apply_local_batch, local, results
+                )
+            remote_results = [
+                (positions, await self._forward_batch_async(owner, sub, context))
+                for owner, (positions, sub) in remote.items()
+            ]
+            yield self._batch_response(results, remote_results, start)
+
+    async def Reconcile(self, request, context):
+        # Comparing leaves hashes every entry in them, which is too slow for
+        # the event loop; and the other workers are asked over sync stubs.
+        start = time.perf_counter()
+        code, details = grpc.StatusCode.OK, None
         try:
-            self.db.update_bucket(
-                request.bucket, request.cluster, request.owner, bstate
+            response = await asyncio.to_thread(
+                self._reconcile, request, *self._partition_args(context)
             )
-            return ubdb_pb2.UpdateBucketEntryResponse()
-        except MismatchedClusterError as e:
-            self.set_context_code(context, grpc.StatusCode.FAILED_PRECONDITION, str(e))
-            return ubdb_pb2.UpdateBucketEntryResponse()
-        except MismatchedOwnerError as e:
-            self.set_context_code(context, grpc.StatusCode.FAILED_PRECONDITION, str(e))
-            return ubdb_pb2.UpdateBucketEntryResponse()
-        except BucketNotFoundError as e:
-            self.set_context_code(context, grpc.StatusCode.NOT_FOUND, str(e))
-            return ubdb_pb2.UpdateBucketEntryResponse()
+        except grpc.RpcError as e:
+            code, details = e.code(), e.details()
+            response = ubdb_pb2.ReconcileResponse()
+        except Exception as e:
+            code, details = _status_for_exception(e), str(e)
+            response = ubdb_pb2.ReconcileResponse()
+        return self._finish_reconcile(request, response, context, code, details, start)
+
+    async def ListBucketEntries(self, request, context):
+        # Pages are built on a thread, both because a selective filter can
+        # mean reading a lot of an index and because the other workers are
+        # asked over sync stubs.
+        start = time.perf_counter()
+        code, details = grpc.StatusCode.CANCELLED, "cancelled by the caller"
+        entries = pages = 0
+        generator = self._list_pages(request, *self._partition_args(context))
+        try:
+            while True:
+                page = await asyncio.to_thread(next, generator, None)
+                if page is None:
+                    break
+                entries += len(page.entries)
+                pages += 1
+                yield page
+            code, details = grpc.StatusCode.OK, None
+        except grpc.RpcError as e:
+            code, details = e.code(), e.details()
+        except Exception as e:
+            code, details = _status_for_exception(e), str(e)
+        finally:
+            try:
+                generator.close()
+            except ValueError:
+                # Cancelled while a page was being built; the generator
+                # is closed when that finishes and it's collected.
+                pass
+            self._finish_list(request, context, code, details, entries, pages, start)
+
+    async def WatchBucketEntries(self, request, context):
+        # As UBDBServer's, waiting on the event loop rather than a thread.
+        start = time.perf_counter()
+        refusal = self._start_watch()
+        if refusal is not None:
+            self._finish_watch(request, context, *refusal, 0, start)
+            return
+        code, details = grpc.StatusCode.CANCELLED, "cancelled by the caller"
+        changes = 0
+        try:
+            feed = self.db.changes
+            after = sent = request.after_seq or feed.seq
+            yield ubdb_pb2.WatchBucketEntriesResponse(seq=after)
+            while True:
+                response = self._next_watch_response(request, feed, after)
+                if response is None:
+                    if await feed.wait_async(after, WATCH_IDLE) or after == sent:
+                        continue
+                    response = ubdb_pb2.WatchBucketEntriesResponse(seq=after)
+                elif not response.changes and not response.resync:
+                    after = response.seq
+                    continue
+                after = sent = response.seq
+                changes += len(response.changes)
+                yield response
+                if response.resync:
+                    code, details = grpc.StatusCode.OK, None
+                    return
         except Exception as e:
-            self.set_context_error(context, e)
-            return ubdb_pb2.UpdateBucketEntryResponse()
+            code, details = _status_for_exception(e), str(e)
+        finally:
+            with self._watch_lock:
+                self.watchers -= 1
+            self._finish_watch(request, context, code, details, changes, start)
 
 
 def _load_credential_from_file(filepath):
@@ -248,41 +2203,534 @@ def _load_credential_from_file(filepath):
         return f.read()
 
 
-def run(args):
-    server_address = f"{args.address}:{args.port}"
-    logging.info("Starting gRPC service...\n")
-    try:
-        server = grpc.server(
-            futures.ThreadPoolExecutor(max_workers=10),
-            options=(
-                ("grpc.so_reuseport", 0),
-            ),  # This apparently helps detect port reuse - see https://github.com/grpc/grpc/issues/16920
+def _server_options(router: PartitionRouter = None):
+    if router is not None:
+        # Every worker binds the public port; the kernel spreads connections
+        # across them.
+        return (("grpc.so_reuseport", 1),)
+    # This apparently helps detect port reuse - see https://github.com/grpc/grpc/issues/16920
+    return (("grpc.so_reuseport", 0),)
+
+
+def _queue_depth_gauge(metrics: MetricsRegistry, executor, help: str):
+    metrics.add_gauge(
+        "ubns_executor_queue_depth",
+        help,
+        lambda: [({}, executor._work_queue.qsize())],
+    )
+
+
+def _bucket_state_gauge(metrics: MetricsRegistry, db: BucketDatabase):
+    metrics.add_gauge(
+        "ubns_buckets",
+        "Buckets in the database, by state. DELETED counts tombstones.",
+        lambda: [
+            ({"state": state.name}, n)
+            for state, n in db.state_counts().items()
+            if state != BucketState.NONE
+        ],
+    )
+
+
+def _request_cache_metrics(metrics: MetricsRegistry, cache: RequestCache):
+    for name, help in (
+        ("hits", "Retries answered from the request ID cache."),
+        ("misses", "First attempts recorded in the request ID cache."),
+        ("evictions", "Request ID cache entries dropped for space or age."),
+    ):
+        metrics.add_counter(
+            f"ubns_request_id_cache_{name}_total",
+            help,
+            lambda name=name: [({}, getattr(cache, name))],
         )
-        ubdb_pb2_grpc.add_UBDBServiceServicer_to_server(UBDBServer(), server)
+    metrics.add_gauge(
+        "ubns_request_id_cache_entries",
+        "Request outcomes held in the request ID cache.",
+        lambda: [({}, len(cache))],
+    )
 
-        if args.tls:
-            server_crt = _load_credential_from_file(args.server_cert)
-            server_key = _load_credential_from_file(args.server_key)
-            ca_crt = _load_credential_from_file(args.ca_cert)
-            server_credentials = grpc.ssl_server_credentials(
+
+def _watch_metrics(metrics: MetricsRegistry, servicer: UBDBServer):
+    metrics.add_gauge(
+        "ubns_watchers",
+        "WatchBucketEntries streams open.",
+        lambda: [({}, servicer.watchers)],
+    )
+    metrics.add_counter(
+        "ubns_watch_resyncs_total",
+        "Watches ended with a resync, the changes they needed next being gone.",
+        lambda: [({}, servicer.watch_resyncs)],
+    )
+
+
+def _bloom_metrics(metrics: MetricsRegistry, table: BucketTable):
+    metrics.add_gauge(
+        "ubns_bloom_filter_names",
+        "Bucket and tombstone names in the SQLite backend's Bloom filter.",
+        lambda: [({}, len(table.bloom))],
+    )
+    metrics.add_gauge(
+        "ubns_bloom_filter_bytes",
+        "Memory used by the Bloom filter's counters.",
+        lambda: [({}, table.bloom.slots)],
+    )
+    metrics.add_counter(
+        "ubns_bloom_filter_negatives_total",
+        "Table lookups the Bloom filter answered without reading the table.",
+        lambda: [({}, table.bloom_negatives)],
+    )
+    metrics.add_counter(
+        "ubns_bloom_filter_false_positives_total",
+        "Creates the Bloom filter sent to the table for names it didn't have.",
+        lambda: [({}, table.bloom_false_positives)],
+    )
+
+
+def _shedder_metrics(metrics: MetricsRegistry, shedder: DeadlineShedder):
+    metrics.add_counter(
+        "ubns_rpc_shed_total",
+        "RPCs failed unstarted as they couldn't finish before their deadline.",
+        lambda: [({"method": m}, n) for m, n in shedder.shed.copy().items()],
+    )
+    metrics.add_gauge(
+        "ubns_rpc_service_time_seconds",
+        "Moving average of each method's handler time, as used for shedding.",
+        lambda: [
+            ({"method": m}, t) for m, t in shedder.service_time.copy().items()
+        ],
+    )
+
+
+def _admission_metrics(metrics: MetricsRegistry, admission: ClusterAdmission):
+    metrics.add_counter(
+        "ubns_rpc_throttled_total",
+        "RPCs refused by per-cluster admission, by cluster and reason.",
+        lambda: [
+            ({"cluster": c, "reason": r}, n)
+            for (c, r), n in admission.throttled.copy().items()
+        ],
+    )
+    metrics.add_gauge(
+        "ubns_fair_queue_waiting",
+        "RPCs waiting for a turn to run in the fair queue, by cluster.",
+        lambda: [({"cluster": c}, n) for c, n in admission.queue.waiting.copy().items()],
+    )
+
+
+def _interceptors(
+    metrics,
+    admission,
+    shedder,
+    metrics_interceptor,
+    admission_interceptor,
+    shedding_interceptor,
+):
+    # The metrics interceptor goes first, outermost, so that it counts shed
+    # RPCs too. Shedding goes after the fair queue, so that it allows for
+    # the time spent waiting there.
+    interceptors = []
+    if metrics is not None:
+        interceptors.append(metrics_interceptor(metrics.rpc))
+    if admission is not None:
+        interceptors.append(admission_interceptor(admission))
+        if metrics is not None:
+            _admission_metrics(metrics, admission)
+    if shedder is not None:
+        interceptors.append(shedding_interceptor(shedder))
+        if metrics is not None:
+            _shedder_metrics(metrics, shedder)
+    return interceptors
+
+
+def build_server(
+    db: BucketDatabase,
+    max_workers: int = 10,
+    router: PartitionRouter = None,
+    access_log: AccessLog = None,
+    metrics: MetricsRegistry = None,
+    request_cache: RequestCache = None,
+    max_concurrent_rpcs: int = None,
+    shedder: DeadlineShedder = None,
+    profiler: Profiler = None,
+    max_watchers: int = 4,
+    admission: ClusterAdmission = None,
+    capture: Capture = None,
+):
+    """
+    Create a (not yet started) gRPC server serving db. With
+    max_concurrent_rpcs, RPCs beyond that many in progress are refused;
+    with a shedder, those that can't make their deadline are shed; with
+    admission, RPCs are limited and queued by cluster. A profiler is
+    attached to the servicer, and a traffic capture sees every RPC, to
+    capture on demand. Each of up to max_watchers WatchBucketEntries streams
+    holds a handler thread.
+    """
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    if metrics is not None:
+        _queue_depth_gauge(
+            metrics, executor, "RPCs waiting for a free handler thread."
+        )
+    interceptors = _interceptors(
+        metrics,
+        admission,
+        shedder,
+        MetricsInterceptor,
+        ClusterAdmissionInterceptor,
+        SheddingInterceptor,
+    )
+    servicer = UBDBServer(db, router, access_log, request_cache, max_watchers)
+    if profiler is not None:
+        profiler.attach(servicer)
+        interceptors.append(ProfilingInterceptor(profiler))
+    if capture is not None:
+        # Outermost, to record what was asked for, whatever became of it.
+        interceptors.insert(0, CaptureInterceptor(capture))
+    server = grpc.server(
+        executor,
+        interceptors=interceptors,
+        options=_server_options(router),
+        maximum_concurrent_rpcs=max_concurrent_rpcs,
+    )
+    if metrics is not None:
+        if request_cache is not None:
+            _request_cache_metrics(metrics, request_cache)
+        _watch_metrics(metrics, servicer)
+    ubdb_pb2_grpc.add_UBDBServiceServicer_to_server(servicer, server)
+    return server
+
+
+def build_async_server(
+    db: BucketDatabase,
+    max_workers: int = 10,
+    router: PartitionRouter = None,
+    access_log: AccessLog = None,
+    metrics: MetricsRegistry = None,
+    request_cache: RequestCache = None,
+    max_concurrent_rpcs: int = None,
+    shedder: DeadlineShedder = None,
+    profiler: Profiler = None,
+    max_watchers: int = 4,
+    admission: ClusterAdmission = None,
+    capture: Capture = None,
+):
+    """
+    Create a (not yet started) grpc.aio server serving db, as build_server().
+    Must be called with the event loop that will run it.
+    """
+    servicer = AsyncUBDBServer(
+        db, max_workers, router, access_log, request_cache, max_watchers
+    )
+    interceptors = _interceptors(
+        metrics,
+        admission,
+        shedder,
+        AsyncMetricsInterceptor,
+        AsyncClusterAdmissionInterceptor,
+        AsyncSheddingInterceptor,
+    )
+    if profiler is not None:
+        profiler.attach(servicer)
+        interceptors.append(AsyncProfilingInterceptor(profiler))
+    if capture is not None:
+        interceptors.insert(0, AsyncCaptureInterceptor(capture))
+    if metrics is not None:
+        if request_cache is not None:
+            _request_cache_metrics(metrics, request_cache)
+        _watch_metrics(metrics, servicer)
+        if servicer.executor is not None:
+            _queue_depth_gauge(
+                metrics,
+                servicer.executor,
+                "Database operations waiting for a free thread.",
+            )
+    server = grpc.aio.server(
+        interceptors=interceptors,
+        options=_server_options(router),
+        maximum_concurrent_rpcs=max_concurrent_rpcs,
+    )
+    ubdb_pb2_grpc.add_UBDBServiceServicer_to_server(servicer, server)
+    return server
+
+
+def _add_ports(server, args, server_address, router: PartitionRouter = None):
+    if args.tls:
+        server_crt = _load_credential_from_file(args.server_cert)
+        server_key = _load_credential_from_file(args.server_key)
+        ca_crt = _load_credential_from_file(args.ca_cert)
+        server_credentials = grpc.ssl_server_credentials(
+            (
                 (
-                    (
-                        server_key,
-                        server_crt,
-                    ),
+                    server_key,
+                    server_crt,
                 ),
-                (ca_crt),
+            ),
+            (ca_crt),
+        )
+        server.add_secure_port(server_address, server_credentials)
+
+    else:
+        server.add_insecure_port(server_address)
+
+    if router is not None:
+        # Forwarded requests from the other workers. The socket directory is
+        # private to this server, so this doesn't need TLS.
+        server.add_insecure_port(router.address(router.index))
+
+
+def _request_cache(args) -> RequestCache:
+    if args.request_id_cache_size <= 0:
+        return None
+    return RequestCache(args.request_id_cache_size, args.request_id_ttl)
+
+
+def _cluster_admission(args) -> ClusterAdmission:
+    return ClusterAdmission(
+        TokenBuckets(args.cluster_rate, args.cluster_burst, dict(args.cluster_limit)),
+        TokenBuckets(args.owner_rate, args.owner_burst, dict(args.owner_limit)),
+        FairQueue(args.fair_slots, args.fair_queue_depth, dict(args.cluster_weight)),
+    )
+
+
+def _shedder(args) -> DeadlineShedder:
+    if args.no_deadline_shedding:
+        return None
+    return DeadlineShedder()
+
+
+async def _serve_async(
+    args, db, server_address, router, metrics, profiler, admission, capture
+):
+    server = build_async_server(
+        db,
+        args.max_workers,
+        router,
+        AccessLog(args.access_log_sample),
+        metrics,
+        _request_cache(args),
+        args.max_concurrent_rpcs,
+        _shedder(args),
+        profiler,
+        args.max_watchers,
+        admission,
+        capture,
+    )
+    _add_ports(server, args, server_address, router)
+    await server.start()
+    logging.info(f"Server started (asyncio), listening on {server_address}")
+    await server.wait_for_termination()
+
+
+def _open_database(args, data_dir: str) -> BucketDatabase:
+    """The database for args.backend, with its checkpointer started if need be."""
+    sync_mode = SyncMode(args.wal_sync)
+    if args.backend == "sqlite":
+        return SQLiteBucketDatabase(
+            BucketTable(data_dir, sync_mode, args.sqlite_cache_mb, args.bloom_fp_rate)
+        )
+    wal = WriteAheadLog(data_dir, sync_mode) if data_dir else None
+    db = BucketNameDatabase(wal, args.shards)
+    if wal is not None:
+        db.start_checkpointer(args.snapshot_interval, args.snapshot_records)
+    return db
+
+
+def serve(args, data_dir: str = None, router: PartitionRouter = None):
+    """Run one server process until interrupted."""
+    server_address = f"{args.address}:{args.port}"
+    db = None
+    capture_file = None
+    try:
+        db = _open_database(args, data_dir)
+        db.start_compactor(args.tombstone_retention)
+        if args.watch_buffer > 0 and router is None:
+            db.changes = ChangeFeed(args.watch_buffer, db.seq)
+        profiler = Profiler(args.profile_interval_ms / 1000)
+        profiler.install_signal(
+            args.profile_dir or tempfile.gettempdir(), args.profile_seconds
+        )
+        admission = _cluster_admission(args)
+        capture = Capture()
+        if args.capture:
+            # Each worker captures its own calls, to a file of its own.
+            path = args.capture
+            if router is not None:
+                path = f"{path}.{router.index}"
+            capture_file = open(path, "wb")
+            capture.start(capture_file)
+
+        metrics = None
+        if args.metrics_port:
+            metrics = MetricsRegistry()
+            _bucket_state_gauge(metrics, db)
+            metrics.add_counter(
+                "ubns_tombstones_purged_total",
+                "Tombstones dropped by compaction at the end of their retention.",
+                lambda: [({}, db.tombstones_purged)],
+            )
+            if isinstance(db, SQLiteBucketDatabase) and db.table.bloom is not None:
+                _bloom_metrics(metrics, db.table)
+            # Each worker serves its own metrics, on consecutive ports.
+            port = args.metrics_port + (router.index if router is not None else 0)
+            serve_metrics(
+                metrics, args.metrics_address, port, profiler, admission, capture
             )
-            server.add_secure_port(server_address, server_credentials)
 
+        if args.use_async:
+            asyncio.run(
+                _serve_async(
+                    args,
+                    db,
+                    server_address,
+                    router,
+                    metrics,
+                    profiler,
+                    admission,
+                    capture,
+                )
+            )
         else:
-            server.add_insecure_port(server_address)
+            server = build_server(
+                db,
+                args.max_workers,
+                router,
+                AccessLog(args.access_log_sample),
+                metrics,
+                _request_cache(args),
+                args.max_concurrent_rpcs,
+                _shedder(args),
+                profiler,
+                args.max_watchers,
+                admission,
+                capture,
+            )
+            _add_ports(server, args, server_address, router)
+            server.start()
+            logging.info(f"Server started, listening on {server_address}")
+            server.wait_for_termination()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Workers are stopped with SIGTERM, which raises SystemExit.
+        if capture_file is not None:
+            calls, _ = capture.stop()
+            capture_file.close()
+            logging.info("capture: wrote %d calls to %s", calls, capture_file.name)
+    if db is not None:
+        db.close()
+
 
-        server.start()
-        logging.info(f"Server started, listening on {server_address}")
-        server.wait_for_termination()
+def _serve_worker(args, index: int, socket_dir: str):
+    # The parent's log listener thread didn't come with us through the fork.
+    listener = setup_logging(logging.getLogger().level)
+    try:
+        router = PartitionRouter(index, args.workers, socket_dir)
+        logging.info(f"Worker {index} (pid {os.getpid()}) starting")
+        data_dir = None
+        if args.data_dir:
+            data_dir = os.path.join(args.data_dir, f"worker-{index}")
+        serve(args, data_dir, router)
+    finally:
+        listener.stop()
+
+
+def _check_partition_count(data_dir: str, workers: int):
+    """
+    Each worker's data only holds its own partition, so the data directory
+    can't be reopened with a different number of workers.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, "partitions")
+    if os.path.exists(path):
+        with open(path) as f:
+            existing = int(f.read())
+        if existing != workers:
+            raise Exception(
+                f"data directory '{data_dir}' is partitioned for {existing} workers, not {workers}"
+            )
+    else:
+        with open(path, "w") as f:
+            f.write(f"{workers}\n")
+
+
+def run_workers(args):
+    """
+    Fork args.workers server processes, each owning a partition of the
+    bucket namespace, and wait for them. If any worker exits, stop the rest.
+
+    This must happen before this process creates any gRPC objects, which
+    don't survive a fork.
+    """
+    if args.data_dir:
+        _check_partition_count(args.data_dir, args.workers)
+    socket_dir = tempfile.mkdtemp(prefix="ubns-workers-")
+    ctx = multiprocessing.get_context("fork")
+    procs = [
+        ctx.Process(
+            target=_serve_worker, args=(args, i, socket_dir), name=f"worker-{i}"
+        )
+        for i in range(args.workers)
+    ]
+    # Make sure a SIGTERM still goes through the cleanup below.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # A profile capture asked of the parent is taken by every worker.
+    signal.signal(
+        signal.SIGUSR1,
+        lambda signum, frame: [
+            os.kill(proc.pid, signum) for proc in procs if proc.is_alive()
+        ],
+    )
+    try:
+        for proc in procs:
+            proc.start()
+        logging.info(
+            f"Started {args.workers} workers on {args.address}:{args.port}"
+        )
+        multiprocessing.connection.wait([proc.sentinel for proc in procs])
+        for proc in procs:
+            if proc.exitcode is not None:
+                logging.error(
+                    f"{proc.name} exited with status {proc.exitcode}, stopping"
+                )
     except KeyboardInterrupt:
         pass
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs:
+            proc.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def _named_limit(text: str) -> tuple[str, tuple[float, float]]:
+    """'NAME=RATE[:BURST]' -> (name, (rate, burst))"""
+    name, _, limit = text.rpartition("=")
+    rate, _, burst = limit.partition(":")
+    try:
+        if not name or float(rate) < 0 or (burst and float(burst) < 1):
+            raise ValueError
+        return name, (float(rate), float(burst or rate))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected NAME=RATE[:BURST], not '{text}'")
+
+
+def _named_weight(text: str) -> tuple[str, float]:
+    """'NAME=WEIGHT' -> (name, weight)"""
+    name, _, weight = text.rpartition("=")
+    try:
+        if not name or float(weight) <= 0:
+            raise ValueError
+        return name, float(weight)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected NAME=WEIGHT, not '{text}'")
+
+
+def run(args):
+    logging.info("Starting gRPC service...\n")
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        serve(args, args.data_dir)
     logging.info("Stopping gRPC server...\n")
 
 
@@ -298,23 +2746,234 @@ if __name__ == "__main__":
         "-t", "--tls", help="connect to the server using TLS", action="store_true"
     )
     p.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    p.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="serve with grpc.aio on an event loop instead of a thread pool",
+    )
+    p.add_argument(
+        "--max-workers",
+        type=int,
+        default=10,
+        help="RPC handler threads, or log-wait threads with --async (default: %(default)s)",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="server processes, each owning a partition of the bucket names (default: %(default)s)",
+    )
+    p.add_argument(
+        "--shards",
+        type=int,
+        default=16,
+        help="independently locked stripes of the bucket table (default: %(default)s)",
+    )
+    pdata = p.add_argument_group("Persistence arguments")
+    pdata.add_argument(
+        "-d",
+        "--data-dir",
+        help="directory for the write-ahead log and snapshots, or the SQLite database (default: in-memory only)",
+    )
+    pdata.add_argument(
+        "--backend",
+        choices=["memory", "sqlite"],
+        default="memory",
+        help="where the bucket table is kept: in memory, or in SQLite under --data-dir for tables larger than memory (default: %(default)s)",
+    )
+    pdata.add_argument(
+        "--sqlite-cache-mb",
+        type=int,
+        default=64,
+        help="SQLite page cache for the writer connection, in MiB (default: %(default)s)",
+    )
+    pdata.add_argument(
+        "--bloom-fp-rate",
+        type=float,
+        default=0.01,
+        help="false-positive rate of the SQLite backend's in-memory filter of bucket names, which saves most creates a disk lookup; 0 to do without (default: %(default)s)",
+    )
+    pdata.add_argument(
+        "--wal-sync",
+        choices=[m.value for m in SyncMode],
+        default=SyncMode.GROUP.value,
+        help="how writes to the log, or SQLite, are made durable (default: %(default)s)",
+    )
+    pdata.add_argument(
+        "--snapshot-interval",
+        type=float,
+        default=300,
+        help="seconds between snapshots (default: %(default)s)",
+    )
+    pdata.add_argument(
+        "--snapshot-records",
+        type=int,
+        default=100000,
+        help="snapshot early after this many logged mutations (default: %(default)s)",
+    )
+    pdata.add_argument(
+        "--tombstone-retention",
+        type=float,
+        default=600,
+        help="seconds to keep a deleted bucket's tombstone, during which only its cluster can re-create it (default: %(default)s)",
+    )
+    p.add_argument(
+        "--access-log-sample",
+        type=float,
+        default=1.0,
+        help="fraction of successful RPCs to access-log; failures are always logged (default: %(default)s)",
+    )
+    padmission = p.add_argument_group("Admission arguments")
+    padmission.add_argument(
+        "--max-concurrent-rpcs",
+        type=int,
+        help="refuse RPCs with RESOURCE_EXHAUSTED while this many are running or queued, per worker (default: unlimited)",
+    )
+    padmission.add_argument(
+        "--no-deadline-shedding",
+        action="store_true",
+        help="run RPCs even when their deadline is too near for them to finish",
+    )
+    padmission.add_argument(
+        "--cluster-rate",
+        type=float,
+        default=0,
+        help="RPCs per second each cluster may make, per worker; more are refused with RESOURCE_EXHAUSTED and a retry delay (default: unlimited)",
+    )
+    padmission.add_argument(
+        "--cluster-burst",
+        type=float,
+        help="RPCs a cluster may make at once after being idle (default: one second's worth)",
+    )
+    padmission.add_argument(
+        "--cluster-limit",
+        type=_named_limit,
+        action="append",
+        default=[],
+        metavar="NAME=RATE[:BURST]",
+        help="a rate and burst for one cluster, instead of --cluster-rate; may be repeated",
+    )
+    padmission.add_argument(
+        "--owner-rate",
+        type=float,
+        default=0,
+        help="as --cluster-rate, for each owner (default: unlimited)",
+    )
+    padmission.add_argument(
+        "--owner-burst", type=float, help="as --cluster-burst, for each owner"
+    )
+    padmission.add_argument(
+        "--owner-limit",
+        type=_named_limit,
+        action="append",
+        default=[],
+        metavar="NAME=RATE[:BURST]",
+        help="a rate and burst for one owner, instead of --owner-rate; may be repeated",
+    )
+    padmission.add_argument(
+        "--fair-slots",
+        type=int,
+        default=0,
+        help="RPCs run at once, with the rest queued fairly by cluster. Without --async, waiting RPCs hold handler threads, so keep this and --fair-queue-depth well below --max-workers (default: unlimited)",
+    )
+    padmission.add_argument(
+        "--fair-queue-depth",
+        type=int,
+        default=16,
+        help="RPCs a cluster may have waiting in the fair queue; more are refused (default: %(default)s)",
+    )
+    padmission.add_argument(
+        "--cluster-weight",
+        type=_named_weight,
+        action="append",
+        default=[],
+        metavar="NAME=WEIGHT",
+        help="a cluster's share of the fair queue relative to others, which have 1; may be repeated",
+    )
+    pdedup = p.add_argument_group("Request ID arguments")
+    pdedup.add_argument(
+        "--request-id-cache-size",
+        type=int,
+        default=100000,
+        help="mutation outcomes kept per worker for retries with the same request ID; 0 disables (default: %(default)s)",
+    )
+    pdedup.add_argument(
+        "--request-id-ttl",
+        type=float,
+        default=300,
+        help="seconds a request ID's outcome is kept (default: %(default)s)",
+    )
+    pwatch = p.add_argument_group("Watch arguments")
+    pwatch.add_argument(
+        "--watch-buffer",
+        type=int,
+        default=100000,
+        help="recent changes held for WatchBucketEntries to stream and resume from; 0 disables watching (default: %(default)s)",
+    )
+    pwatch.add_argument(
+        "--max-watchers",
+        type=int,
+        default=4,
+        help="refuse watches with RESOURCE_EXHAUSTED while this many are open. Without --async each holds a handler thread, so keep it below --max-workers (default: %(default)s)",
+    )
+    pmetrics = p.add_argument_group("Metrics arguments")
+    pmetrics.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics over HTTP on this port; worker N uses port+N (default: off)",
+    )
+    pmetrics.add_argument(
+        "--metrics-address",
+        default="127.0.0.1",
+        help="address for the metrics listener (default: %(default)s)",
+    )
+    pprofile = p.add_argument_group("Profiling arguments")
+    pprofile.add_argument(
+        "--profile-dir",
+        help="where a capture started by SIGUSR1 is written (default: $TMPDIR)",
+    )
+    pprofile.add_argument(
+        "--profile-seconds",
+        type=float,
+        default=10,
+        help="length of a capture started by SIGUSR1 (default: %(default)s)",
+    )
+    pprofile.add_argument(
+        "--profile-interval-ms",
+        type=float,
+        default=10,
+        help="milliseconds between stack samples during a capture (default: %(default)s)",
+    )
+    pcapture = p.add_argument_group(
+        "Capture arguments",
+        "a running server can also capture for a while on request, over HTTP at "
+        "/debug/capture?seconds=S on --metrics-port",
+    )
+    pcapture.add_argument(
+        "--capture",
+        metavar="FILE",
+        help="record every unary RPC from start to exit to FILE, for ubns_client.py replay; with --workers, worker N writes FILE.N",
+    )
     ptls = p.add_argument_group("TLS arguments")
     ptls.add_argument("--ca-cert", help="CA certificate file")
     ptls.add_argument("--server-cert", help="client certificate file")
     ptls.add_argument("--server-key", help="client key file")
 
     args = p.parse_args()
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
-
-    if args.tls:
-        if not args.server_cert:
-            logging.error("TLS requires a server certificate")
-            sys.exit(1)
-        if not args.server_key:
-            logging.error("TLS requires a server key")
+    listener = setup_logging(logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        if args.tls:
+            if not args.server_cert:
+                logging.error("TLS requires a server certificate")
+                sys.exit(1)
+            if not args.server_key:
+                logging.error("TLS requires a server key")
+                sys.exit(1)
+        if args.backend == "sqlite" and not args.data_dir:
+            logging.error("The sqlite backend requires --data-dir")
             sys.exit(1)
 
-    run(args)
+        run(args)
+    finally:
+        listener.stop()
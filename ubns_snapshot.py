@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped binary snapshots of the UBNS bucket table.
+
+A snapshot is a fixed-layout file that the server maps and serves from as it
+stands, so loading one takes the same time however many buckets it holds:
+nothing is parsed until it's looked up. Lookups go through a hash table of
+record numbers, listings through permutations of the records sorted by each
+filter, and reconciliation through per-cluster leaf digests and a
+permutation sorted by leaf, all precomputed when the snapshot is written.
+
+Layout, little-endian, each section starting on an 8-byte boundary::
+
+    header      magic, version, counts, section offsets, buckets per state,
+                then the tombstones' offset and count
+    strings     the distinct clusters and owners: (n + 1) u64 offsets, then
+                their UTF-8 bytes
+    names       bucket names, UTF-8, one after another in name order
+    records     per bucket, in name order: name offset u64, name length u16,
+                state u8, pad, cluster u32, owner u32 (string numbers)
+    table       open-addressed hash table of record number + 1, by the CRC
+                of the name; 0 is empty
+    by_cluster  (strings + 1) u32 start positions, then the record numbers
+                ordered by (cluster, name)
+    by_owner    likewise, by owner
+    by_state    (STATES + 1) u32 start positions, then the record numbers
+                ordered by (state, name)
+    leaves      per cluster: string number u32, pad, LEAVES u64 digests and
+                (LEAVES + 1) u32 start positions in by_leaf
+    by_leaf     the record numbers ordered by (cluster, leaf, name)
+    tombstones  per deleted bucket, by deletion: sequence number u64, name
+                offset u64, name length u16, pad, cluster u32; then the
+                names, as for the records
+
+Version 1 snapshots, from before tombstones, are still read.
+
+Usage::
+    ./ubns_snapshot.py dump SNAPSHOT > buckets.txt
+    ./ubns_snapshot.py build buckets.txt SNAPSHOT [--last-seq N]
+
+with one "bucket cluster owner state" line per bucket, as the dump prints
+them, so a table can be exported from one server and imported into another.
+"""
+
+import argparse
+from array import array
+from collections import Counter
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from ubns_reconcile import LEAF_DEPTH, LEAVES, entry_hash, node_at
+
+MAGIC = b"UBNSSNAP"
+VERSION = 2
+# Room for a count per state value in the header.
+STATES = 8
+
+_HEADER = struct.Struct("<8sII" + "Q" * 13 + "Q" * STATES)
+# Follows _HEADER from version 2.
+_TOMBSTONE_HEADER = struct.Struct("<QQ")
+_TOMBSTONE = struct.Struct("<QQHxxI")
+_RECORD = struct.Struct("<QHBxII")
+_U32 = struct.Struct("<I")
+_LEAF_STARTS = struct.Struct(f"<{LEAVES + 1}I")
+_LEAF_DIGESTS = struct.Struct(f"<{LEAVES}Q")
+# A cluster's entry in the leaves section.
+_LEAF_ENTRY_SIZE = 8 + _LEAF_DIGESTS.size + (_LEAF_STARTS.size + 7) // 8 * 8
+
+
+class SnapshotFormatError(Exception):
+    def __init__(self, path, reason):
+        super().__init__(f"snapshot '{path}' is unusable: {reason}")
+
+
+def _slot(h: int, bits: int) -> int:
+    # Fibonacci hashing: the CRC's low bits alone cluster for similar names.
+    return ((h * 0x9E3779B1) & 0xFFFFFFFF) >> (32 - bits)
+
+
+def _pad(n: int) -> int:
+    return -n % 8
+
+
+def _key_index(keys: array, nkeys: int) -> tuple[array, array]:
+    """Start positions per key, and record numbers ordered by (key, name)."""
+    counts = Counter(keys)
+    starts = array("I", [0]) * (nkeys + 1)
+    for k in range(nkeys):
+        starts[k + 1] = starts[k] + counts.get(k, 0)
+    # Records are in name order already, and the sort is stable.
+    return starts, array("I", sorted(range(len(keys)), key=keys.__getitem__))
+
+
+def write(path: str, last_seq: int, entries, tombstones=()):
+    """
+    Write a snapshot of (bucket, cluster, owner, state) entries, state being
+    a number below STATES, which must come in bucket name order, and of
+    (bucket, cluster, seq) tombstones in sequence order. The file is
+    fsynced before this returns. Returns the number of buckets.
+    """
+    strings: list[str] = []
+    string_ids: dict[str, int] = {}
+    names = bytearray()
+    records = bytearray()
+    hashes, clusters, owners = array("I"), array("I"), array("I")
+    states = array("B")
+    digests: dict[int, list[int]] = {}
+    previous = None
+    for name, cluster, owner, state in entries:
+        key = name.encode()
+        if previous is not None and key <= previous:
+            raise ValueError(f"snapshot entries out of order at '{name}'")
+        previous = key
+        ids = []
+        for s in (cluster, owner):
+            i = string_ids.get(s)
+            if i is None:
+                i = string_ids[s] = len(strings)
+                strings.append(s)
+            ids.append(i)
+        records += _RECORD.pack(len(names), len(key), state, *ids)
+        names += key
+        h = zlib.crc32(key)
+        hashes.append(h)
+        clusters.append(ids[0])
+        owners.append(ids[1])
+        states.append(state)
+        leaves = digests.get(ids[0])
+        if leaves is None:
+            leaves = digests[ids[0]] = [0] * LEAVES
+        leaves[node_at(h, LEAF_DEPTH)] ^= entry_hash(name, owner)
+    count = len(hashes)
+
+    tombstone_names = bytearray()
+    tombstone_records = bytearray()
+    for name, cluster, seq in tombstones:
+        key = name.encode()
+        i = string_ids.get(cluster)
+        if i is None:
+            i = string_ids[cluster] = len(strings)
+            strings.append(cluster)
+        tombstone_records += _TOMBSTONE.pack(seq, len(tombstone_names), len(key), i)
+        tombstone_names += key
+    ntombstones = len(tombstone_records) // _TOMBSTONE.size
+
+    bits = 3
+    while (1 << bits) < count * 3 // 2:
+        bits += 1
+    table = array("I", [0]) * (1 << bits)
+    mask = (1 << bits) - 1
+    for i, h in enumerate(hashes):
+        slot = _slot(h, bits)
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = i + 1
+
+    encoded = [s.encode() for s in strings]
+    string_offsets = array("Q", [0])
+    for s in encoded:
+        string_offsets.append(string_offsets[-1] + len(s))
+
+    by_cluster = _key_index(clusters, len(strings))
+    by_owner = _key_index(owners, len(strings))
+    by_state = _key_index(states, STATES)
+    cluster_leaf = array(
+        "Q",
+        (c * LEAVES + node_at(h, LEAF_DEPTH) for c, h in zip(clusters, hashes)),
+    )
+    by_leaf = array("I", sorted(range(count), key=cluster_leaf.__getitem__))
+    leaf_counts = Counter(cluster_leaf)
+    del cluster_leaf
+    leaf_sections = []
+    position = 0
+    for c in sorted(digests):
+        starts = [position]
+        for leaf in range(LEAVES):
+            position += leaf_counts.get(c * LEAVES + leaf, 0)
+            starts.append(position)
+        section = (
+            _U32.pack(c)
+            + bytes(4)
+            + _LEAF_DIGESTS.pack(*digests[c])
+            + _LEAF_STARTS.pack(*starts)
+        )
+        leaf_sections.append(section + bytes(_pad(len(section))))
+
+    sections = [
+        string_offsets.tobytes() + b"".join(encoded),
+        names,
+        records,
+        table.tobytes(),
+        by_cluster[0].tobytes() + by_cluster[1].tobytes(),
+        by_owner[0].tobytes() + by_owner[1].tobytes(),
+        by_state[0].tobytes() + by_state[1].tobytes(),
+        b"".join(leaf_sections),
+        by_leaf.tobytes(),
+        tombstone_records + tombstone_names,
+    ]
+    offsets = []
+    header_size = _HEADER.size + _TOMBSTONE_HEADER.size
+    position = header_size + _pad(header_size)
+    for section in sections:
+        offsets.append(position)
+        position += len(section) + _pad(len(section))
+    state_counts = Counter(states)
+    header = _HEADER.pack(
+        MAGIC,
+        VERSION,
+        len(digests),
+        last_seq,
+        count,
+        len(strings),
+        bits,
+        *offsets[:-1],
+        *(state_counts.get(s, 0) for s in range(STATES)),
+    ) + _TOMBSTONE_HEADER.pack(offsets[-1], ntombstones)
+
+    with open(path, "wb") as f:
+        f.write(header + bytes(_pad(len(header))))
+        for section in sections:
+            f.write(section)
+            f.write(bytes(_pad(len(section))))
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+
+class Snapshot:
+    """
+    A snapshot file, mapped read-only. Safe to read from any number of
+    threads at once, since nothing in it ever changes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < _HEADER.size:
+            raise SnapshotFormatError(path, "truncated header")
+        fields = _HEADER.unpack_from(self._mm, 0)
+        magic, version, nclusters = fields[:3]
+        if magic != MAGIC:
+            raise SnapshotFormatError(path, "not a snapshot")
+        if version not in (1, VERSION):
+            raise SnapshotFormatError(path, f"unknown version {version}")
+        self.last_seq, self.count, nstrings, self._bits = fields[3:7]
+        (
+            strings,
+            self._names,
+            self._records,
+            self._table,
+            by_cluster,
+            by_owner,
+            by_state,
+            leaves,
+            self._by_leaf,
+        ) = fields[7:16]
+        self.state_counts = dict(enumerate(fields[16:]))
+        if version >= 2:
+            self._tombstones, self.tombstone_count = _TOMBSTONE_HEADER.unpack_from(
+                self._mm, _HEADER.size
+            )
+        else:
+            self._tombstones, self.tombstone_count = 0, 0
+
+        # Clusters and owners are few enough to decode up front, and then
+        # every record shares the one copy of each.
+        offsets = struct.unpack_from(f"<{nstrings + 1}Q", self._mm, strings)
+        base = strings + 8 * (nstrings + 1)
+        self.strings = [
+            sys.intern(self._mm[base + a : base + b].decode())
+            for a, b in zip(offsets, offsets[1:])
+        ]
+        self._string_ids = {s: i for i, s in enumerate(self.strings)}
+        # Each key index is its start positions followed by record numbers.
+        self._by_cluster = (by_cluster, by_cluster + 4 * (nstrings + 1))
+        self._by_owner = (by_owner, by_owner + 4 * (nstrings + 1))
+        self._by_state = (by_state, by_state + 4 * (STATES + 1))
+        self._leaves = {}
+        for i in range(nclusters):
+            offset = leaves + i * _LEAF_ENTRY_SIZE
+            (c,) = _U32.unpack_from(self._mm, offset)
+            self._leaves[self.strings[c]] = offset + 8
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._mm.close()
+
+    def _record(self, i: int) -> tuple:
+        return _RECORD.unpack_from(self._mm, self._records + i * _RECORD.size)
+
+    def _name_bytes(self, i: int) -> bytes:
+        offset, length = _RECORD.unpack_from(
+            self._mm, self._records + i * _RECORD.size
+        )[:2]
+        start = self._names + offset
+        return self._mm[start : start + length]
+
+    def entry(self, i: int) -> tuple[str, str, str, int]:
+        """Record i's (bucket, cluster, owner, state), in name order."""
+        offset, length, state, cluster, owner = self._record(i)
+        start = self._names + offset
+        return (
+            self._mm[start : start + length].decode(),
+            self.strings[cluster],
+            self.strings[owner],
+            state,
+        )
+
+    def entries(self):
+        """Every (bucket, cluster, owner, state), in name order."""
+        for i in range(self.count):
+            yield self.entry(i)
+
+    def tombstones(self):
+        """Every (bucket, cluster, seq) tombstone, in sequence order."""
+        names = self._tombstones + self.tombstone_count * _TOMBSTONE.size
+        for i in range(self.tombstone_count):
+            seq, offset, length, cluster = _TOMBSTONE.unpack_from(
+                self._mm, self._tombstones + i * _TOMBSTONE.size
+            )
+            start = names + offset
+            yield self._mm[start : start + length].decode(), self.strings[cluster], seq
+
+    def get(self, bucket_name: str) -> tuple[str, str, int]:
+        """A bucket's (cluster, owner, state), or None."""
+        key = bucket_name.encode()
+        mask = (1 << self._bits) - 1
+        slot = _slot(zlib.crc32(key), self._bits)
+        while True:
+            (n,) = _U32.unpack_from(self._mm, self._table + 4 * slot)
+            if n == 0:
+                return None
+            offset, length, state, cluster, owner = self._record(n - 1)
+            start = self._names + offset
+            if self._mm[start : start + length] == key:
+                return self.strings[cluster], self.strings[owner], state
+            slot = (slot + 1) & mask
+
+    def _at(self, perm: int, position: int) -> int:
+        return _U32.unpack_from(self._mm, perm + 4 * position)[0]
+
+    def _key_range(self, index: tuple, key: int) -> tuple:
+        starts, perm = index
+        lo, hi = struct.unpack_from("<2I", self._mm, starts + 4 * key)
+        return lo, hi, perm
+
+    def candidates_after(
+        self,
+        cluster,
+        owner,
+        state,
+        after: str,
+        n: int,
+        end: str = None,
+        inclusive: bool = False,
+    ):
+        """
+        Up to n bucket names after `after` (or from it, if inclusive) and
+        before `end`, from the most selective index for the filters, as
+        BucketIndex.candidates_after() does. They may not match the other
+        filters; the caller checks.
+        """
+        options = [(0, self.count, None)]
+        for index, key in ((self._by_cluster, cluster), (self._by_owner, owner)):
+            if key:
+                i = self._string_ids.get(key)
+                if i is None:
+                    return []
+                options.append(self._key_range(index, i))
+        if state is not None:
+            options.append(self._key_range(self._by_state, state))
+        lo, stop, perm = min(options[1:] or options, key=lambda o: o[1] - o[0])
+
+        def record(position):
+            return position if perm is None else self._at(perm, position)
+
+        def first_from(lo, hi, key, inclusive):
+            # The first position whose name sorts after key, or from it.
+            while lo < hi:
+                mid = (lo + hi) // 2
+                name = self._name_bytes(record(mid))
+                if name < key or (name == key and not inclusive):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        lo = first_from(lo, stop, after.encode(), inclusive)
+        if end is not None:
+            stop = first_from(lo, min(lo + n, stop), end.encode(), True)
+        return [
+            self._name_bytes(record(p)).decode() for p in range(lo, min(lo + n, stop))
+        ]
+
+    def leaf_digests(self, cluster: str) -> list[int]:
+        """A cluster's reconciliation leaf digests."""
+        offset = self._leaves.get(cluster)
+        if offset is None:
+            return [0] * LEAVES
+        return list(_LEAF_DIGESTS.unpack_from(self._mm, offset))
+
+    def leaf_entries(self, cluster: str, leaf: int) -> list[tuple[str, str]]:
+        """A cluster's (bucket, owner) entries in one reconciliation leaf."""
+        offset = self._leaves.get(cluster)
+        if offset is None:
+            return []
+        lo, hi = struct.unpack_from(
+            "<2I", self._mm, offset + _LEAF_DIGESTS.size + 4 * leaf
+        )
+        entries = []
+        for position in range(lo, hi):
+            name, _, owner, _ = self.entry(self._at(self._by_leaf, position))
+            entries.append((name, owner))
+        return entries
+
+
+def _dump(args):
+    snapshot = Snapshot(args.snapshot)
+    for name, cluster, owner, state in snapshot.entries():
+        print(name, cluster, owner, state)
+
+
+def _build(args):
+    def entries():
+        with open(args.entries) as f:
+            for line in f:
+                name, cluster, owner, state = line.split()
+                yield name, cluster, owner, int(state)
+
+    count = write(args.snapshot, args.last_seq, entries())
+    print(f"wrote {count} buckets to {args.snapshot}", file=sys.stderr)
+
+
+def main(argv):
+    p = argparse.ArgumentParser(description="UBNS snapshot export and import")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    pdump = sub.add_parser("dump", help="print a snapshot's buckets, one per line")
+    pdump.add_argument("snapshot")
+    pdump.set_defaults(func=_dump)
+
+    pbuild = sub.add_parser(
+        "build", help="write a snapshot from lines in the format dump prints"
+    )
+    pbuild.add_argument("entries", help="file of lines, sorted by bucket name")
+    pbuild.add_argument("snapshot")
+    pbuild.add_argument(
+        "--last-seq",
+        type=int,
+        default=0,
+        help="log sequence number the snapshot is as of (default: %(default)s)",
+    )
+    pbuild.set_defaults(func=_build)
+
+    args = p.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,472 @@
+"""
+SQLite storage for the UBNS bucket table.
+
+The in-memory backend holds the whole table in the server's heap, which
+bounds it by RAM. This one keeps it in a SQLite database in WAL mode, with
+only a bounded page cache in memory, so the table can be far larger than
+RAM, and the database file is its own log: no snapshots or replay.
+
+BucketTable deals in plain (bucket, cluster, owner, state) rows, with
+states as their numbers; ubns_server's SQLiteBucketDatabase puts the bucket
+lifecycle on top. There is one writer connection, used under `lock` by
+whoever is mutating, and each reading thread has its own connection, which
+sees the table as of the last commit and never waits for the writer.
+
+The names of buckets and tombstones are kept in a counting Bloom filter in
+memory, rebuilt from the tables on opening, so that looking up a name that
+isn't there, as every create does, mostly doesn't touch the disk.
+
+Mutations accumulate in an open transaction and are committed with group
+commit, as for the write-ahead log: ticket() hands back the caller's place,
+and the first wait() to find no commit in progress commits everything so
+far, with one fsync, for every waiter it covers.
+
+Schema::
+
+    buckets     name primary key, cluster, owner, state, reconciliation
+                leaf; indexed by (cluster, name), (owner, name),
+                (state, name) and (cluster, leaf)
+    states      state primary key, number of buckets in it
+    leaves      (cluster, leaf) primary key, XOR of its entry hashes
+    tombstones  name primary key, cluster, deletion sequence number;
+                indexed by sequence number
+    meta        key primary key, value: the last sequence number
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+from ubns_bloom import CountingBloomFilter
+from ubns_reconcile import LEAVES, entry_hash, leaf_of
+from ubns_wal import SyncMode
+
+DB_NAME = "buckets.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    cluster TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    state INTEGER NOT NULL,
+    leaf INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS buckets_cluster ON buckets (cluster, name);
+CREATE INDEX IF NOT EXISTS buckets_owner ON buckets (owner, name);
+CREATE INDEX IF NOT EXISTS buckets_state ON buckets (state, name);
+CREATE INDEX IF NOT EXISTS buckets_leaf ON buckets (cluster, leaf);
+CREATE TABLE IF NOT EXISTS states (
+    state INTEGER PRIMARY KEY,
+    n INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leaves (
+    cluster TEXT NOT NULL,
+    leaf INTEGER NOT NULL,
+    digest INTEGER NOT NULL,
+    PRIMARY KEY (cluster, leaf)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tombstones (
+    name TEXT PRIMARY KEY,
+    cluster TEXT NOT NULL,
+    seq INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tombstones_seq ON tombstones (seq);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+_SYNCHRONOUS = {
+    # FULL fsyncs the SQLite log on every commit; NORMAL would only do so
+    # at its checkpoints, which isn't durable.
+    SyncMode.GROUP: "FULL",
+    SyncMode.PER_OP: "FULL",
+    SyncMode.NONE: "OFF",
+}
+
+# Pages each reading connection caches. There's one per thread, and the OS
+# page cache is shared between them anyway, so this only needs to hold the
+# top of the B-trees.
+_READER_CACHE_KB = 2048
+
+# The Bloom filter is sized for twice the names there are on opening, or
+# this many if that's more.
+BLOOM_MIN_CAPACITY = 1 << 20
+
+
+class StoreFailedError(Exception):
+    def __init__(self, cause):
+        super().__init__(f"bucket store failed: {cause}")
+
+
+def _signed(digest: int) -> int:
+    """A 64-bit digest as SQLite's signed 64-bit integer."""
+    return digest - (1 << 64) if digest >= 1 << 63 else digest
+
+
+def _name_bounds(end, inclusive) -> list[str]:
+    # Names sort as in Python: BINARY collation compares UTF-8 bytes, which
+    # order as the code points do.
+    where = ["name >= ?" if inclusive else "name > ?"]
+    if end is not None:
+        where.append("name < ?")
+    return where
+
+
+def _listing_query(cluster, owner, state, end, inclusive) -> str:
+    # The filters are part of the statement text rather than bound as
+    # NULL-or-value, so that SQLite can plan each combination with its own
+    # index, and the connection's statement cache keeps each one prepared.
+    where = _name_bounds(end, inclusive)
+    if cluster:
+        where.append("cluster = ?")
+    if owner:
+        where.append("owner = ?")
+    if state is not None:
+        where.append("state = ?")
+    return (
+        "SELECT name, cluster, owner, state FROM buckets WHERE "
+        + " AND ".join(where)
+        + " ORDER BY name LIMIT ?"
+    )
+
+
+class BucketTable:
+    """The bucket table and its tombstones in a SQLite database."""
+
+    def __init__(
+        self,
+        data_dir: str,
+        sync_mode: SyncMode = SyncMode.GROUP,
+        cache_mb: int = 64,
+        bloom_fp_rate: float = 0.01,
+    ):
+        os.makedirs(data_dir, exist_ok=True)
+        self.path = os.path.join(data_dir, DB_NAME)
+        self.sync_mode = sync_mode
+        # Held for every use of the writer connection.
+        self.lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._readers = threading.local()
+        self._writer = self._connect()
+        self._writer.execute(f"PRAGMA cache_size = -{cache_mb * 1024}")
+        self._writer.executescript(_SCHEMA)
+        row = self._writer.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+        self.seq = row[0] if row is not None else 0
+        # Mutations made, and committed, as tickets for wait().
+        self._written = 0
+        self._committed = 0
+        self._committing = False
+        self._error = None
+        self.bloom = None
+        # Lookups the filter answered, and those it said might find something
+        # that then found neither a bucket nor a tombstone.
+        self.bloom_negatives = 0
+        self.bloom_false_positives = 0
+        if bloom_fp_rate:
+            self._build_bloom(bloom_fp_rate)
+
+    def _build_bloom(self, fp_rate: float):
+        names = self._writer.execute(
+            "SELECT (SELECT count(*) FROM buckets) + (SELECT count(*) FROM tombstones)"
+        ).fetchone()[0]
+        self.bloom = CountingBloomFilter(max(BLOOM_MIN_CAPACITY, 2 * names), fp_rate)
+        for (name,) in self._writer.execute(
+            "SELECT name FROM buckets UNION ALL SELECT name FROM tombstones"
+        ):
+            self.bloom.add(name)
+
+    def _absent(self, name: str) -> bool:
+        """Whether the filter says a name is neither a bucket nor a tombstone."""
+        if self.bloom is None or name in self.bloom:
+            return False
+        self.bloom_negatives += 1
+        return True
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {_SYNCHRONOUS[self.sync_mode]}")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = self._readers.conn = self._connect()
+            conn.execute(f"PRAGMA cache_size = -{_READER_CACHE_KB}")
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    # Reads through the writer connection, which see uncommitted changes.
+    # Caller must hold the lock.
+
+    def find(self, name: str) -> tuple:
+        """A bucket's (cluster, owner, state), or None."""
+        if self._absent(name):
+            return None
+        return self._writer.execute(
+            "SELECT cluster, owner, state FROM buckets WHERE name = ?", (name,)
+        ).fetchone()
+
+    def tombstone(self, name: str) -> tuple:
+        """
+        A deleted bucket's (seq, cluster), or None. Only asked about names
+        that find() didn't find.
+        """
+        if self._absent(name):
+            return None
+        found = self._writer.execute(
+            "SELECT seq, cluster FROM tombstones WHERE name = ?", (name,)
+        ).fetchone()
+        if found is None and self.bloom is not None:
+            self.bloom_false_positives += 1
+        return found
+
+    # Mutations. Caller must hold the lock, then call ticket() and, without
+    # the lock, wait().
+
+    def _count(self, state: int, n: int):
+        self._writer.execute(
+            "INSERT INTO states (state, n) VALUES (?, ?) "
+            "ON CONFLICT (state) DO UPDATE SET n = n + excluded.n",
+            (state, n),
+        )
+
+    def _toggle_digest(self, name: str, cluster: str, owner: str, leaf: int):
+        row = self._writer.execute(
+            "SELECT digest FROM leaves WHERE cluster = ? AND leaf = ?", (cluster, leaf)
+        ).fetchone()
+        digest = (row[0] if row is not None else 0) ^ _signed(entry_hash(name, owner))
+        if digest:
+            self._writer.execute(
+                "INSERT OR REPLACE INTO leaves (cluster, leaf, digest) VALUES (?, ?, ?)",
+                (cluster, leaf, digest),
+            )
+        else:
+            self._writer.execute(
+                "DELETE FROM leaves WHERE cluster = ? AND leaf = ?", (cluster, leaf)
+            )
+
+    def insert(self, name: str, cluster: str, owner: str, state: int):
+        """Add a bucket, dropping any tombstone it had."""
+        if self._absent(name):
+            buried = 0
+        else:
+            buried = self._writer.execute(
+                "DELETE FROM tombstones WHERE name = ?", (name,)
+            ).rowcount
+        # A tombstone's name is in the filter already.
+        if self.bloom is not None and not buried:
+            self.bloom.add(name)
+            if len(self.bloom) == self.bloom.capacity + 1:
+                logging.warning(
+                    "Bloom filter is past its capacity of %d names, and will "
+                    "give more false positives until a restart resizes it",
+                    self.bloom.capacity,
+                )
+        leaf = leaf_of(name)
+        self._writer.execute(
+            "INSERT INTO buckets (name, cluster, owner, state, leaf) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (name, cluster, owner, state, leaf),
+        )
+        self._count(state, 1)
+        self._toggle_digest(name, cluster, owner, leaf)
+        self._mutated()
+
+    def set_state(self, name: str, old: int, state: int):
+        self._writer.execute(
+            "UPDATE buckets SET state = ? WHERE name = ?", (state, name)
+        )
+        self._count(old, -1)
+        self._count(state, 1)
+        self._mutated()
+
+    def remove(self, name: str, cluster: str, owner: str, state: int) -> int:
+        """Remove a bucket and leave its tombstone. Returns its sequence number."""
+        self._writer.execute("DELETE FROM buckets WHERE name = ?", (name,))
+        self._count(state, -1)
+        self._toggle_digest(name, cluster, owner, leaf_of(name))
+        self._mutated()
+        self._writer.execute(
+            "INSERT OR REPLACE INTO tombstones (name, cluster, seq) VALUES (?, ?, ?)",
+            (name, cluster, self.seq),
+        )
+        return self.seq
+
+    def purge(self, upto_seq: int, limit: int) -> int:
+        """
+        Drop up to `limit` of the oldest tombstones, those of deletions up
+        to upto_seq. Returns how many were dropped.
+        """
+        names = self._writer.execute(
+            "SELECT name FROM tombstones WHERE seq <= ? ORDER BY seq LIMIT ?",
+            (upto_seq, limit),
+        ).fetchall()
+        self._writer.executemany("DELETE FROM tombstones WHERE name = ?", names)
+        if self.bloom is not None:
+            for (name,) in names:
+                self.bloom.remove(name)
+        if names:
+            self._written += 1
+        return len(names)
+
+    def _mutated(self):
+        self.seq += 1
+        self._written += 1
+
+    def ticket(self) -> int:
+        """
+        The ticket covering every mutation so far. With SyncMode.PER_OP
+        they're committed here, and there's nothing to wait for.
+        """
+        if self.sync_mode == SyncMode.PER_OP:
+            self._commit_locked()
+            return None
+        return self._written
+
+    def check(self):
+        """
+        Raise StoreFailedError if a commit has failed: every later one will
+        too, so nothing more should be written. Caller must hold the lock.
+        """
+        if self._error is not None:
+            raise StoreFailedError(self._error)
+
+    def _commit_locked(self):
+        self.check()
+        try:
+            self._writer.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('seq', ?)",
+                (self.seq,),
+            )
+            self._writer.commit()
+        except sqlite3.Error as e:
+            self._error = e
+            raise StoreFailedError(e)
+
+    def wait(self, ticket: int):
+        """Block until the mutations covered by a ticket are committed."""
+        if ticket is None:
+            return
+        with self._cond:
+            while self._committed < ticket:
+                if self._error is not None:
+                    raise StoreFailedError(self._error)
+                if self._committing:
+                    self._cond.wait()
+                    continue
+
+                # Become the leader for everything written so far.
+                self._committing = True
+                self._cond.release()
+                upto = None
+                try:
+                    with self.lock:
+                        upto = self._written
+                        self._commit_locked()
+                except StoreFailedError:
+                    pass
+                finally:
+                    self._cond.acquire()
+                    self._committing = False
+                    if upto is not None and self._error is None:
+                        self._committed = upto
+                    self._cond.notify_all()
+
+    # Reads through this thread's reader connection, which see the table as
+    # of the last commit. No lock needed.
+
+    def get(self, name: str) -> tuple:
+        """A bucket's (cluster, owner, state), or None."""
+        return (
+            self._reader()
+            .execute("SELECT cluster, owner, state FROM buckets WHERE name = ?", (name,))
+            .fetchone()
+        )
+
+    def rows_after(
+        self,
+        cluster: str,
+        owner: str,
+        state: int,
+        after: str,
+        limit: int,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple]:
+        """
+        Up to limit (bucket, cluster, owner, state) rows matching the
+        filters that are set, in name order, after the bucket named `after`
+        (or from it, if inclusive) and before `end`, if it's set.
+        """
+        args = [after]
+        if end is not None:
+            args.append(end)
+        args.extend(v for v in (cluster, owner) if v)
+        if state is not None:
+            args.append(state)
+        args.append(limit)
+        return (
+            self._reader()
+            .execute(_listing_query(cluster, owner, state, end, inclusive), args)
+            .fetchall()
+        )
+
+    def tombstones_after(
+        self,
+        cluster: str,
+        after: str,
+        limit: int,
+        end: str = None,
+        inclusive: bool = False,
+    ) -> list[tuple]:
+        """Up to limit (bucket, cluster, seq) tombstones, as for rows_after()."""
+        where = _name_bounds(end, inclusive)
+        args = [after]
+        if end is not None:
+            args.append(end)
+        if cluster:
+            where.append("cluster = ?")
+            args.append(cluster)
+        args.append(limit)
+        query = (
+            "SELECT name, cluster, seq FROM tombstones WHERE "
+            + " AND ".join(where)
+            + " ORDER BY name LIMIT ?"
+        )
+        return self._reader().execute(query, args).fetchall()
+
+    def leaf_digests(self, cluster: str) -> list[int]:
+        digests = [0] * LEAVES
+        for leaf, digest in self._reader().execute(
+            "SELECT leaf, digest FROM leaves WHERE cluster = ?", (cluster,)
+        ):
+            digests[leaf] = digest & ((1 << 64) - 1)
+        return digests
+
+    def leaf_entries(self, cluster: str, leaf: int) -> list[tuple[str, str]]:
+        """(bucket, owner) for a cluster's buckets in a leaf."""
+        return (
+            self._reader()
+            .execute(
+                "SELECT name, owner FROM buckets WHERE cluster = ? AND leaf = ?",
+                (cluster, leaf),
+            )
+            .fetchall()
+        )
+
+    def state_counts(self) -> dict[int, int]:
+        """Number of buckets with each state number."""
+        return dict(self._reader().execute("SELECT state, n FROM states"))
+
+    def tombstone_count(self) -> int:
+        return self._reader().execute("SELECT count(*) FROM tombstones").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            if self._error is None:
+                self._commit_locked()
+            self._writer.close()
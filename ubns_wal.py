@@ -0,0 +1,279 @@
+"""
+Write-ahead log and snapshot persistence for the UBNS bucket name database.
+
+Every mutation is logged as a full-state record, either a ``put`` carrying the
+complete bucket entry or a ``del`` carrying the name and the cluster for its
+tombstone, so replay is idempotent. That lets snapshots be taken without stopping writers: the log is
+rotated at sequence S, the database is copied out (possibly picking up changes
+newer than S) and on restart the log tail after S is replayed over the
+snapshot, which converges on the state as of the last logged record.
+
+Snapshots are in the memory-mapped format of ubns_snapshot, which the
+database serves from without loading it. A snapshot.json from before that
+is still read, and replaced by the next snapshot written.
+
+Layout of the data directory::
+
+    snapshot.ubns               the table as of some sequence number
+    wal.<first-seq>.log         log segments, one JSON record per line
+"""
+
+from enum import Enum
+import json
+import logging
+import os
+import threading
+
+import ubns_snapshot
+
+SNAPSHOT_NAME = "snapshot.ubns"
+# Header line, then one JSON put record per bucket.
+JSON_SNAPSHOT_NAME = "snapshot.json"
+SEGMENT_PREFIX = "wal."
+SEGMENT_SUFFIX = ".log"
+
+
+class SyncMode(Enum):
+    # Batch concurrent appends into one write+fsync.
+    GROUP = "group"
+    # Write and fsync every record before append() returns.
+    PER_OP = "per-op"
+    # Write to the OS but never fsync. Only useful for testing.
+    NONE = "none"
+
+
+class WALFailedError(Exception):
+    def __init__(self, cause):
+        super().__init__(f"write-ahead log failed: {cause}")
+
+
+def _encode(record: dict) -> bytes:
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """
+    Append-only mutation log with group commit.
+
+    append() only buffers the record and hands back a ticket; wait() blocks
+    until that ticket is on disk. The first waiter to find no flush in
+    progress becomes the leader, writes out everything buffered so far and
+    fsyncs once, then wakes every waiter its flush covered. Appends that
+    arrive during an fsync pile up for the next leader, so the number of
+    fsyncs tracks disk latency rather than request rate.
+    """
+
+    def __init__(self, data_dir: str, sync_mode: SyncMode = SyncMode.GROUP):
+        self.data_dir = data_dir
+        self.sync_mode = sync_mode
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._file = None
+        self._buffer: list[bytes] = []
+        self._appended = 0
+        self._durable = 0
+        self._flushing = False
+        self._error = None
+        # Records logged since the last rotation, used to trigger snapshots.
+        self.records_since_rotate = 0
+        os.makedirs(data_dir, exist_ok=True)
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(
+            self.data_dir, f"{SEGMENT_PREFIX}{first_seq:020d}{SEGMENT_SUFFIX}"
+        )
+
+    def _segments(self) -> list[tuple[int, str]]:
+        segments = []
+        for name in os.listdir(self.data_dir):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                first_seq = int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+                segments.append((first_seq, os.path.join(self.data_dir, name)))
+        return sorted(segments)
+
+    def recover(self, apply, load) -> int:
+        """
+        Hand the snapshot, mapped, to load(snapshot) and replay the log tail
+        through apply(record), then open a segment for new appends. Returns
+        the last sequence number seen, which the caller must continue from.
+        A JSON snapshot is replayed through apply() instead.
+        """
+        last_seq = 0
+        snapshot_path = os.path.join(self.data_dir, SNAPSHOT_NAME)
+        json_path = os.path.join(self.data_dir, JSON_SNAPSHOT_NAME)
+        if os.path.exists(snapshot_path):
+            snapshot = ubns_snapshot.Snapshot(snapshot_path)
+            load(snapshot)
+            last_seq = snapshot.last_seq
+            logging.info(
+                f"Mapped snapshot: {len(snapshot)} buckets up to sequence {last_seq}"
+            )
+        elif os.path.exists(json_path):
+            with open(json_path, "rb") as f:
+                header = json.loads(f.readline())
+                last_seq = header["last_seq"]
+                count = 0
+                for line in f:
+                    apply(json.loads(line))
+                    count += 1
+            logging.info(
+                f"Loaded snapshot: {count} buckets up to sequence {last_seq}"
+            )
+
+        segments = self._segments()
+        replayed = 0
+        for i, (_, path) in enumerate(segments):
+            with open(path, "rb") as f:
+                good_offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("truncated record")
+                        record = json.loads(line)
+                    except ValueError:
+                        if i != len(segments) - 1:
+                            raise
+                        # A torn write at the very end of the log is the
+                        # expected result of a crash mid-append; that record
+                        # was never acknowledged, so drop it.
+                        logging.warning(
+                            f"Truncating torn record at {path}:{good_offset}"
+                        )
+                        break
+                    good_offset += len(line)
+                    if record["seq"] <= last_seq:
+                        continue
+                    apply(record)
+                    last_seq = record["seq"]
+                    replayed += 1
+            if os.path.getsize(path) != good_offset:
+                os.truncate(path, good_offset)
+        logging.info(f"Replayed {replayed} log records, last sequence {last_seq}")
+
+        if segments and os.path.getsize(segments[-1][1]) == 0:
+            path = segments[-1][1]
+        else:
+            path = self._segment_path(last_seq + 1)
+        self._file = open(path, "ab")
+        _fsync_dir(self.data_dir)
+        return last_seq
+
+    def append(self, record: dict) -> int:
+        """
+        Queue a record for the log and return its ticket for wait(). The
+        caller is responsible for ordering: records hit the log in the order
+        append() is called.
+        """
+        line = _encode(record)
+        with self._lock:
+            if self._error is not None:
+                raise WALFailedError(self._error)
+            self._buffer.append(line)
+            self._appended += 1
+            self.records_since_rotate += 1
+            ticket = self._appended
+            if self.sync_mode == SyncMode.PER_OP:
+                self._write_locked()
+        return ticket
+
+    def _sync(self, f):
+        f.flush()
+        if self.sync_mode != SyncMode.NONE:
+            os.fsync(f.fileno())
+
+    def _write_locked(self):
+        batch, self._buffer = self._buffer, []
+        try:
+            self._file.write(b"".join(batch))
+            self._sync(self._file)
+        except OSError as e:
+            self._error = e
+            self._cond.notify_all()
+            raise WALFailedError(e)
+        self._durable = self._appended
+
+    def wait(self, ticket: int):
+        """Block until the record with the given ticket is durable."""
+        with self._cond:
+            while self._durable < ticket:
+                if self._error is not None:
+                    raise WALFailedError(self._error)
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+
+                # Become the leader for everything buffered so far.
+                self._flushing = True
+                batch, self._buffer = self._buffer, []
+                upto = self._appended
+                f = self._file
+                self._lock.release()
+                try:
+                    f.write(b"".join(batch))
+                    self._sync(f)
+                except OSError as e:
+                    self._error = e
+                finally:
+                    self._lock.acquire()
+                    self._flushing = False
+                    if self._error is None:
+                        self._durable = upto
+                    self._cond.notify_all()
+
+    def rotate(self, next_seq: int):
+        """
+        Start a new segment whose first record will be next_seq. The caller
+        must hold whatever lock orders sequence assignment, so that no record
+        numbered below next_seq is appended afterwards.
+        """
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+            if self._error is not None:
+                raise WALFailedError(self._error)
+            self._write_locked()
+            self._file.close()
+            self._file = open(self._segment_path(next_seq), "ab")
+            self.records_since_rotate = 0
+        _fsync_dir(self.data_dir)
+
+    def write_snapshot(self, last_seq: int, entries, tombstones=()):
+        """
+        Atomically replace the snapshot with the given (bucket, cluster,
+        owner, state) entries, in bucket name order, and (bucket, cluster,
+        seq) tombstones, in sequence order, which must include every
+        mutation up to last_seq, then drop the log segments it supersedes.
+        """
+        path = os.path.join(self.data_dir, SNAPSHOT_NAME)
+        tmp_path = path + ".tmp"
+        count = ubns_snapshot.write(tmp_path, last_seq, entries, tombstones)
+        # A snapshot that's already mapped stays readable after this.
+        os.replace(tmp_path, path)
+        _fsync_dir(self.data_dir)
+
+        json_path = os.path.join(self.data_dir, JSON_SNAPSHOT_NAME)
+        if os.path.exists(json_path):
+            os.unlink(json_path)
+
+        for first_seq, segment in self._segments():
+            if first_seq <= last_seq:
+                os.unlink(segment)
+        logging.info(f"Wrote snapshot: {count} buckets up to sequence {last_seq}")
+
+    def close(self):
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+            if self._file is not None:
+                if self._error is None:
+                    self._write_locked()
+                self._file.close()
+                self._file = None
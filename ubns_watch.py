@@ -0,0 +1,106 @@
+"""
+Change feed for WatchBucketEntries.
+
+Every mutation a database applies is published here with its sequence
+number, into a fixed-size ring: the change numbered seq goes in slot seq %
+capacity, overwriting the one `capacity` changes older. Publishing is a
+list store and, only if some watcher is waiting, a wakeup, so it costs a
+mutation next to nothing and never waits for a watcher.
+
+Each watcher keeps its own position and reads the ring from there at its
+own pace. One that is slower than the changes coming in finds that the
+slots it wanted have been overwritten, and is told so, rather than
+holding anything up; the same goes for resuming from further back than the
+ring reaches, or from a sequence number the database hasn't got to (say,
+after a restart without persistence).
+"""
+
+import asyncio
+import threading
+
+
+class ChangeFeed:
+    """
+    The last `capacity` changes, as (seq, bucket, cluster, owner, state)
+    tuples with the database's BucketState. A deletion is published with
+    state DELETED and the owner the bucket had.
+    """
+
+    def __init__(self, capacity: int, seq: int = 0):
+        self.capacity = capacity
+        # The sequence number of the last change published.
+        self.seq = seq
+        self._ring = [None] * capacity
+        self._cond = threading.Condition(threading.Lock())
+        # Threads in wait(), and (loop, event) for asyncio waiters.
+        self._waiting = 0
+        self._wakeups = []
+
+    def publish(self, seq: int, bucket: str, cluster: str, owner: str, state):
+        """
+        Add a change. The caller serializes publishing, in sequence order:
+        the database does it where it numbers the change.
+        """
+        self._ring[seq % self.capacity] = (seq, bucket, cluster, owner, state)
+        # Waiters register before they check seq, so once seq is set,
+        # either they see the change or we see them.
+        self.seq = seq
+        if self._waiting or self._wakeups:
+            self.wake()
+
+    def wake(self):
+        """Wake every waiter, as if there had been a change."""
+        with self._cond:
+            self._cond.notify_all()
+            wakeups, self._wakeups = self._wakeups, []
+        for loop, event in wakeups:
+            loop.call_soon_threadsafe(event.set)
+
+    def changes_after(self, after: int, limit: int = 1000) -> list:
+        """
+        Up to limit changes following the one numbered `after`, oldest
+        first. None if any of them aren't held, or `after` is ahead of the
+        feed. Reads without locking: a slot overwritten as it's read shows
+        a later seq, and counts as not held.
+        """
+        head = self.seq
+        if after > head or after < head - self.capacity:
+            return None
+        ring, capacity = self._ring, self.capacity
+        changes = []
+        for seq in range(after + 1, min(head, after + limit) + 1):
+            change = ring[seq % capacity]
+            if change is None or change[0] != seq:
+                return None
+            changes.append(change)
+        return changes
+
+    def wait(self, after: int, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for a change after `after`. Returns
+        whether there is one.
+        """
+        with self._cond:
+            self._waiting += 1
+            try:
+                if self.seq == after:
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting -= 1
+        return self.seq != after
+
+    async def wait_async(self, after: int, timeout: float) -> bool:
+        """As wait(), from a coroutine."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            self._wakeups.append(waiter)
+        try:
+            if self.seq == after:
+                await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                if waiter in self._wakeups:
+                    self._wakeups.remove(waiter)
+        return self.seq != after